@@ -0,0 +1,38 @@
+import os
+import tempfile
+
+# the suite runs on local SQLite databases, the Postgres settings are unused
+for name, value in {
+    "DJANGO_SECRET_KEY": "test",
+    "DEBUG": "False",
+    "ORIGIN": "http://localhost",
+    "DATABASE_NAME": "",
+    "DATABASE_USER": "",
+    "DATABASE_PASSWORD": "",
+    "DATABASE_HOST": "",
+    "DATABASE_PORT": "",
+}.items():
+    os.environ.setdefault(name, value)
+
+from .settings import *  # noqa: E402,F403
+
+SQLITE = {"ENGINE": "django.db.backends.sqlite3"}
+
+DATABASES = {
+    "default": {**SQLITE, "NAME": "default"},
+    "shard0": {**SQLITE, "NAME": "shard0"},
+    "shard1": {**SQLITE, "NAME": "shard1"},
+    # routed to by tests that override DATABASE_REPLICAS, reads the default
+    # database through a connection of its own
+    "replica0": {**SQLITE, "NAME": "replica0", "TEST": {"MIRROR": "default"}},
+}
+DATABASE_SHARDS = ["default", "shard0", "shard1"]
+DATABASE_REPLICAS = []
+
+# every test sees a change of the shard map right away
+SHARD_MAP_SECONDS = 0.0
+
+# the views log every handled error, keep them out of the test output
+LOG_LEVEL = "CRITICAL"
+
+MEDIA_ROOT = tempfile.mkdtemp(prefix="bug-pen-media-")
@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class BugTrackerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'bug_tracker'
+
+    def ready(self):
+        from django.conf import settings
+
+        from .log import startLogging
+
+        startLogging(settings.LOG_LEVEL)
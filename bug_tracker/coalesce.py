@@ -0,0 +1,64 @@
+import threading
+import time
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Run one build per key at a time. Callers that arrive while a build is in
+    flight wait for it and share its result, which is then reused by later
+    callers for ttl seconds.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.results = {}
+
+    def do(self, key, function):
+        with self.lock:
+            now = time.monotonic()
+            result = self.results.get(key)
+            if result is not None and result[0] > now:
+                return result[1]
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = function()
+        except BaseException as error:
+            # a leader stopped by a timeout or a kill fails its waiters like
+            # any other error, and nothing is cached
+            if not isinstance(error, Exception):
+                error = Exception(f"build of {key} interrupted")
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+                if call.error is None and self.ttl > 0:
+                    now = time.monotonic()
+                    for stale in [
+                        stale
+                        for stale, (expires, _) in self.results.items()
+                        if expires <= now
+                    ]:
+                        del self.results[stale]
+                    self.results[key] = (now + self.ttl, call.value)
+            call.done.set()
+        return call.value
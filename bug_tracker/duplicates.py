@@ -0,0 +1,142 @@
+import re
+import struct
+import zlib
+
+from django.db import transaction
+from django.db.models import F, Q
+
+from .models import Band, Bug, Signature
+
+# 64 one-permutation MinHash values in 16 bands of 4: two bugs whose word
+# pairs have a Jaccard similarity of 1/2 share a band with a probability of
+# about 2/3, at 1/4 only 6% do
+HASHES = 64
+BANDS = 16
+ROWS = HASHES // BANDS
+FORMAT = f"<{HASHES}I"
+
+# bugs estimated at least this similar are reported as likely duplicates
+SIMILARITY = 0.5
+
+WORD = re.compile(r"\w+")
+MULTIPLIER = 0x9E3779B97F4A7C15
+MASK = (1 << 64) - 1
+EMPTY = 1 << 32
+
+
+def shingles(title, description):
+    words = WORD.findall(f"{title} {description}".lower())
+    if len(words) < 2:
+        return set(words)
+    return {f"{first} {second}" for first, second in zip(words, words[1:])}
+
+
+def minhash(title, description):
+    """
+    MinHash of the word pairs of a bug, or None when it has no words. Each
+    word pair is hashed once, the top bits of the hash pick one of HASHES
+    bins and the bin keeps its smallest value; empty bins copy the next
+    filled one so short texts still compare.
+    """
+    bins = [EMPTY] * HASHES
+    for shingle in shingles(title, description):
+        value = (zlib.crc32(shingle.encode()) * MULTIPLIER + 1) & MASK
+        index, value = value >> 58, (value >> 26) & 0xFFFFFFFF
+        if value < bins[index]:
+            bins[index] = value
+    filled = [index for index, value in enumerate(bins) if value != EMPTY]
+    if not filled:
+        return None
+    for index in range(HASHES):
+        if bins[index] == EMPTY:
+            bins[index] = bins[next((i for i in filled if i > index), filled[0])]
+    return bins
+
+
+def bandKeys(bins):
+    # band number in the high bits, so equal rows in different bands differ
+    return [
+        (band << 32)
+        | zlib.crc32(struct.pack(f"<{ROWS}I", *bins[band * ROWS : (band + 1) * ROWS]))
+        for band in range(BANDS)
+    ]
+
+
+def similarity(bins, other):
+    return sum(a == b for a, b in zip(bins, other)) / HASHES
+
+
+def findDuplicates(project, bins, exclude=None, limit=5):
+    """
+    Bugs of project whose MinHash shares a band with bins and is estimated
+    at least SIMILARITY alike, as (bug, similarity) most similar first.
+    """
+    if bins is None:
+        return []
+    # the bands narrow a project down to a few candidates through their
+    # index, only those signatures are read and compared
+    candidates = set(
+        Band.objects.filter(project=project, key__in=bandKeys(bins)).values_list(
+            "bug_id", flat=True
+        )
+    )
+    candidates.discard(exclude)
+    if not candidates:
+        return []
+    signatures = Signature.objects.filter(bug_id__in=candidates).select_related("bug")
+    duplicates = []
+    for signature in signatures:
+        score = similarity(bins, struct.unpack(FORMAT, signature.minhash))
+        if score >= SIMILARITY:
+            duplicates.append((signature.bug, score))
+    duplicates.sort(key=lambda duplicate: -duplicate[1])
+    return duplicates[:limit]
+
+
+def indexBugs(bugs, database):
+    """
+    Replace the signatures and bands of bugs, a list from one project.
+    """
+    ids = [bug.id for bug in bugs]
+    signatures, bands = [], []
+    for bug in bugs:
+        bins = minhash(bug.title, bug.description)
+        if bins is None:
+            continue
+        signatures.append(
+            Signature(
+                bug=bug,
+                project_id=bug.project_id,
+                date_indexed=bug.date_modified,
+                minhash=struct.pack(FORMAT, *bins),
+            )
+        )
+        bands.extend(
+            Band(bug=bug, project_id=bug.project_id, key=key) for key in bandKeys(bins)
+        )
+    with transaction.atomic(using=database):
+        Band.objects.using(database).filter(bug_id__in=ids).delete()
+        Signature.objects.using(database).filter(bug_id__in=ids).delete()
+        Signature.objects.using(database).bulk_create(signatures)
+        Band.objects.using(database).bulk_create(bands)
+
+
+def indexProject(project, batch_size=500, everything=False):
+    """
+    Index the bugs of project changed since they were last indexed, or all
+    of them. Returns the number of bugs indexed.
+    """
+    database = project._state.db
+    bugs = Bug.objects.using(database).filter(project=project)
+    if not everything:
+        bugs = bugs.filter(
+            Q(signature__isnull=True)
+            | Q(signature__date_indexed__lt=F("date_modified"))
+        )
+    bugs = bugs.only("id", "project_id", "title", "description", "date_modified")
+    indexed = last = 0
+    while batch := list(bugs.filter(id__gt=last).order_by("id")[:batch_size]):
+        last = batch[-1].id
+        indexBugs(batch, database)
+        indexed += len(batch)
+    return indexed
@@ -0,0 +1,145 @@
+from itertools import islice
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import Assignment, Attachment, Bug, Mark, Tag, User
+from .serializers import (
+    countMemberships,
+    getAttachmentShell,
+    getProjectFields,
+    getTagShell,
+    getUser,
+)
+
+CHUNK_SIZE = 500
+BUFFER_SIZE = 64 * 1024
+
+encoder = DjangoJSONEncoder(separators=(",", ":"))
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def buffered(pieces, size=BUFFER_SIZE):
+    buffer, length = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield "".join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def exportUsers(project):
+    # collected on the project's shard and loaded from default in batches
+    ids = set()
+    for queryset, field in [
+        (project.memberships.all(), "user_id"),
+        (Bug.objects.filter(project=project), "reporter_id"),
+        (Tag.objects.filter(project=project), "creator_id"),
+        (Mark.objects.filter(bug__project=project), "creator_id"),
+        (Attachment.objects.filter(bug__project=project), "creator_id"),
+    ]:
+        ids.update(queryset.values_list(field, flat=True).distinct())
+    for batch in batched(sorted(ids), CHUNK_SIZE):
+        for user in countMemberships(User.objects.filter(id__in=batch).order_by("id")):
+            yield getUser(user)
+
+
+def exportMembers(project):
+    for membership in project.memberships.order_by("id").iterator(
+        chunk_size=CHUNK_SIZE
+    ):
+        yield {
+            "id": membership.user_id,
+            "authorization": membership.get_authorization_display(),
+            "createdAt": membership.date_created,
+        }
+
+
+def exportTags(project):
+    for tag in project.tags.order_by("id").iterator(chunk_size=CHUNK_SIZE):
+        yield getTagShell(tag)
+
+
+def exportBugs(project):
+    bugs = project.bugs.order_by("id").iterator(chunk_size=CHUNK_SIZE)
+    for batch in batched(bugs, CHUNK_SIZE):
+        ids = [bug.id for bug in batch]
+        marks, assignees, attachments = {}, {}, {}
+        for bug_id, tag_id in Mark.objects.filter(bug_id__in=ids).values_list(
+            "bug_id", "tag_id"
+        ):
+            marks.setdefault(bug_id, []).append(tag_id)
+        for bug_id, user_id in Assignment.objects.filter(bug_id__in=ids).values_list(
+            "bug_id", "membership__user_id"
+        ):
+            assignees.setdefault(bug_id, []).append(user_id)
+        for attachment in Attachment.objects.filter(bug_id__in=ids).order_by("id"):
+            attachments.setdefault(attachment.bug_id, []).append(
+                getAttachmentShell(attachment, project.project_id)
+            )
+
+        for bug in batch:
+            yield {
+                "id": bug.id,
+                "index": bug.index,
+                "title": bug.title,
+                "description": bug.description,
+                "reporter": bug.reporter_id,
+                "createdAt": bug.date_created,
+                "updatedAt": bug.date_modified,
+                "reproducible": bug.reproducible,
+                "impact": bug.impact,
+                "urgency": bug.urgency,
+                "priority": bug.priority,
+                "status": bug.get_status_display(),
+                "version": bug.version,
+                "tags": marks.get(bug.id, []),
+                "attachments": attachments.get(bug.id, []),
+                "assignees": assignees.get(bug.id, []),
+            }
+
+
+def exportSections(project):
+    return [
+        ("users", "user", exportUsers(project)),
+        ("members", "member", exportMembers(project)),
+        ("tags", "tag", exportTags(project)),
+        ("bugs", "bug", exportBugs(project)),
+    ]
+
+
+def streamJson(project):
+    def pieces():
+        yield '{"project":' + encoder.encode(
+            {**getProjectFields(project), "creator": project.creator_id}
+        )
+        for name, _, rows in exportSections(project):
+            yield f',"{name}":['
+            for index, row in enumerate(rows):
+                yield ("," if index else "") + encoder.encode(row)
+            yield "]"
+        yield "}"
+
+    return buffered(pieces())
+
+
+def streamNdjson(project):
+    def pieces():
+        yield encoder.encode(
+            {
+                "type": "project",
+                "data": {**getProjectFields(project), "creator": project.creator_id},
+            }
+        ) + "\n"
+        for _, kind, rows in exportSections(project):
+            for row in rows:
+                yield encoder.encode({"type": kind, "data": row}) + "\n"
+
+    return buffered(pieces())
@@ -0,0 +1,58 @@
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+class FragmentCache:
+    """
+    Least recently used cache of serialized model fragments.
+
+    Entries are stored per (kind, id) together with the version they were
+    built from (usually date_modified), so a lookup with a newer version
+    misses and the stale entry is replaced. The total size of the cached
+    fragments, measured as encoded JSON, is kept under max_bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, kind, id, version):
+        with self.lock:
+            entry = self.entries.get((kind, id))
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((kind, id))
+            self.hits += 1
+            return entry[1]
+
+    def set(self, kind, id, version, fragment):
+        size = len(json.dumps(fragment, cls=DjangoJSONEncoder))
+        if size > self.max_bytes:
+            return fragment
+        with self.lock:
+            previous = self.entries.pop((kind, id), None)
+            if previous is not None:
+                self.size -= previous[2]
+            self.entries[(kind, id)] = (version, fragment, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, _, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+        return fragment
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+fragments = FragmentCache(max_bytes=settings.FRAGMENT_CACHE_BYTES)
@@ -0,0 +1,84 @@
+import string
+import threading
+
+from django.db import IntegrityError, router, transaction
+
+from .models import Sequence
+
+PROJECT_ALPHABET = string.ascii_uppercase + string.digits
+USER_ALPHABET = string.ascii_lowercase + string.digits
+
+# odd and not a multiple of 3, so it is coprime with every 36 ** length and
+# multiplying by it permutes the id space
+MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+def encode(number, length, alphabet):
+    """
+    Map number to a fixed-length id. Distinct numbers below
+    len(alphabet) ** length - 1 give distinct ids, and consecutive numbers give
+    ids that look unrelated.
+    """
+    base = len(alphabet)
+    value = (number + 1) * MULTIPLIER % base**length
+    characters = []
+    for _ in range(length):
+        value, digit = divmod(value, base)
+        characters.append(alphabet[digit])
+    return "".join(characters)
+
+
+class Allocator:
+    """
+    Hand out unique public ids without querying for collisions. Numbers are
+    reserved from the database in blocks, one short transaction per block,
+    so every process draws from its own disjoint range and encodes them.
+    """
+
+    def __init__(self, name, length, alphabet, block=100):
+        self.name = name
+        self.length = length
+        self.alphabet = alphabet
+        self.block = block
+        self.current = self.end = 0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        with transaction.atomic():
+            sequence, _ = Sequence.objects.select_for_update().get_or_create(
+                name=self.name
+            )
+            start = sequence.value
+            sequence.value += self.block
+            sequence.save(update_fields=["value"])
+        self.current, self.end = start, start + self.block
+
+    def next(self):
+        with self.lock:
+            if self.current >= self.end:
+                self.reserve()
+            number = self.current
+            self.current += 1
+        return encode(number, self.length, self.alphabet)
+
+
+project_ids = Allocator("project", 10, PROJECT_ALPHABET)
+user_ids = Allocator("user", 6, USER_ALPHABET)
+
+
+def saveWithId(instance, field, allocator, attempts=3):
+    """
+    Save a new instance under the next id of allocator. Ids created before
+    the allocator existed were random and may be taken already, the unique
+    constraint rejects those and the next id is tried.
+    """
+    for attempt in range(attempts):
+        setattr(instance, field, allocator.next())
+        try:
+            database = router.db_for_write(type(instance), instance=instance)
+            with transaction.atomic(using=database):
+                instance.save()
+            return instance
+        except IntegrityError:
+            if attempt == attempts - 1:
+                raise
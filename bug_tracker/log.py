@@ -0,0 +1,115 @@
+import atexit
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+
+logger = logging.getLogger("bug_tracker")
+
+# request id, user and endpoint of the request being handled, set by the
+# RequestLog middleware and attached to every record logged meanwhile
+context = ContextVar("log_context", default={})
+
+
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        for key, value in context.get().items():
+            setattr(record, key, value)
+        return True
+
+
+class SampleFilter(logging.Filter):
+    """
+    Keep the first burst records of each error class in every window of
+    seconds, then only one in every.
+    """
+
+    def __init__(self, burst=10, every=100, window=60):
+        super().__init__()
+        self.burst = burst
+        self.every = every
+        self.window = window
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        error_class = getattr(record, "errorClass", None)
+        if error_class is None:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            start, count = self.counts.get(error_class, (now, 0))
+            if now - start > self.window:
+                start, count = now, 0
+            count += 1
+            self.counts[error_class] = (start, count)
+        if count <= self.burst:
+            return True
+        if (count - self.burst) % self.every == 0:
+            record.sampled = self.every
+            return True
+        return False
+
+
+class TracebackQueueHandler(QueueHandler):
+    """
+    QueueHandler.prepare drops exc_info before enqueueing, format the
+    traceback into the record first so the listener can still write it.
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exception = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return super().prepare(record)
+
+
+class JsonFormatter(logging.Formatter):
+    FIELDS = ["requestId", "user", "endpoint", "method", "status", "duration"]
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key in self.FIELDS + ["errorClass", "sampled", "exception"]:
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        return json.dumps(entry, default=str)
+
+
+def startLogging(level=logging.INFO):
+    """
+    Records are put on an in-memory queue by the request and written to
+    stdout by a listener thread, so logging never waits on the stream.
+    """
+    records = queue.SimpleQueue()
+    handler = TracebackQueueHandler(records)
+    handler.addFilter(ContextFilter())
+    handler.addFilter(SampleFilter())
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter())
+    listener = QueueListener(records, stream, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger.handlers = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
+    return listener
+
+
+def bind(**fields):
+    context.set({**context.get(), **fields})
+
+
+def logError(error):
+    logger.error(str(error), extra={"errorClass": type(error).__qualname__})
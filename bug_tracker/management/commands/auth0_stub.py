@@ -0,0 +1,113 @@
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from bug_tracker.models import User
+
+KID = "bench"
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve a local stand-in for the Auth0 JWKS, token and userinfo endpoints. "
+        "Point the server at it with AUTH0_ISSUER=http://<host>:<port>/."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--lifetime", type=int, default=24 * 60 * 60)
+
+    def handle(self, *args, **options):
+        issuer = f"http://{options['host']}:{options['port']}/"
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key()))
+        jwks = {"keys": [{**jwk, "kid": KID, "use": "sig", "alg": "RS256"}]}
+        lifetime = options["lifetime"]
+
+        def issue(sub):
+            now = int(time.time())
+            payload = {
+                "iss": issuer,
+                "sub": sub,
+                "aud": [settings.ORIGIN, f"{issuer}userinfo"],
+                "iat": now,
+                "exp": now + lifetime,
+            }
+            return jwt.encode(
+                payload, private_key, algorithm="RS256", headers={"kid": KID}
+            )
+
+        def profile(sub):
+            user = User.objects.filter(auth_id=sub).first()
+            if user:
+                return {
+                    "sub": sub,
+                    "email": user.email,
+                    "email_verified": user.email_verified,
+                    "family_name": user.last_name,
+                    "given_name": user.first_name,
+                    "locale": user.locale,
+                    "picture": user.picture,
+                }
+            name = sub.replace("|", "-")
+            return {
+                "sub": sub,
+                "email": f"{name}@example.com",
+                "email_verified": True,
+                "family_name": "Bench",
+                "given_name": name,
+                "locale": "en",
+                "picture": f"https://example.com/avatars/{name}.png",
+            }
+
+        class Handler(BaseHTTPRequestHandler):
+            def send(self, status, body):
+                content = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/.well-known/jwks.json":
+                    return self.send(200, jwks)
+                if url.path == "/token":
+                    sub = parse_qs(url.query).get("sub", ["bench|0"])[0]
+                    return self.send(200, {"access_token": issue(sub)})
+                if url.path == "/userinfo":
+                    try:
+                        token = self.headers["Authorization"].split()[1]
+                        claims = jwt.decode(
+                            token,
+                            private_key.public_key(),
+                            algorithms=["RS256"],
+                            options={"verify_aud": False},
+                        )
+                    except Exception as error:
+                        return self.send(
+                            401,
+                            {"error": "invalid_token", "error_description": str(error)},
+                        )
+                    return self.send(200, profile(claims["sub"]))
+                return self.send(404, {"error": "not_found"})
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((options["host"], options["port"]), Handler)
+        self.stdout.write(f"serving Auth0 stub at {issuer}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
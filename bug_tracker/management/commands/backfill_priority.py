@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from bug_tracker.models import Bug
+from bug_tracker.purge import BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = (
+        "Set the stored priority of every bug to impact * urgency, for bugs "
+        "created before priority was stored."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        for database in settings.DATABASE_SHARDS:
+            bugs = Bug.objects.using(database).order_by("id")
+            updated = last = 0
+            # bounded ranges of ids, so no update locks the whole table
+            while ids := list(
+                bugs.filter(id__gt=last).values_list("id", flat=True)[
+                    : options["batch_size"]
+                ]
+            ):
+                last = ids[-1]
+                updated += (
+                    bugs.filter(id__gte=ids[0], id__lte=last)
+                    .exclude(priority=F("impact") * F("urgency"))
+                    .update(priority=F("impact") * F("urgency"))
+                )
+            self.stdout.write(f"{database}: {updated} bugs updated")
@@ -0,0 +1,249 @@
+import json
+import random
+import statistics
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from bug_tracker.models import Attachment, Membership, User
+from bug_tracker.routers import fanout
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(fraction * len(values)) - 1))
+    return values[index]
+
+
+class Client:
+    def __init__(self, base_url, auth_url, membership):
+        self.base_url = base_url.rstrip("/")
+        self.user = membership.user
+        self.project_id = membership.project.project_id
+        self.attachments = list(
+            Attachment.objects.filter(bug__project=membership.project).values_list(
+                "id", "bug_id"
+            )[:50]
+        )
+        self.session = requests.Session()
+        token = requests.get(
+            f"{auth_url.rstrip('/')}/token", params={"sub": self.user.auth_id}
+        ).json()["access_token"]
+        response = self.session.get(
+            f"{self.base_url}/me", headers={"Authorization": f"Bearer {token}"}
+        )
+        response.raise_for_status()
+
+    def get(self, path, **params):
+        return self.session.get(
+            f"{self.base_url}/{path}", params=params, allow_redirects=False
+        )
+
+    def post(self, path, body=None, **params):
+        return self.session.post(
+            f"{self.base_url}/{path}",
+            params=params,
+            json=body or {},
+            allow_redirects=False,
+        )
+
+
+def project_get(client, rng):
+    return client.get("project-get", projectId=client.project_id)
+
+
+def projects_my(client, rng):
+    return client.get("projects-my")
+
+
+def profiles_search(client, rng):
+    return client.get("profiles-search", text=rng.choice(["Ada", "Turing", "Gr"]))
+
+
+def bug_report(client, rng):
+    return client.post(
+        "bug-report",
+        {"title": f"benchmark {rng.random():.6f}", "description": "benchmark"},
+        projectId=client.project_id,
+    )
+
+
+def attachment_get(client, rng):
+    attachment_id, bug_id = rng.choice(client.attachments)
+    return client.get(
+        "attachment-get",
+        projectId=client.project_id,
+        bugId=bug_id,
+        attachmentId=attachment_id,
+    )
+
+
+SCENARIOS = {
+    "project-get": project_get,
+    "projects-my": projects_my,
+    "profiles-search": profiles_search,
+    "bug-report": bug_report,
+    "attachment-get": attachment_get,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Run repeatable latency and throughput benchmarks against a running server "
+        "(gunicorn -k gevent) authenticated through the auth0_stub command."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+        parser.add_argument("--auth-url", default=settings.AUTH0_ISSUER)
+        parser.add_argument(
+            "--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS)
+        )
+        parser.add_argument("--clients", type=int, default=20)
+        parser.add_argument("--concurrency", type=int, default=20)
+        parser.add_argument("--requests", type=int, default=500, help="per scenario")
+        parser.add_argument("--warmup", type=int, default=20, help="per scenario")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--prefix", default="bench")
+        parser.add_argument("--output", default=settings.BASE_DIR / "benchmarks")
+        parser.add_argument("--label", default="")
+        parser.add_argument("--compare", help="previous result file to compare with")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+
+        users = list(
+            User.objects.filter(
+                auth_id__startswith=f"{options['prefix']}|"
+            ).values_list("id", flat=True)
+        )
+        memberships = [
+            membership
+            for memberships in fanout(
+                lambda alias: list(
+                    Membership.objects.filter(user_id__in=users)
+                    # spectators may not report bugs
+                    .exclude(authorization="SPE")
+                    .select_related("project")
+                    .order_by("id")
+                )
+            )
+            for membership in memberships
+        ]
+        if not memberships:
+            raise CommandError("no benchmark data, run generate_dataset first")
+        # one client per user so each one keeps its own session cookie
+        by_user = {}
+        for membership in memberships:
+            by_user.setdefault(membership.user_id, membership)
+        chosen = rng.sample(
+            list(by_user.values()), min(options["clients"], len(by_user))
+        )
+        clients = [
+            Client(options["base_url"], options["auth_url"], membership)
+            for membership in chosen
+        ]
+
+        results = {}
+        for name in options["scenarios"]:
+            scenario = SCENARIOS[name]
+            candidates = clients
+            if name == "attachment-get":
+                candidates = [client for client in clients if client.attachments]
+                if not candidates:
+                    self.stderr.write(f"{name}: skipped, no attachments")
+                    continue
+            results[name] = self.run(scenario, candidates, rng, options)
+            self.report(name, results[name])
+
+        document = {
+            "label": options["label"],
+            "date": datetime.now(timezone.utc).isoformat(),
+            "commit": self.commit(),
+            "baseUrl": options["base_url"],
+            "clients": len(clients),
+            "concurrency": options["concurrency"],
+            "requests": options["requests"],
+            "results": results,
+        }
+        output = settings.BASE_DIR / options["output"]
+        output.mkdir(parents=True, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        name = f"{stamp}-{options['label']}" if options["label"] else stamp
+        path = output / f"{name}.json"
+        path.write_text(json.dumps(document, indent=2))
+        self.stdout.write(f"saved {path}")
+
+        if options["compare"]:
+            self.compare(json.loads(open(options["compare"]).read()), document)
+
+    def run(self, scenario, clients, rng, options):
+        for _ in range(options["warmup"]):
+            scenario(rng.choice(clients), rng)
+
+        seeds = [rng.random() for _ in range(options["requests"])]
+
+        def call(seed):
+            local = random.Random(seed)
+            client = local.choice(clients)
+            start = time.perf_counter()
+            try:
+                status = scenario(client, local).status_code
+            except requests.RequestException:
+                status = 0
+            return time.perf_counter() - start, status
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as executor:
+            samples = list(executor.map(call, seeds))
+        elapsed = time.perf_counter() - start
+
+        latencies = [duration * 1000 for duration, status in samples]
+        errors = sum(1 for duration, status in samples if not 200 <= status < 400)
+        return {
+            "count": len(samples),
+            "errors": errors,
+            "rps": len(samples) / elapsed,
+            "mean": statistics.mean(latencies),
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+        }
+
+    def report(self, name, result):
+        self.stdout.write(
+            f"{name:16} {result['rps']:8.1f} req/s  "
+            f"p50 {result['p50']:7.1f} ms  p95 {result['p95']:7.1f} ms  "
+            f"p99 {result['p99']:7.1f} ms  errors {result['errors']}"
+        )
+
+    def compare(self, before, after):
+        self.stdout.write(f"compared with {before['date']} ({before.get('commit')})")
+        for name, result in after["results"].items():
+            previous = before["results"].get(name)
+            if not previous:
+                continue
+            changes = "  ".join(
+                f"{key} {(result[key] - previous[key]) / previous[key] * 100:+6.1f}%"
+                for key in ["rps", "p50", "p95", "p99"]
+                if previous[key]
+            )
+            self.stdout.write(f"{name:16} {changes}")
+
+    def commit(self):
+        try:
+            return subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"],
+                capture_output=True,
+                text=True,
+                cwd=settings.BASE_DIR,
+            ).stdout.strip()
+        except OSError:
+            return None
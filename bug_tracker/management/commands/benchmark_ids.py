@@ -0,0 +1,63 @@
+import random
+import string
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from bug_tracker.ids import PROJECT_ALPHABET, Allocator, saveWithId
+from bug_tracker.models import Project, User
+
+
+class Rollback(Exception):
+    pass
+
+
+def probe(project):
+    project_id = None
+    while not project_id or Project.objects.filter(project_id=project_id).exists():
+        project_id = "".join(
+            random.choice(string.ascii_uppercase + string.digits) for _ in range(10)
+        )
+    project.project_id = project_id
+    project.save()
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare project creations per second of the old probe-then-insert id "
+        "loop with the block allocator. Everything is rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=2000)
+        parser.add_argument("--block", type=int, default=100)
+
+    def run(self, count, create):
+        creator = User.objects.create(user_id="bench0", email="ids@example.com")
+        start = time.perf_counter()
+        for number in range(count):
+            create(Project(creator=creator, title=f"Project {number}"))
+        return time.perf_counter() - start
+
+    def measure(self, name, count, create):
+        try:
+            with transaction.atomic():
+                seconds = self.run(count, create)
+                raise Rollback
+        except Rollback:
+            pass
+        self.stdout.write(
+            f"{name:<10} {count / seconds:10.1f} creations/s  "
+            f"({seconds * 1000 / count:.3f} ms each)"
+        )
+
+    def handle(self, *args, **options):
+        count = options["count"]
+        allocator = Allocator("benchmark", 10, PROJECT_ALPHABET, options["block"])
+        self.measure("probe", count, probe)
+        self.measure(
+            "allocator",
+            count,
+            lambda project: saveWithId(project, "project_id", allocator),
+        )
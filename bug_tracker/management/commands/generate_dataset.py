@@ -0,0 +1,177 @@
+import random
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from bug_tracker.duplicates import indexProject
+from bug_tracker.ids import project_ids, saveWithId
+from bug_tracker.models import (
+    Assignment,
+    Attachment,
+    Bug,
+    Mark,
+    Membership,
+    Project,
+    ProjectShard,
+    Tag,
+    User,
+)
+from bug_tracker.routers import using
+
+FIRST_NAMES = ["Ada", "Alan", "Grace", "Linus", "Barbara", "Ken", "Margaret", "Dennis"]
+LAST_NAMES = ["Lovelace", "Turing", "Hopper", "Torvalds", "Liskov", "Thompson"]
+WORDS = (
+    "crash login button page error slow upload timeout layout mobile cache "
+    "token session search filter export import dialog scroll font menu"
+).split()
+COLORS = ["#d73a4a", "#0075ca", "#a2eeef", "#7057ff", "#008672", "#e4e669"]
+AUTHORIZATIONS = ["DIR", "CON", "CON", "CON", "SPE"]
+
+
+def sentence(rng, length):
+    return " ".join(rng.choice(WORDS) for _ in range(length)).capitalize()
+
+
+class Command(BaseCommand):
+    help = "Generate a synthetic dataset for load testing and benchmarks."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=200)
+        parser.add_argument("--projects", type=int, default=20)
+        parser.add_argument("--members", type=int, default=15, help="per project")
+        parser.add_argument("--bugs", type=int, default=300, help="per project")
+        parser.add_argument("--tags", type=int, default=12, help="per project")
+        parser.add_argument("--marks", type=int, default=2, help="per bug")
+        parser.add_argument("--assignees", type=int, default=1, help="per bug")
+        parser.add_argument(
+            "--attachments", type=float, default=0.2, help="per bug, on average"
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--prefix", default="bench")
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        prefix = options["prefix"]
+
+        User.objects.bulk_create(
+            [
+                User(
+                    user_id=f"{prefix[:1]}{index:05d}",
+                    auth_id=f"{prefix}|{index}",
+                    email=f"{prefix}{index}@example.com",
+                    email_verified=True,
+                    first_name=rng.choice(FIRST_NAMES),
+                    last_name=rng.choice(LAST_NAMES),
+                    picture=f"https://example.com/avatars/{index}.png",
+                )
+                for index in range(options["users"])
+            ]
+        )
+        users = list(User.objects.filter(auth_id__startswith=f"{prefix}|"))
+
+        for number in range(options["projects"]):
+            # projects are dealt out over the shards in turn
+            database = settings.DATABASE_SHARDS[number % len(settings.DATABASE_SHARDS)]
+            with using(database), transaction.atomic(using=database):
+                project = self.createProject(rng, users, number, options)
+            ProjectShard.objects.create(
+                project_id=project.project_id, database=database
+            )
+
+        self.stdout.write(self.style.SUCCESS(f"created {len(users)} users"))
+
+    def createProject(self, rng, users, number, options):
+        members = rng.sample(users, min(options["members"], len(users)))
+        creator = members[0]
+        project = Project(
+            title=f"{sentence(rng, 2)} {number}",
+            description=sentence(rng, 12),
+            creator=creator,
+            bug_index=options["bugs"],
+        )
+        # ids are allocated like project-create does, so datasets generated
+        # with the same seed do not collide
+        saveWithId(project, "project_id", project_ids)
+
+        Membership.objects.bulk_create(
+            [Membership(user=creator, project=project, authorization="ADM")]
+            + [
+                Membership(
+                    user=user,
+                    project=project,
+                    authorization=rng.choice(AUTHORIZATIONS),
+                )
+                for user in members[1:]
+            ]
+        )
+        memberships = list(project.memberships.all())
+
+        Tag.objects.bulk_create(
+            [
+                Tag(
+                    title=rng.choice(WORDS),
+                    creator=rng.choice(members),
+                    project=project,
+                    text_color="#ffffff",
+                    background_color=rng.choice(COLORS),
+                    border_color=rng.choice(COLORS),
+                )
+                for _ in range(options["tags"])
+            ],
+            # the same title and colors may be drawn twice
+            ignore_conflicts=True,
+        )
+        tags = list(project.tags.all())
+
+        bugs = []
+        for index in range(options["bugs"]):
+            impact, urgency = rng.randint(1, 5), rng.randint(1, 5)
+            bugs.append(
+                Bug(
+                    index=index + 1,
+                    title=sentence(rng, rng.randint(3, 8)),
+                    description=sentence(rng, rng.randint(10, 120))[:1000],
+                    reporter=rng.choice(members),
+                    project=project,
+                    reproducible=rng.random() < 0.8,
+                    impact=impact,
+                    urgency=urgency,
+                    priority=Bug.score(impact, urgency),
+                )
+            )
+        Bug.objects.bulk_create(bugs)
+        bugs = list(project.bugs.all())
+
+        marks, assignments, attachments = [], [], []
+        for bug in bugs:
+            for tag in rng.sample(tags, min(options["marks"], len(tags))):
+                marks.append(Mark(creator_id=bug.reporter_id, bug=bug, tag=tag))
+            for membership in rng.sample(
+                memberships, min(options["assignees"], len(memberships))
+            ):
+                assignments.append(Assignment(membership=membership, bug=bug))
+            if rng.random() < options["attachments"]:
+                content = sentence(rng, rng.randint(50, 500)).encode()
+                attachment = Attachment(
+                    title=f"log-{bug.index}.txt",
+                    bug=bug,
+                    creator_id=bug.reporter_id,
+                    content_type="text/plain",
+                    size=len(content),
+                )
+                attachment.file.save(attachment.title, ContentFile(content), save=False)
+                attachments.append(attachment)
+
+        Mark.objects.bulk_create(marks)
+        Assignment.objects.bulk_create(assignments)
+        Attachment.objects.bulk_create(attachments)
+        indexProject(project)
+
+        self.stdout.write(
+            f"{project.project_id}: {len(bugs)} bugs, {len(marks)} marks, "
+            f"{len(assignments)} assignments, {len(attachments)} attachments"
+        )
+        return project
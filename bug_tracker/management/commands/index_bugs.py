@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from bug_tracker.duplicates import indexProject
+from bug_tracker.models import Project
+from bug_tracker.purge import BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = (
+        "Index bugs for duplicate detection, those changed since they were last "
+        "indexed or with --all every bug."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("project_id", nargs="*")
+        parser.add_argument("--all", action="store_true")
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        for database in settings.DATABASE_SHARDS:
+            projects = Project.objects.using(database).filter(date_deleted__isnull=True)
+            if options["project_id"]:
+                projects = projects.filter(project_id__in=options["project_id"])
+            for project in projects.order_by("id"):
+                indexed = indexProject(
+                    project, options["batch_size"], everything=options["all"]
+                )
+                if indexed:
+                    self.stdout.write(f"{project.project_id}: {indexed} bugs indexed")
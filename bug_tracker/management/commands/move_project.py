@@ -0,0 +1,169 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+
+from bug_tracker.models import (
+    Assignment,
+    Attachment,
+    Band,
+    Bug,
+    Mark,
+    Membership,
+    Notification,
+    Project,
+    ProjectShard,
+    Signature,
+    Tag,
+)
+from bug_tracker.purge import BATCH_SIZE, purgeProject
+
+
+def copy(queryset, target, remap, batch_size):
+    """
+    Insert the rows of queryset into target with new primary keys, pointing
+    their foreign keys at the copies through remap, {field: {old: new}}.
+    Returns {old primary key: new primary key}.
+    """
+    pks = {}
+    rows = queryset.order_by("pk")
+    last = 0
+    while batch := list(rows.filter(pk__gt=last)[:batch_size]):
+        last = batch[-1].pk
+        old = [row.pk for row in batch]
+        for row in batch:
+            row.pk = None
+            row._state.adding = True
+            for field, mapping in remap.items():
+                setattr(row, field, mapping[getattr(row, field)])
+        queryset.model.objects.using(target).bulk_create(batch)
+        pks.update(zip(old, [row.pk for row in batch]))
+    return pks
+
+
+def remapNotifications(project_id, bugs):
+    """
+    Point the project's pending notifications at the copies of their bugs,
+    digests look the bugs up by primary key.
+    """
+    pending = {}
+    for id, bug_id in (
+        Notification.objects.select_for_update()
+        .filter(project_id=project_id, date_sent__isnull=True)
+        .values_list("id", "bug_id")
+    ):
+        pending.setdefault(bug_id, []).append(id)
+    for bug_id, ids in pending.items():
+        if bug_id in bugs:
+            Notification.objects.filter(id__in=ids).update(bug_id=bugs[bug_id])
+
+
+class Command(BaseCommand):
+    help = (
+        "Move a project and everything in it to another shard. Edits of the "
+        "project are refused while it is copied, its pending notifications "
+        "follow it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("project_id")
+        parser.add_argument("database", choices=settings.DATABASE_SHARDS)
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+        parser.add_argument(
+            "--wait",
+            type=float,
+            default=settings.SHARD_MAP_SECONDS,
+            help="seconds for every process to see a change of the shard map",
+        )
+
+    def handle(self, *args, **options):
+        project_id, target = options["project_id"], options["database"]
+        entry, _ = ProjectShard.objects.get_or_create(
+            project_id=project_id, defaults={"database": "default"}
+        )
+        source = entry.database
+        if source == target:
+            raise CommandError(f"{project_id} is already on {target}")
+        project = Project.objects.using(source).get(project_id=project_id)
+
+        entry.frozen = True
+        entry.save(update_fields=["frozen"])
+        time.sleep(options["wait"])
+
+        try:
+            with transaction.atomic(using=target):
+                bugs = self.copyProject(project, target, options["batch_size"])
+        except Exception:
+            entry.frozen = False
+            entry.save(update_fields=["frozen"])
+            raise
+
+        # the map and the notifications are both on default, expanding
+        # notifications never sees one flipped without the other
+        with transaction.atomic(using="default"):
+            remapNotifications(project_id, bugs)
+            entry.database = target
+            entry.frozen = False
+            entry.save(update_fields=["database", "frozen"])
+        self.stdout.write(f"{project_id} moved from {source} to {target}")
+
+        # processes that still map the project to the source read from it
+        # until their map expires, only then is the old copy removed
+        time.sleep(options["wait"])
+        purgeProject(project, options["batch_size"], files=False)
+        self.stdout.write(f"{project_id} removed from {source}")
+
+    def copyProject(self, project, target, batch_size):
+        source = project._state.db
+        old = Project.objects.using(source).filter(pk=project.pk)
+        projects = copy(old, target, {}, batch_size)
+        # ids of everything in the project change, cached builds must go
+        Project.objects.using(target).filter(pk=projects[project.pk]).update(
+            revision=F("revision") + 1
+        )
+        memberships = copy(
+            Membership.objects.using(source).filter(project=project),
+            target,
+            {"project_id": projects},
+            batch_size,
+        )
+        tags = copy(
+            Tag.objects.using(source).filter(project=project),
+            target,
+            {"project_id": projects},
+            batch_size,
+        )
+        bugs = copy(
+            Bug.objects.using(source).filter(project=project),
+            target,
+            {"project_id": projects},
+            batch_size,
+        )
+        copy(
+            Mark.objects.using(source).filter(bug__project=project),
+            target,
+            {"bug_id": bugs, "tag_id": tags},
+            batch_size,
+        )
+        copy(
+            Assignment.objects.using(source).filter(bug__project=project),
+            target,
+            {"bug_id": bugs, "membership_id": memberships},
+            batch_size,
+        )
+        copy(
+            Attachment.objects.using(source).filter(bug__project=project),
+            target,
+            {"bug_id": bugs},
+            batch_size,
+        )
+        for model in [Signature, Band]:
+            copy(
+                model.objects.using(source).filter(project=project),
+                target,
+                {"project_id": projects, "bug_id": bugs},
+                batch_size,
+            )
+        return bugs
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from bug_tracker.purge import BATCH_SIZE, purgeDeletedProjects
+
+
+class Command(BaseCommand):
+    help = "Remove deleted projects and everything in them in bounded batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+        parser.add_argument(
+            "--loop", action="store_true", help="keep running as a worker"
+        )
+        parser.add_argument("--interval", type=float, default=30)
+
+    def handle(self, *args, **options):
+        while True:
+            for project in purgeDeletedProjects(options["batch_size"]):
+                self.stdout.write(f"purged {project.project_id}")
+            if not options["loop"]:
+                return
+            time.sleep(options["interval"])
@@ -0,0 +1,90 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Min
+
+from bug_tracker.models import Assignment, Mark, Membership, Tag
+from bug_tracker.routers import using
+
+# rows that the unique constraints allow only once, oldest one is kept.
+# Memberships and tags go first, moving their marks and assignments to the
+# kept row can duplicate those.
+UNIQUE_FIELDS = [
+    (Membership, ["user", "project"]),
+    (
+        Tag,
+        ["project", "title", "text_color", "background_color", "border_color"],
+    ),
+    (Mark, ["bug", "tag"]),
+    (Assignment, ["bug", "membership"]),
+]
+
+# rows pointing at a duplicate through field, unique together with other
+REFERENCES = {
+    Membership: [(Assignment, "membership_id", "bug_id")],
+    Tag: [(Mark, "tag_id", "bug_id")],
+}
+
+
+def repoint(model, keep, duplicates):
+    """
+    Point the rows referring to duplicates at keep instead, dropping those
+    that keep already has. Returns the number of rows dropped.
+    """
+    dropped = 0
+    for reference, field, other in REFERENCES.get(model, []):
+        taken = set(
+            reference.objects.filter(**{field: keep}).values_list(other, flat=True)
+        )
+        move, drop = [], []
+        for id, value in (
+            reference.objects.filter(**{f"{field}__in": duplicates})
+            .order_by("id")
+            .values_list("id", other)
+        ):
+            if value in taken:
+                drop.append(id)
+            else:
+                taken.add(value)
+                move.append(id)
+        reference.objects.filter(id__in=move).update(**{field: keep})
+        dropped += reference.objects.filter(id__in=drop).delete()[0]
+    return dropped
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete duplicate memberships, marks, assignments and tags left by "
+        "racing inserts. Marks and assignments of a deleted tag or membership "
+        "move to the one kept. Run before migrating to the unique constraints."
+    )
+
+    def handle(self, *args, **options):
+        for database in settings.DATABASE_SHARDS:
+            with using(database):
+                self.removeDuplicates(database)
+
+    def removeDuplicates(self, database):
+        for model, fields in UNIQUE_FIELDS:
+            with transaction.atomic(using=database):
+                groups = (
+                    model.objects.values(*fields)
+                    .annotate(keep=Min("id"), count=Count("id"))
+                    .filter(count__gt=1)
+                    .order_by()
+                )
+                deleted = dropped = 0
+                for group in groups:
+                    duplicates = list(
+                        model.objects.filter(
+                            **{field: group[field] for field in fields}
+                        )
+                        .exclude(id=group["keep"])
+                        .values_list("id", flat=True)
+                    )
+                    dropped += repoint(model, group["keep"], duplicates)
+                    deleted += model.objects.filter(id__in=duplicates).delete()[0]
+            message = f"{database} {model.__name__}: {deleted} deleted"
+            if model in REFERENCES:
+                message += f", {dropped} references dropped"
+            self.stdout.write(message)
@@ -0,0 +1,55 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from bug_tracker.tasks import cleanUp, queueStats, runPending
+
+
+class Command(BaseCommand):
+    help = "Run queued background tasks."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--loop", action="store_true", help="keep running as a worker"
+        )
+        parser.add_argument("--threads", type=int, default=4)
+        parser.add_argument("--batch-size", type=int, default=10)
+        parser.add_argument("--interval", type=float, default=1)
+        parser.add_argument(
+            "--stats",
+            action="store_true",
+            help="print task counts and durations and exit",
+        )
+
+    def work(self, batch_size, interval, loop):
+        try:
+            while True:
+                if not runPending(batch_size):
+                    if not loop:
+                        return
+                    time.sleep(interval)
+        finally:
+            connections.close_all()
+
+    def handle(self, *args, **options):
+        if options["stats"]:
+            self.stdout.write(json.dumps(queueStats(), indent=2))
+            return
+
+        cleanUp()
+        with ThreadPoolExecutor(max_workers=options["threads"]) as executor:
+            futures = [
+                executor.submit(
+                    self.work,
+                    options["batch_size"],
+                    options["interval"],
+                    options["loop"],
+                )
+                for _ in range(options["threads"])
+            ]
+            for future in futures:
+                future.result()
+        self.stdout.write(json.dumps(queueStats(), indent=2))
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from bug_tracker.notifications import cleanUp, sendDigests
+
+
+class Command(BaseCommand):
+    help = "Send notification digests whose window has passed."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument(
+            "--loop", action="store_true", help="keep running as a worker"
+        )
+        parser.add_argument("--interval", type=float, default=60)
+
+    def handle(self, *args, **options):
+        cleanUp()
+        while True:
+            while sent := sendDigests(options["batch_size"]):
+                self.stdout.write(f"sent {sent} digests")
+            if not options["loop"]:
+                return
+            time.sleep(options["interval"])
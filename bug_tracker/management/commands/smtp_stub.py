@@ -0,0 +1,78 @@
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+
+from django.core.management.base import BaseCommand
+
+
+class Handler(StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        self.reply("220 smtp stub")
+        sender, recipients = None, []
+        while line := self.rfile.readline():
+            command = line.decode(errors="replace").strip()
+            verb = command[:4].upper()
+            if verb in ("EHLO", "HELO"):
+                self.reply("250 smtp stub")
+            elif verb == "MAIL":
+                sender, recipients = command[10:], []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                recipients.append(command[8:])
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 end data with <CR><LF>.<CR><LF>")
+                lines = []
+                while (data := self.rfile.readline()) not in (b".\r\n", b""):
+                    lines.append(data.decode(errors="replace").rstrip("\r\n"))
+                self.server.write(
+                    f"message from {sender} to {', '.join(recipients)}\n"
+                    + "\n".join(lines)
+                    + "\n"
+                )
+                self.reply("250 OK")
+            elif verb in ("RSET", "NOOP"):
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("502 command not implemented")
+
+
+class Server(ThreadingTCPServer):
+    """
+    SMTP server that accepts every message and passes it to write, as the
+    message's envelope followed by its lines.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, write):
+        super().__init__(address, Handler)
+        self.write = write
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve a local SMTP server that prints the messages it receives instead of "
+        "delivering them. Point the server at it with EMAIL_URL=smtp://<host>:<port>."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8025)
+
+    def handle(self, *args, **options):
+        server = Server((options["host"], options["port"]), self.stdout.write)
+        self.stdout.write(
+            f"serving SMTP stub at smtp://{options['host']}:{options['port']}"
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
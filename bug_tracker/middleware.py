@@ -1,16 +1,17 @@
 import json
-import random
-import string
-from pprint import pprint
+import time
+import uuid
 
 import jwt
-import requests
 from django.conf import settings
 from django.http import HttpResponseForbidden, HttpResponseServerError, JsonResponse
 
-from bug_tracker.views import printError
-
+from . import outbound
+from .ids import saveWithId, user_ids
+from .log import bind, context, logError, logger
 from .models import User
+from .routers import Routing, pickReplica, routing
+from .tasks import enqueue
 
 
 def public(request):
@@ -21,11 +22,62 @@ def public(request):
     )
 
 
-def generate_id(
-    length=10,
-    characters=string.ascii_uppercase + string.digits,
-):
-    return "".join(random.choice(characters) for _ in range(length))
+class RequestLog:
+    """
+    Give every request an id, returned in the X-Request-Id header, and log
+    its endpoint, user, status and duration once it is answered.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.id = request.headers.get("X-Request-Id") or uuid.uuid4().hex
+        token = context.set({"requestId": request.id, "endpoint": request.path})
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+            logger.info(
+                "request",
+                extra={
+                    "method": request.method,
+                    "status": response.status_code,
+                    "duration": round((time.perf_counter() - start) * 1000, 2),
+                },
+            )
+        finally:
+            context.reset(token)
+        response["X-Request-Id"] = request.id
+        return response
+
+
+class RouteReads:
+    """
+    Route the reads of GET requests to the replicas, unless the session wrote
+    to the primary in the last DATABASE_REPLICA_STICKY_SECONDS, so a client
+    always reads its own writes.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        sticky = request.session.get("primary_until", 0) > time.time()
+        replica = None
+        if request.method in ("GET", "HEAD") and not sticky:
+            replica = pickReplica()
+        state = Routing(replica=replica)
+        token = routing.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            routing.reset(token)
+
+        if state.wrote:
+            request.session["primary_until"] = (
+                time.time() + settings.DATABASE_REPLICA_STICKY_SECONDS
+            )
+        return response
 
 
 class Authenticate:
@@ -36,25 +88,26 @@ class Authenticate:
         if public(request) or request.session.get("user_id"):
             return self.get_response(request)
 
-        print("REQUESTING_AUTH0")
+        logger.info("requesting auth0")
 
-        DOMAIN = "dev-su34m38a.us.auth0.com"
-        ISSUER = f"https://{DOMAIN}/"
+        ISSUER = settings.AUTH0_ISSUER
         AUDIENCE = settings.ORIGIN
         ALGORITHM = "RS256"
-        JWKS_URL = f"{ISSUER}.well-known/jwks.json"
 
         try:
             authorization = request.headers.get("Authorization")
             request.token = authorization.split()[1]
         except Exception as error:
-            print("ERROR", error)
+            logError(error)
             return HttpResponseForbidden("token not found")
 
         try:
             header = jwt.get_unverified_header(request.token)
-            jwks = requests.get(JWKS_URL).json()
-            for jwk in jwks["keys"]:
+            keys = outbound.jwks(ISSUER)["keys"]
+            if not any(jwk["kid"] == header["kid"] for jwk in keys):
+                # the signing key was rotated since the keys were cached
+                keys = outbound.jwks(ISSUER, max_age=0)["keys"]
+            for jwk in keys:
                 if jwk["kid"] == header["kid"]:
                     public_key = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(jwk))
             request.payload = jwt.decode(
@@ -66,20 +119,21 @@ class Authenticate:
             )
             request.auth_id = request.payload["sub"]
         except Exception as error:
-            print("ERROR", error)
+            logError(error)
             return HttpResponseForbidden("token not valid")
 
         try:
-            request.user_info = requests.get(
-                request.payload["aud"][1],
-                headers={"Authorization": f"Bearer {request.token}"},
-            ).json()
+            request.user_info = outbound.userinfo(
+                request.payload["aud"][1], request.token
+            )
 
             if "error" in request.user_info:
-                print("ERROR", request.user_info)
+                logger.error(
+                    "auth0 userinfo: %s", request.user_info.get("error_description")
+                )
                 return HttpResponseServerError(request.user_info["error_description"])
         except Exception as error:
-            print("ERROR", error)
+            logError(error)
             return HttpResponseServerError("cannot get user info")
 
         request.authenticated = True
@@ -99,37 +153,41 @@ class UserFindCreate:
         if user_id:
             try:
                 request.user = User.objects.get(user_id=user_id)
+                bind(user=user_id)
             except Exception as error:
-                print("ERROR", error)
+                logError(error)
                 return HttpResponseForbidden("cannot find user from cookie")
             return self.get_response(request)
 
         try:
-            user, created = User.objects.update_or_create(
-                auth_id=request.auth_id,
-                defaults={
-                    "picture": request.user_info["picture"],
-                    "email": request.user_info["email"],
-                    # if "email" in request.user_info
-                    # else print("WARNING", "could not get email", request.user_info),
-                    "email_verified": request.user_info["email_verified"],
-                    "last_name": request.user_info["family_name"],
-                    "first_name": request.user_info["given_name"],
-                    "locale": request.user_info["locale"],
-                },
-            )
-            if created:
-                while User.objects.filter(user_id=user.user_id).exists():
-                    user.user_id = generate_id(
-                        length=6, characters=string.ascii_lowercase + string.digits
-                    )
-                user.save()
+            profile = {
+                "picture": request.user_info["picture"],
+                "email": request.user_info["email"],
+                # if "email" in request.user_info
+                # else print("WARNING", "could not get email", request.user_info),
+                "email_verified": request.user_info["email_verified"],
+                "last_name": request.user_info["family_name"],
+                "first_name": request.user_info["given_name"],
+                "locale": request.user_info["locale"],
+            }
+            user = User.objects.filter(auth_id=request.auth_id).first()
+            if user is None:
+                user = User(auth_id=request.auth_id, **profile)
+                saveWithId(user, "user_id", user_ids)
+            else:
+                # the stored profile is brought up to date in the background
+                enqueue(
+                    "refresh_profile",
+                    {"user": user.pk, "profile": profile},
+                    key=f"profile:{user.pk}",
+                )
 
             request.user = user
             request.session["user_id"] = request.user.user_id
+            bind(user=user.user_id)
 
         except Exception as error:
-            print("ERROR:CANNOT-FIND-OR-CREATE-USER", error)
+            logError(error)
             return HttpResponseForbidden("cannot find or create user")
 
         return self.get_response(request)
@@ -147,7 +205,7 @@ class ParseBody:
             try:
                 request.data = json.loads(request.body.decode("utf-8"))
             except Exception as error:
-                print("ERROR", error)
+                logError(error)
                 return HttpResponseForbidden("cannot read body")
 
         return self.get_response(request)
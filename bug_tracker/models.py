@@ -1,5 +1,63 @@
 from django.db import models
+from django.db.models import F, Q
 from django.core.validators import MaxValueValidator, MinValueValidator
+from django.utils import timezone
+
+
+class Sequence(models.Model):  # Counter handing out blocks of public ids
+    name = models.CharField(max_length=50, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class ProjectShard(models.Model):  # Database a project is stored in
+    project_id = models.CharField(max_length=10, unique=True)
+    database = models.CharField(max_length=50)
+    # set while move_project copies the project, edits are refused meanwhile
+    frozen = models.BooleanField(default=False)
+
+    def __str__(self) -> str:
+        return f"{self.project_id} on {self.database}"
+
+
+class Task(models.Model):  # Side effect run by the task worker
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_modified = models.DateTimeField(auto_now=True)
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    # at most one pending task per key, enqueueing it again updates its payload
+    key = models.CharField(max_length=200, null=True, blank=True)
+    STATUS_CHOICES = [
+        ("PND", "Pending"),
+        ("RUN", "Running"),
+        ("DON", "Done"),
+        ("FAI", "Failed"),
+    ]
+    status = models.CharField(max_length=3, choices=STATUS_CHOICES, default="PND")
+    attempts = models.IntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    error = models.TextField(blank=True)
+    # duration of the last run, the worker metrics are aggregated from it
+    seconds = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["key"], condition=Q(status="PND"), name="task_pending_key"
+            ),
+        ]
+        indexes = [
+            models.Index(
+                fields=["run_after", "id"],
+                condition=Q(status="PND"),
+                name="task_pending",
+            ),
+        ]
+
+    def __str__(self) -> str:
+        return self.name
 
 
 class User(models.Model):
@@ -11,6 +69,10 @@ class User(models.Model):
     last_name = models.CharField(max_length=100)
     locale = models.CharField(max_length=20, default="en")
     picture = models.URLField()
+    date_modified = models.DateTimeField(auto_now=True)
+
+    def touch(self):
+        User.objects.filter(pk=self.pk).update(date_modified=timezone.now())
 
     def __str__(self) -> str:
         return self.auth_id
@@ -21,16 +83,50 @@ class Project(models.Model):
     date_modified = models.DateTimeField(auto_now=True)
     title = models.CharField(max_length=100)
     description = models.TextField(max_length=1000)
+    # users are global and projects may be on another shard, so none of the
+    # references to User are enforced by the database
     creator = models.ForeignKey(
-        User, on_delete=models.CASCADE, related_name="projects_created"
+        User,
+        on_delete=models.CASCADE,
+        related_name="projects_created",
+        db_constraint=False,
     )
     bug_index = models.IntegerField(default=0)
     project_id = models.CharField(max_length=10, null=True, blank=True, unique=True)
+    # incremented on every change to the project or anything in it
+    revision = models.IntegerField(default=0)
+    # incremented on every edit of the project's own fields, clients send it
+    # back with their edit so changes made meanwhile are not overwritten
+    version = models.IntegerField(default=0)
+    # set when an administrator deletes the project, the purge_project task then
+    # removes it and everything in it
+    date_deleted = models.DateTimeField(null=True, blank=True)
 
     def update(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
 
+    def touch(self):
+        Project.objects.filter(pk=self.pk).update(revision=F("revision") + 1)
+
+    def edit(self, changes, version=None):
+        """
+        Write only the changed columns in a single UPDATE, which also touches
+        the project. With a version the update only applies if nobody edited
+        the project since; returns whether it was applied.
+        """
+        projects = Project.objects.filter(pk=self.pk)
+        if version is not None:
+            projects = projects.filter(version=version)
+        return bool(
+            projects.update(
+                **changes,
+                version=F("version") + 1,
+                revision=F("revision") + 1,
+                date_modified=timezone.now(),
+            )
+        )
+
     # def save(self):
     #     while (
     #         not self.project_id
@@ -43,13 +139,30 @@ class Project(models.Model):
         return self.title
 
 
+class MembershipQuerySet(models.QuerySet):
+    def live(self):
+        return self.filter(project__date_deleted__isnull=True)
+
+
 class Membership(models.Model):
     date_created = models.DateTimeField(auto_now_add=True)
     date_modified = models.DateTimeField(auto_now=True)
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="memberships")
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="memberships", db_constraint=False
+    )
     project = models.ForeignKey(
         Project, on_delete=models.CASCADE, related_name="memberships"
     )
+
+    objects = MembershipQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "project"], name="membership_unique"
+            ),
+        ]
+
     AUTHORIZATION_CHOICES = [
         # + delete the project, nominate director
         ("ADM", "Administrator"),
@@ -89,13 +202,19 @@ class Membership(models.Model):
         return self.project.title
 
 
+# statuses of bugs still being worked on
+ACTIVE_STATUSES = ["OPN", "PRG"]
+
+
 class Bug(models.Model):
     date_created = models.DateTimeField(auto_now_add=True)
     date_modified = models.DateTimeField(auto_now=True)
     index = models.IntegerField()
     title = models.CharField(max_length=100)
     description = models.TextField(max_length=1000)
-    reporter = models.ForeignKey(User, on_delete=models.CASCADE, related_name="bugs")
+    reporter = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="bugs", db_constraint=False
+    )
     project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name="bugs")
     reproducible = models.BooleanField(default=True)
     impact = models.IntegerField(
@@ -104,11 +223,91 @@ class Bug(models.Model):
     urgency = models.IntegerField(
         validators=[MinValueValidator(1), MaxValueValidator(5)], default=3
     )
+    # impact * urgency, kept up to date by save()
+    priority = models.IntegerField(default=9)
+    STATUS_CHOICES = [
+        ("OPN", "Open"),
+        ("PRG", "In progress"),
+        ("RES", "Resolved"),
+        ("CLO", "Closed"),
+    ]
+    status = models.CharField(max_length=3, choices=STATUS_CHOICES, default="OPN")
+    # incremented on every edit, see Project.version
+    version = models.IntegerField(default=0)
+    ACTIVE_STATUSES = ACTIVE_STATUSES
+    STATUS_TRANSITIONS = {
+        "OPN": ["PRG", "RES", "CLO"],
+        "PRG": ["OPN", "RES", "CLO"],
+        "RES": ["OPN", "CLO"],
+        "CLO": ["OPN"],
+    }
+
+    @staticmethod
+    def score(impact, urgency):
+        return int(impact) * int(urgency)
 
     def update(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
 
+    def touch(self):
+        Bug.objects.filter(pk=self.pk).update(date_modified=timezone.now())
+
+    def edit(self, changes, version=None):
+        """
+        Write only the changed columns in a single UPDATE, see Project.edit.
+        Without a version a status change still only applies to the status
+        it was validated against.
+        """
+        bugs = Bug.objects.filter(pk=self.pk)
+        if version is not None:
+            bugs = bugs.filter(version=version)
+        elif "status" in changes:
+            bugs = bugs.filter(status=self.status)
+        if "impact" in changes or "urgency" in changes:
+            changes = {
+                **changes,
+                "priority": (
+                    int(changes["impact"]) if "impact" in changes else F("impact")
+                )
+                * (int(changes["urgency"]) if "urgency" in changes else F("urgency")),
+            }
+        return bool(
+            bugs.update(
+                **changes, version=F("version") + 1, date_modified=timezone.now()
+            )
+        )
+
+    def save(self, *args, **kwargs):
+        self.priority = Bug.score(self.impact, self.urgency)
+        return super().save(*args, **kwargs)
+
+    class Meta:
+        # resolved and closed bugs only grow, so the indexes used by the
+        # everyday queries leave them out
+        indexes = [
+            models.Index(
+                fields=["project", "id"],
+                condition=Q(status__in=ACTIVE_STATUSES),
+                name="bug_active",
+            ),
+            models.Index(
+                fields=["project", "impact", "urgency"],
+                condition=Q(status__in=ACTIVE_STATUSES),
+                name="bug_active_impact_urgency",
+            ),
+            models.Index(
+                fields=["project", "-priority", "-id"],
+                condition=Q(status__in=ACTIVE_STATUSES),
+                name="bug_active_project_priority",
+            ),
+            models.Index(
+                fields=["-priority", "-id"],
+                condition=Q(status__in=ACTIVE_STATUSES),
+                name="bug_active_priority",
+            ),
+        ]
+
     """
     class Scale(models.TextChoices):
         VERY_HIGH = "very high"
@@ -132,6 +331,19 @@ class Assignment(models.Model):  # Assigning a bug to a member
     )
     bug = models.ForeignKey(Bug, on_delete=models.CASCADE, related_name="assignments")
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["bug", "membership"], name="assignment_unique"
+            ),
+        ]
+        # bugs assigned to a member, read by bugs-mine without the bug table
+        indexes = [
+            models.Index(
+                fields=["membership", "bug"], name="assignment_membership_bug"
+            ),
+        ]
+
     def __str__(self) -> str:
         return self.bug.title
 
@@ -140,22 +352,45 @@ class Tag(models.Model):
     date_created = models.DateTimeField(auto_now_add=True)
     date_modified = models.DateTimeField(auto_now=True)
     title = models.CharField(max_length=100)
-    creator = models.ForeignKey(User, on_delete=models.CASCADE, related_name="tags")
+    creator = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="tags", db_constraint=False
+    )
     project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name="tags")
     text_color = models.CharField(max_length=7)
     background_color = models.CharField(max_length=7)
     border_color = models.CharField(max_length=7)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=[
+                    "project",
+                    "title",
+                    "text_color",
+                    "background_color",
+                    "border_color",
+                ],
+                name="tag_unique",
+            ),
+        ]
+
     def __str__(self) -> str:
         return self.title
 
 
 class Mark(models.Model):  # Marking a bug with a tag
     date_created = models.DateTimeField(auto_now_add=True)
-    creator = models.ForeignKey(User, on_delete=models.CASCADE, related_name="marks")
+    creator = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="marks", db_constraint=False
+    )
     bug = models.ForeignKey(Bug, on_delete=models.CASCADE, related_name="marks")
     tag = models.ForeignKey(Tag, on_delete=models.CASCADE, related_name="marks")
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["bug", "tag"], name="mark_unique"),
+        ]
+
     def __str__(self) -> str:
         return self.bug.title
 
@@ -165,16 +400,105 @@ class Attachment(models.Model):
     title = models.CharField(max_length=200)
     bug = models.ForeignKey(Bug, on_delete=models.CASCADE, related_name="attachments")
     creator = models.ForeignKey(
-        User, on_delete=models.CASCADE, related_name="attachments"
+        User, on_delete=models.CASCADE, related_name="attachments", db_constraint=False
     )
     file = models.FileField(upload_to="media/attachments/")
     content_type = models.CharField(max_length=200)
     size = models.IntegerField()
+    # thumbnail of an image or the first lines of a text file, stored next to
+    # the file by the make_preview task, empty until it ran
+    preview = models.FileField(upload_to="media/attachments/", blank=True)
+    preview_type = models.CharField(max_length=200, blank=True)
 
     def __str__(self) -> str:
         return self.title
 
 
+class Signature(models.Model):  # MinHash of a bug's title and description
+    # the bug's date_modified when it was computed
+    date_indexed = models.DateTimeField()
+    bug = models.OneToOneField(Bug, on_delete=models.CASCADE, related_name="signature")
+    project = models.ForeignKey(
+        Project, on_delete=models.CASCADE, related_name="signatures"
+    )
+    minhash = models.BinaryField()
+
+    def __str__(self) -> str:
+        return self.bug.title
+
+
+class Band(models.Model):  # a band of a signature, bugs sharing one are similar
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name="bands")
+    bug = models.ForeignKey(Bug, on_delete=models.CASCADE, related_name="bands")
+    key = models.BigIntegerField()
+
+    class Meta:
+        indexes = [models.Index(fields=["project", "key"], name="band_project_key")]
+
+    def __str__(self) -> str:
+        return self.bug.title
+
+
+class Notification(models.Model):  # Event waiting for a recipient's digest
+    # kept when a change is expanded, the digest window counts from it
+    date_created = models.DateTimeField(default=timezone.now)
+    # empty for changes until send_digests expands them to the bug's reporter
+    # and assignees
+    recipient = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name="notifications",
+        null=True,
+        blank=True,
+    )
+    actor = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    KIND_CHOICES = [
+        ("ASG", "Assigned"),
+        ("CHG", "Changed"),
+    ]
+    kind = models.CharField(max_length=3, choices=KIND_CHOICES)
+    # bugs are on the project's shard, what the digest shows is copied here
+    project_id = models.CharField(max_length=10)
+    project_title = models.CharField(max_length=100)
+    bug_id = models.BigIntegerField()
+    bug_index = models.IntegerField()
+    bug_title = models.CharField(max_length=100)
+    changes = models.JSONField(default=list)
+    date_sent = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["recipient", "date_created"],
+                condition=Q(date_sent__isnull=True),
+                name="notification_unsent",
+            ),
+        ]
+
+    def __str__(self) -> str:
+        return self.bug_title
+
+
+class NotificationPreference(models.Model):
+    user = models.OneToOneField(
+        User, on_delete=models.CASCADE, related_name="notification_preference"
+    )
+    assignments = models.BooleanField(default=True)
+    changes = models.BooleanField(default=True)
+    # minutes notifications are collected for after the first one, before
+    # they go out together
+    window = models.IntegerField(
+        validators=[MinValueValidator(0), MaxValueValidator(24 * 60)], default=60
+    )
+
+    def update(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def __str__(self) -> str:
+        return str(self.user)
+
+
 # class Change(models.Model):
 #     date_created = models.DateTimeField(auto_now_add=True)
 #     title = models.CharField(max_length=200)
@@ -0,0 +1,205 @@
+from datetime import timedelta
+
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import Min
+from django.utils import timezone
+
+from .log import logError
+from .models import (
+    Assignment,
+    Bug,
+    Notification,
+    NotificationPreference,
+    User,
+)
+from .routers import shard_map
+
+# preference each kind of notification is switched off by
+PREFERENCES = {"ASG": "assignments", "CHG": "changes"}
+
+
+def notify(kind, actor, bug, project, recipients=None, changes=None):
+    """
+    Record an event on bug for the digests, a single insert. Assignments name
+    their recipients, changes reach the bug's reporter and assignees once
+    send_digests expands them.
+    """
+    event = {
+        "kind": kind,
+        "actor": actor,
+        "project_id": project.project_id,
+        "project_title": project.title,
+        "bug_id": bug.id,
+        "bug_index": bug.index,
+        "bug_title": bug.title,
+        "changes": changes or [],
+    }
+    if recipients is None:
+        Notification.objects.create(**event)
+        return
+    Notification.objects.bulk_create(
+        [
+            Notification(recipient_id=recipient, **event)
+            for recipient in recipients
+            if recipient != actor.id
+        ]
+    )
+
+
+# copied from a change to the notifications it expands to
+EVENT_FIELDS = [
+    "date_created",
+    "actor_id",
+    "kind",
+    "project_id",
+    "project_title",
+    "bug_id",
+    "bug_index",
+    "bug_title",
+    "changes",
+]
+
+
+def expand(batch_size):
+    # the bugs are read on their shard, the notifications are all on default
+    with transaction.atomic(using="default"):
+        events = list(
+            Notification.objects.select_for_update(skip_locked=True)
+            .filter(recipient__isnull=True)
+            .order_by("id")[:batch_size]
+        )
+        by_project = {}
+        for event in events:
+            by_project.setdefault(event.project_id, []).append(event)
+
+        notifications = []
+        for project_id, project_events in by_project.items():
+            # move_project remaps bug ids as it flips the map, a stale entry
+            # would look them up on the old shard
+            shard_map.forget(project_id)
+            database, _ = shard_map.get(project_id)
+            ids = {event.bug_id for event in project_events}
+            watchers = {}
+            for bug_id, user_id in (
+                Bug.objects.using(database)
+                .filter(id__in=ids)
+                .values_list("id", "reporter_id")
+                .union(
+                    Assignment.objects.using(database)
+                    .filter(bug_id__in=ids)
+                    .values_list("bug_id", "membership__user_id")
+                )
+            ):
+                watchers.setdefault(bug_id, set()).add(user_id)
+            for event in project_events:
+                fields = {field: getattr(event, field) for field in EVENT_FIELDS}
+                notifications.extend(
+                    Notification(recipient_id=recipient, **fields)
+                    for recipient in watchers.get(event.bug_id, ())
+                    if recipient != event.actor_id
+                )
+
+        Notification.objects.bulk_create(notifications)
+        Notification.objects.filter(id__in=[event.id for event in events]).delete()
+    return len(events)
+
+
+def describe(notification):
+    actor = f"{notification.actor.first_name} {notification.actor.last_name}"
+    bug = (
+        f"{notification.project_title} #{notification.bug_index} "
+        f"{notification.bug_title}"
+    )
+    if notification.kind == "ASG":
+        return f"{bug}: assigned to you by {actor}"
+    return f"{bug}: {', '.join(notification.changes)} changed by {actor}"
+
+
+def getDigest(user, notifications):
+    count = len(notifications)
+    lines = [describe(notification) for notification in notifications]
+    return EmailMessage(
+        subject=f"BugPen: {count} update{'' if count == 1 else 's'}",
+        body="\n".join(lines),
+        to=[user.email],
+    )
+
+
+def sendDigests(batch_size=100, connection=None):
+    """
+    Send a digest to every recipient whose oldest unsent notification is
+    older than their window, at most batch_size of them over one SMTP
+    connection. Each digest is sent at most once, also with several digest
+    processes. Returns the number of digests sent.
+    """
+    expand(batch_size * 10)
+    now = timezone.now()
+    pending = (
+        Notification.objects.filter(recipient__isnull=False, date_sent__isnull=True)
+        .values("recipient")
+        .annotate(first=Min("date_created"))
+        .order_by("first")
+    )
+    due = list(pending)
+    preferences = {
+        preference.user_id: preference
+        for preference in NotificationPreference.objects.filter(
+            user_id__in=[row["recipient"] for row in due]
+        )
+    }
+    default = NotificationPreference()
+    recipients = [
+        row["recipient"]
+        for row in due
+        if now - row["first"]
+        >= timedelta(minutes=preferences.get(row["recipient"], default).window)
+    ][:batch_size]
+    if not recipients:
+        return 0
+
+    users = User.objects.in_bulk(recipients)
+    # claimed by marking them sent first, so a concurrent run skips them
+    with transaction.atomic(using="default"):
+        claimed = list(
+            Notification.objects.select_for_update(skip_locked=True, of=("self",))
+            .filter(recipient_id__in=recipients, date_sent__isnull=True)
+            .select_related("actor")
+            .order_by("id")
+        )
+        Notification.objects.filter(
+            id__in=[notification.id for notification in claimed]
+        ).update(date_sent=now)
+    notifications = {}
+    for notification in claimed:
+        notifications.setdefault(notification.recipient_id, []).append(notification)
+
+    sent = 0
+    connection = connection or get_connection()
+    try:
+        with connection:
+            for recipient, items in list(notifications.items()):
+                preference = preferences.get(recipient, default)
+                items = [
+                    item
+                    for item in items
+                    if getattr(preference, PREFERENCES[item.kind])
+                ]
+                user = users.get(recipient)
+                if items and user and user.email:
+                    connection.send_messages([getDigest(user, items)])
+                    sent += 1
+                # switched off and undeliverable notifications are done as well
+                del notifications[recipient]
+    except Exception as error:
+        logError(error)
+    # the notifications of digests that were not sent go to the next run
+    Notification.objects.filter(
+        id__in=[item.id for items in notifications.values() for item in items]
+    ).update(date_sent=None)
+    return sent
+
+
+def cleanUp(days=7):
+    before = timezone.now() - timedelta(days=days)
+    return Notification.objects.filter(date_sent__lt=before).delete()[0]
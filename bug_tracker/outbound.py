@@ -0,0 +1,155 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from .log import logger
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Open after failures consecutive failed calls and refuse calls for reset
+    seconds, then let a single trial call through: success closes the
+    circuit again, failure keeps it open for another reset period.
+    """
+
+    def __init__(self, failures=5, reset=30):
+        self.failures = failures
+        self.reset = reset
+        self.count = 0
+        self.opened = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if time.monotonic() - self.opened < self.reset or self.trial:
+                return False
+            self.trial = True
+            return True
+
+    def success(self):
+        with self.lock:
+            self.count = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.count += 1
+            if self.trial or self.count >= self.failures:
+                self.opened = time.monotonic()
+            self.trial = False
+
+
+class Outbound:
+    """
+    Shared HTTP client for calls leaving the server. Connections are kept
+    alive in a pool per host, every call is bounded by timeout, and each
+    named endpoint has its own circuit breaker and a small cache of its last
+    good responses to fall back on while the remote side is failing.
+    """
+
+    def __init__(self, timeout=(3.05, 5), pool_size=20, cache_size=1000):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.breakers = {}
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def breaker(self, name):
+        with self.lock:
+            return self.breakers.setdefault(name, CircuitBreaker())
+
+    def cached(self, key):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None:
+                self.cache.move_to_end(key)
+            return entry
+
+    def store(self, key, value):
+        with self.lock:
+            self.cache[key] = (time.monotonic(), value)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def record(self, name, seconds, failed):
+        with self.lock:
+            metric = self.metrics.setdefault(
+                name, {"calls": 0, "failures": 0, "seconds": 0.0, "maxSeconds": 0.0}
+            )
+            metric["calls"] += 1
+            metric["failures"] += failed
+            metric["seconds"] += seconds
+            metric["maxSeconds"] = max(metric["maxSeconds"], seconds)
+        logger.info("outbound %s", name, extra={"duration": round(seconds * 1000, 2)})
+
+    def get_json(self, name, url, headers=None, key=None, max_age=0):
+        key = (name, key or url)
+        entry = self.cached(key)
+        if entry is not None and time.monotonic() - entry[0] < max_age:
+            return entry[1]
+
+        breaker = self.breaker(name)
+        if not breaker.allow():
+            if entry is not None:
+                return entry[1]
+            raise CircuitOpen(f"{name} circuit open")
+
+        start = time.perf_counter()
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+            if response.status_code >= 500:
+                response.raise_for_status()
+            value = response.json()
+        except Exception:
+            breaker.failure()
+            self.record(name, time.perf_counter() - start, True)
+            if entry is not None:
+                return entry[1]
+            raise
+        breaker.success()
+        self.record(name, time.perf_counter() - start, False)
+        self.store(key, value)
+        return value
+
+
+outbound = Outbound(
+    timeout=(settings.OUTBOUND_CONNECT_TIMEOUT, settings.OUTBOUND_READ_TIMEOUT)
+)
+
+
+def jwks(issuer, max_age=600):
+    # refetched at most every JWKS_REFRESH_SECONDS however many tokens name
+    # an unknown key, made-up key ids must not flood Auth0 or open its breaker
+    return outbound.get_json(
+        "auth0-jwks",
+        f"{issuer}.well-known/jwks.json",
+        max_age=max(max_age, settings.JWKS_REFRESH_SECONDS),
+    )
+
+
+def userinfo(url, token):
+    return outbound.get_json(
+        "auth0-userinfo",
+        url,
+        headers={"Authorization": f"Bearer {token}"},
+        key=hashlib.sha256(token.encode()).hexdigest(),
+    )
@@ -0,0 +1,160 @@
+from functools import wraps
+
+from django.http import (
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseForbidden,
+    HttpResponseNotFound,
+)
+
+from .log import logError
+from .models import Membership
+from .routers import shard_map, using
+
+ADMINISTRATOR = 1
+DIRECTOR = 2
+CONTRIBUTOR = 4
+SPECTATOR = 8
+
+ROLES = {
+    "ADM": ADMINISTRATOR,
+    "DIR": DIRECTOR,
+    "CON": CONTRIBUTOR,
+    "SPE": SPECTATOR,
+}
+
+# display names clients use for roles, like "Director"
+AUTHORIZATIONS = {name: role for role, name in Membership.AUTHORIZATION_CHOICES}
+
+# roles allowed to take each action, see the Membership docstring
+RULES = {
+    "project.view": ["ADM", "DIR", "CON", "SPE"],
+    "project.edit": ["ADM", "DIR"],
+    "project.delete": ["ADM"],
+    "member.add": ["ADM", "DIR"],
+    "member.remove": ["ADM", "DIR"],
+    "member.authorize": ["ADM", "DIR"],
+    "tag.create": ["ADM", "DIR", "CON"],
+    "tag.remove": ["ADM", "DIR"],
+    "bug.report": ["ADM", "DIR", "CON"],
+    "bug.edit": ["ADM", "DIR", "CON"],
+    "bug.tag": ["ADM", "DIR", "CON"],
+    "bug.assign": ["ADM", "DIR"],
+    "bug.attach": ["ADM", "DIR", "CON"],
+    "attachment.remove": ["ADM", "DIR", "CON"],
+}
+
+# roles allowed to take each action on any bug, other roles the action is
+# allowed to only on bugs reported by or assigned to them
+ANY_BUG = {
+    "bug.edit": ["ADM", "DIR"],
+    "attachment.remove": ["ADM", "DIR"],
+}
+
+# roles a member of the outer role may give to a member of the inner role
+NOMINATIONS = {
+    "ADM": {
+        "ADM": ["DIR", "CON", "SPE"],
+        "DIR": ["ADM", "CON", "SPE"],
+        "CON": ["ADM", "DIR", "SPE"],
+        "SPE": ["ADM", "DIR", "CON"],
+    },
+    "DIR": {"CON": ["SPE"], "SPE": ["CON"]},
+}
+
+# roles a member of the key role may remove from the project
+REMOVALS = {
+    "ADM": ["ADM", "DIR", "CON", "SPE"],
+    "DIR": ["CON", "SPE"],
+}
+
+
+def mask(roles):
+    value = 0
+    for role in roles:
+        value |= ROLES[role]
+    return value
+
+
+PERMISSIONS = {action: mask(roles) for action, roles in RULES.items()}
+NOMINATE = {
+    (ROLES[requester], ROLES[subject]): mask(roles)
+    for requester, subjects in NOMINATIONS.items()
+    for subject, roles in subjects.items()
+}
+REMOVE = {ROLES[requester]: mask(roles) for requester, roles in REMOVALS.items()}
+ON_ANY_BUG = {action: mask(roles) for action, roles in ANY_BUG.items()}
+
+
+def can(authorization, action):
+    return bool(PERMISSIONS[action] & ROLES[authorization])
+
+
+def canNominate(requester, subject, authorization):
+    return bool(
+        NOMINATE.get((ROLES[requester], ROLES[subject]), 0) & ROLES[authorization]
+    )
+
+
+def canRemove(requester, subject):
+    return bool(REMOVE.get(ROLES[requester], 0) & ROLES[subject])
+
+
+def canOnBug(membership, action, bug):
+    if not can(membership.authorization, action):
+        return False
+    if ON_ANY_BUG.get(action, ~0) & ROLES[membership.authorization]:
+        return True
+    return (
+        bug.reporter_id == membership.user_id
+        or bug.assignments.filter(membership=membership).exists()
+    )
+
+
+def requires(action):
+    """
+    Resolve the requester's membership of the project named by projectId,
+    together with the project, in one query and check that its role may
+    take action. The view finds it on request.membership and runs routed to
+    the project's shard. Non-members and deleted projects get a 404.
+    """
+    if action not in PERMISSIONS:
+        raise ValueError(f"unknown action {action}")
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            try:
+                project_id = request.GET["projectId"]
+            except Exception as error:
+                logError(error)
+                return HttpResponseBadRequest("projectId not specified")
+
+            database, frozen = shard_map.get(project_id)
+            if frozen and request.method != "GET":
+                return HttpResponse("project is being moved", status=503)
+
+            with using(database):
+                try:
+                    membership = (
+                        Membership.objects.live()
+                        .select_related("project")
+                        .get(user=request.user, project__project_id=project_id)
+                    )
+                except Exception as error:
+                    logError(error)
+                    return HttpResponseNotFound("membership not found")
+
+                try:
+                    if not can(membership.authorization, action):
+                        raise Exception(f"{action} not allowed")
+                except Exception as error:
+                    logError(error)
+                    return HttpResponseForbidden("not authorized")
+
+                request.membership = membership
+                return view(request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,60 @@
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+IMAGE_TYPES = {"image/png", "image/jpeg", "image/gif", "image/webp", "image/bmp"}
+TEXT_TYPES = {"application/json", "application/xml", "application/x-ndjson"}
+TEXT_EXTENSIONS = {".txt", ".log", ".csv", ".json", ".xml", ".yaml", ".yml"}
+
+# bytes read from a text file at most, enough for PREVIEW_LINES long lines
+TEXT_BYTES = 64 * 1024
+
+
+def previewKind(content_type, title):
+    if content_type in IMAGE_TYPES:
+        return "image"
+    if (
+        content_type.startswith("text/")
+        or content_type in TEXT_TYPES
+        or any(title.lower().endswith(extension) for extension in TEXT_EXTENSIONS)
+    ):
+        return "text"
+    return None
+
+
+def imagePreview(file, size):
+    image = Image.open(file)
+    # JPEG is decoded at the smallest scale still larger than the preview,
+    # which is most of the work for large photos
+    image.draft("RGB", (size, size))
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((size, size))
+    output = BytesIO()
+    if image.mode in ("RGBA", "LA", "P"):
+        image.save(output, "PNG", optimize=True)
+        return ContentFile(output.getvalue()), "png", "image/png"
+    image.convert("RGB").save(output, "JPEG", quality=80, optimize=True)
+    return ContentFile(output.getvalue()), "jpg", "image/jpeg"
+
+
+def textPreview(file, lines):
+    data = file.read(TEXT_BYTES)
+    text = data.decode("utf-8", errors="replace")
+    excerpt = "\n".join(text.splitlines()[:lines])
+    return ContentFile(excerpt.encode()), "txt", "text/plain; charset=utf-8"
+
+
+def makePreview(attachment):
+    """
+    Build the preview of attachment and return (content, extension, content
+    type), or None for files without one.
+    """
+    preview = previewKind(attachment.content_type, attachment.title)
+    if preview is None:
+        return None
+    with attachment.file.open("rb") as file:
+        if preview == "image":
+            return imagePreview(file, settings.PREVIEW_SIZE)
+        return textPreview(file, settings.PREVIEW_LINES)
@@ -0,0 +1,99 @@
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import (
+    Assignment,
+    Attachment,
+    Band,
+    Bug,
+    Mark,
+    Membership,
+    Project,
+    ProjectShard,
+    Signature,
+    Tag,
+    User,
+)
+from .tasks import enqueue
+
+BATCH_SIZE = 500
+
+
+def deleteInBatches(queryset, batch_size=BATCH_SIZE, before=None):
+    # each batch is its own short transaction, so locks are never held for
+    # long and a crash only loses the batch in progress
+    deleted = 0
+    while True:
+        ids = list(queryset.order_by("id").values_list("id", flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        with transaction.atomic(using=queryset.db):
+            rows = queryset.model.objects.using(queryset.db).filter(id__in=ids)
+            if before:
+                before(rows)
+            deleted += rows.delete()[0]
+
+
+def deleteFiles(attachments):
+    names = [
+        name
+        for names in attachments.values_list("file", "preview")
+        for name in names
+        if name
+    ]
+    transaction.on_commit(
+        lambda: enqueue("delete_files", {"names": names}), using=attachments.db
+    )
+
+
+def touchUsers(memberships):
+    # users are on default, the memberships maybe on another shard
+    User.objects.filter(
+        id__in=list(memberships.values_list("user_id", flat=True))
+    ).update(date_modified=timezone.now())
+
+
+def purgeProject(project, batch_size=BATCH_SIZE, files=True):
+    # files are kept when the project was copied to another shard and the
+    # copy still refers to them
+    database = project._state.db
+    deleteInBatches(
+        Mark.objects.using(database).filter(bug__project=project), batch_size
+    )
+    deleteInBatches(
+        Assignment.objects.using(database).filter(bug__project=project), batch_size
+    )
+    deleteInBatches(
+        Attachment.objects.using(database).filter(bug__project=project),
+        batch_size,
+        deleteFiles if files else None,
+    )
+    deleteInBatches(Band.objects.using(database).filter(project=project), batch_size)
+    deleteInBatches(
+        Signature.objects.using(database).filter(project=project), batch_size
+    )
+    deleteInBatches(Bug.objects.using(database).filter(project=project), batch_size)
+    deleteInBatches(Tag.objects.using(database).filter(project=project), batch_size)
+    deleteInBatches(
+        Membership.objects.using(database).filter(project=project),
+        batch_size,
+        touchUsers,
+    )
+    project.delete()
+
+
+def purgeDeleted(project, batch_size=BATCH_SIZE):
+    purgeProject(project, batch_size)
+    ProjectShard.objects.filter(project_id=project.project_id).delete()
+
+
+def purgeDeletedProjects(batch_size=BATCH_SIZE):
+    projects = []
+    for database in settings.DATABASE_SHARDS:
+        for project in Project.objects.using(database).filter(
+            date_deleted__isnull=False
+        ):
+            purgeDeleted(project, batch_size)
+            projects.append(project)
+    return projects
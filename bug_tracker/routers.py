@@ -0,0 +1,220 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+
+from django.conf import settings
+from django.db import connections
+
+# set by the RouteReads middleware for the duration of a request
+routing = ContextVar("routing", default=None)
+
+# database holding the project being worked on, set by using()
+shard = ContextVar("shard", default=None)
+
+# models stored with their project, everything else lives on default
+SHARDED = {
+    "project",
+    "membership",
+    "bug",
+    "tag",
+    "mark",
+    "assignment",
+    "attachment",
+    "signature",
+    "band",
+}
+
+
+class Routing:
+    def __init__(self, replica):
+        # replica every read of the request goes to, or None for the primary
+        self.replica = replica
+        self.wrote = False
+
+
+class ReplicaRouter:
+    """
+    Send reads made while handling a GET to the replica picked for the
+    request and everything else to the primary (default) database. Replicas
+    lag by different amounts, so a request never reads from two of them.
+    Sessions always use the primary, they are read before the request is
+    routed.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = routing.get()
+        if (
+            state is None
+            or state.replica is None
+            or model._meta.app_label == "sessions"
+        ):
+            return "default"
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        state = routing.get()
+        if state is not None and model._meta.app_label != "sessions":
+            state.wrote = True
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == "default"
+
+
+class ShardRouter:
+    """
+    Send the rows of a project and everything in it to the shard the
+    project is mapped to. Queries made on an instance stay on the database it
+    was loaded from, other queries go to the shard set by using(). Global
+    models, and project models outside of using(), fall through to the
+    ReplicaRouter.
+    """
+
+    def route(self, model, hints):
+        if model._meta.model_name not in SHARDED:
+            return None
+        instance = hints.get("instance")
+        if instance is not None and instance._meta.model_name in SHARDED:
+            if instance._state.db in settings.DATABASE_SHARDS[1:]:
+                return instance._state.db
+        alias = shard.get()
+        return None if alias in (None, "default") else alias
+
+    def db_for_read(self, model, **hints):
+        return self.route(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self.route(model, hints)
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == "default":
+            return None
+        return app_label == "bug_tracker" and model_name in SHARDED
+
+
+def current():
+    return shard.get() or "default"
+
+
+@contextmanager
+def using(alias):
+    token = shard.set(alias)
+    try:
+        yield alias
+    finally:
+        shard.reset(token)
+
+
+def pinned(alias, iterable):
+    # a streamed response is consumed after the view returned, so every step
+    # of it is routed on its own
+    iterator = iter(iterable)
+    while True:
+        with using(alias):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+class ShardMap:
+    """
+    Shards of projects by public project id, read from ProjectShard and
+    cached for ttl seconds. Projects without an entry were created before
+    sharding and live on default.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, project_id):
+        from .models import ProjectShard
+
+        with self.lock:
+            entry = self.entries.get(project_id)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1], entry[2]
+        row = (
+            ProjectShard.objects.filter(project_id=project_id)
+            .values_list("database", "frozen")
+            .first()
+        )
+        database, frozen = row or ("default", False)
+        with self.lock:
+            self.entries[project_id] = (time.monotonic() + self.ttl, database, frozen)
+        return database, frozen
+
+    def forget(self, project_id):
+        with self.lock:
+            self.entries.pop(project_id, None)
+
+
+shard_map = ShardMap(ttl=settings.SHARD_MAP_SECONDS)
+
+# long-lived threads per shard, each keeps its connections open between
+# fan-outs, see FANOUT_THREADS
+executors = {}
+executors_lock = threading.Lock()
+
+
+def getExecutor(alias):
+    with executors_lock:
+        if alias not in executors:
+            executors[alias] = ThreadPoolExecutor(
+                max_workers=settings.FANOUT_THREADS,
+                thread_name_prefix=f"fanout-{alias}",
+            )
+        return executors[alias]
+
+
+def closeUnusable():
+    # what Django does at the end of a request, without CONN_MAX_AGE: the
+    # thread outlives the request, so only broken connections are closed
+    for connection in connections.all():
+        if connection.connection is not None and connection.errors_occurred:
+            if not connection.is_usable():
+                connection.close()
+            connection.errors_occurred = False
+
+
+def fanout(function):
+    """
+    Call function once per shard, in parallel, each call routed to its
+    shard. The first shard is queried on the calling thread, the others on
+    threads of their own. Returns the results in the order of
+    DATABASE_SHARDS.
+    """
+    first, *others = settings.DATABASE_SHARDS
+
+    def call(alias):
+        try:
+            with using(alias):
+                return function(alias)
+        finally:
+            closeUnusable()
+
+    futures = [
+        getExecutor(alias).submit(copy_context().run, call, alias) for alias in others
+    ]
+    with using(first):
+        results = [function(first)]
+    return results + [future.result() for future in futures]
+
+
+def pickReplica():
+    if not settings.DATABASE_REPLICAS:
+        return None
+    return random.choice(settings.DATABASE_REPLICAS)
+
+
+def pickShard():
+    return random.choice(settings.DATABASE_SHARDS)
@@ -0,0 +1,362 @@
+from django.db.models import Count, prefetch_related_objects
+
+from .fragments import fragments
+from .models import Bug, Membership, User
+from .routers import fanout
+
+
+def countMemberships(users):
+    # memberships are spread over the shards, so they are counted on each
+    # and set as memberships_count, the annotation getUser reads
+    users = list(users)
+    counts = {user.id: 0 for user in users}
+    for rows in fanout(
+        lambda alias: list(
+            Membership.objects.filter(user_id__in=counts)
+            .values("user_id")
+            .annotate(count=Count("id"))
+            .values_list("user_id", "count")
+            .order_by()
+        )
+    ):
+        for user_id, count in rows:
+            counts[user_id] += count
+    for user in users:
+        user.memberships_count = counts[user.id]
+    return users
+
+
+def getUser(user):
+    return {
+        "id": user.id,
+        "userId": user.user_id,
+        "name": f"{user.first_name} {user.last_name}",
+        "firstName": user.first_name,
+        "lastName": user.last_name,
+        "picture": user.picture,
+        "membershipsCount": user.memberships_count
+        if hasattr(user, "memberships_count")
+        else countMemberships([user])[0].memberships_count,
+    }
+
+
+def getUsers(ids):
+    users = {}
+    missing = []
+    for id, version in User.objects.filter(id__in=ids).values_list(
+        "id", "date_modified"
+    ):
+        fragment = fragments.get("user", id, version)
+        if fragment is None:
+            missing.append(id)
+        else:
+            users[id] = fragment
+    if missing:
+        for user in countMemberships(User.objects.filter(id__in=missing)):
+            users[user.id] = fragments.set(
+                "user", user.id, user.date_modified, getUser(user)
+            )
+    return users
+
+
+# Shells are the cached form of attachments, tags and bugs. They refer to
+# users and tags by id, so a changed user does not invalidate every bug that
+# mentions them; resolve* functions expand the ids into full fragments.
+
+
+def getBugSummary(bug):
+    return {
+        "id": bug.id,
+        "index": bug.index,
+        "title": bug.title,
+        "priority": bug.priority,
+        "impact": bug.impact,
+        "urgency": bug.urgency,
+        "projectId": bug.project.project_id,
+        "updatedAt": bug.date_modified,
+    }
+
+
+def getDuplicate(bug, similarity):
+    return {
+        "id": bug.id,
+        "index": bug.index,
+        "title": bug.title,
+        "status": bug.get_status_display(),
+        "similarity": round(similarity, 2),
+    }
+
+
+def getPreferences(preference):
+    return {
+        "assignments": preference.assignments,
+        "changes": preference.changes,
+        "window": preference.window,
+    }
+
+
+def getAttachmentShell(attachment, project_id):
+    return {
+        "id": attachment.id,
+        "title": attachment.title,
+        "size": attachment.size,
+        "contentType": attachment.content_type,
+        "creator": attachment.creator_id,
+        "createdAt": attachment.date_created,
+        "preview": getPreviewUrl(attachment, project_id),
+        "previewType": attachment.preview_type or None,
+    }
+
+
+def getPreviewUrl(attachment, project_id):
+    if not attachment.preview:
+        return None
+    return (
+        f"/attachment-preview?projectId={project_id}"
+        f"&bugId={attachment.bug_id}&attachmentId={attachment.id}"
+    )
+
+
+def getTagShell(tag):
+    return {
+        "id": tag.id,
+        "createdAt": tag.date_created,
+        "creator": tag.creator_id,
+        "title": tag.title,
+        "textColor": tag.text_color,
+        "backgroundColor": tag.background_color,
+        "borderColor": tag.border_color,
+    }
+
+
+PROJECT_SECTIONS = {"bugs", "tags", "members"}
+
+BUG_FIELDS = [
+    "id",
+    "index",
+    "title",
+    "description",
+    "reporter",
+    "createdAt",
+    "updatedAt",
+    "reproducible",
+    "impact",
+    "urgency",
+    "priority",
+    "status",
+    "version",
+    "tags",
+    "attachments",
+    "assignees",
+]
+
+# fields that cost an extra column or query to load, skipped unless requested
+BUG_PARTS = {"description", "tags", "attachments", "assignees"}
+
+
+def getBugShell(bug, parts=BUG_PARTS):
+    shell = {
+        "id": bug.id,
+        "index": bug.index,
+        "title": bug.title,
+        "reporter": bug.reporter_id,
+        "createdAt": bug.date_created,
+        "updatedAt": bug.date_modified,
+        "reproducible": bug.reproducible,
+        "impact": bug.impact,
+        "urgency": bug.urgency,
+        "priority": bug.priority,
+        "status": bug.get_status_display(),
+        "version": bug.version,
+    }
+    if "description" in parts:
+        shell["description"] = bug.description
+    if "tags" in parts:
+        shell["tags"] = [mark.tag_id for mark in bug.marks.all()]
+    if "attachments" in parts:
+        shell["attachments"] = [
+            getAttachmentShell(attachment, bug.project.project_id)
+            for attachment in bug.attachments.all()
+        ]
+    if "assignees" in parts:
+        shell["assignees"] = [
+            assignment.membership.user_id for assignment in bug.assignments.all()
+        ]
+    return shell
+
+
+def getTagShells(tags):
+    # ids of tags and bugs are only unique within a shard
+    return [
+        fragments.get("tag", (tag._state.db, tag.id), tag.date_modified)
+        or fragments.set(
+            "tag", (tag._state.db, tag.id), tag.date_modified, getTagShell(tag)
+        )
+        for tag in tags
+    ]
+
+
+def getBugShells(bugs, parts=BUG_PARTS):
+    # complete shells are cached as "bug" and serve any request, partial ones
+    # are cached under a kind naming the parts they were built with
+    kind = "bug" if parts == BUG_PARTS else f"bug:{','.join(sorted(parts))}"
+    bugs = list(bugs)
+    shells = {
+        bug.id: fragments.get("bug", (bug._state.db, bug.id), bug.date_modified)
+        or (
+            kind != "bug"
+            and fragments.get(kind, (bug._state.db, bug.id), bug.date_modified)
+        )
+        or None
+        for bug in bugs
+    }
+    missing = [bug for bug in bugs if shells[bug.id] is None]
+    lookups = {
+        "tags": "marks",
+        "attachments": "attachments",
+        "assignees": "assignments__membership",
+    }
+    prefetch_related_objects(
+        missing, *[lookup for part, lookup in lookups.items() if part in parts]
+    )
+    for bug in missing:
+        shells[bug.id] = fragments.set(
+            kind, (bug._state.db, bug.id), bug.date_modified, getBugShell(bug, parts)
+        )
+    return [shells[bug.id] for bug in bugs]
+
+
+def resolveTag(shell, users):
+    return {**shell, "creator": users[shell["creator"]]}
+
+
+def resolveBug(shell, users, tags):
+    bug = dict(shell)
+    if "reporter" in bug:
+        bug["reporter"] = users[shell["reporter"]]
+    if "tags" in bug:
+        bug["tags"] = [tags[id] for id in shell["tags"]]
+    if "attachments" in bug:
+        bug["attachments"] = [
+            {**attachment, "creator": users[attachment["creator"]]}
+            for attachment in shell["attachments"]
+        ]
+    if "assignees" in bug:
+        bug["assignees"] = [users[id] for id in shell["assignees"]]
+    return bug
+
+
+def getBugs(bugs, project):
+    bugs = getBugShells(bugs)
+    tags = {tag["id"]: tag for tag in getTagShells(project.tags.all())}
+    ids = {tag["creator"] for tag in tags.values()}
+    for bug in bugs:
+        ids.add(bug["reporter"])
+        ids.update(bug["assignees"])
+        ids.update(attachment["creator"] for attachment in bug["attachments"])
+    users = getUsers(ids)
+    tags = {id: resolveTag(tag, users) for id, tag in tags.items()}
+    return [resolveBug(bug, users, tags) for bug in bugs]
+
+
+def loadProject(project, include=PROJECT_SECTIONS, fields=None):
+    """
+    Load the requested sections of a project. include selects the bugs, tags
+    and members sections and fields the keys of each bug; sections and bug
+    parts that were not asked for are never queried. Only active bugs are
+    loaded, resolved and closed ones are listed by getBugs.
+    """
+    bugs = tags = memberships = None
+    ids = {project.creator_id}
+
+    if "bugs" in include:
+        if fields is None:
+            fields = BUG_FIELDS
+        else:
+            fields = [field for field in BUG_FIELDS if field in fields or field == "id"]
+        parts = BUG_PARTS.intersection(fields)
+        queryset = project.bugs.filter(status__in=Bug.ACTIVE_STATUSES)
+        if "description" not in parts:
+            queryset = queryset.defer("description")
+        bugs = getBugShells(queryset, parts)
+        if fields != BUG_FIELDS:
+            bugs = [{field: bug[field] for field in fields} for bug in bugs]
+        for bug in bugs:
+            if "reporter" in bug:
+                ids.add(bug["reporter"])
+            ids.update(bug.get("assignees", ()))
+            ids.update(
+                attachment["creator"] for attachment in bug.get("attachments", ())
+            )
+
+    if "tags" in include or (bugs and "tags" in fields):
+        tags = getTagShells(project.tags.all())
+        ids.update(tag["creator"] for tag in tags)
+
+    if "members" in include:
+        memberships = list(project.memberships.all())
+        ids.update(membership.user_id for membership in memberships)
+
+    return bugs, tags, memberships, getUsers(ids)
+
+
+def getProjectFields(project):
+    return {
+        "id": project.id,
+        "projectId": project.project_id,
+        "title": project.title,
+        "description": project.description,
+        "createdAt": project.date_created,
+        "updatedAt": project.date_modified,
+        "version": project.version,
+    }
+
+
+def getProject(project, include=PROJECT_SECTIONS, fields=None):
+    bugs, tags, memberships, users = loadProject(project, include, fields)
+    project_dict = {
+        **getProjectFields(project),
+        "creator": users[project.creator_id],
+    }
+    if tags is not None:
+        tags = {tag["id"]: resolveTag(tag, users) for tag in tags}
+    if bugs is not None:
+        project_dict["bugs"] = [resolveBug(bug, users, tags) for bug in bugs]
+    if "tags" in include:
+        project_dict["tags"] = list(tags.values())
+    if memberships is not None:
+        project_dict["members"] = [
+            {
+                "authorization": membership.get_authorization_display(),
+                **users[membership.user_id],
+            }
+            for membership in memberships
+        ]
+    return project_dict
+
+
+def getProjectNormalized(project, include=PROJECT_SECTIONS, fields=None):
+    """
+    Every user appears once in the users map, keyed by id. The creator,
+    members, reporters, assignees and tag and attachment creators refer to
+    it by id, and bugs refer to the tags list by tag id.
+    """
+    bugs, tags, memberships, users = loadProject(project, include, fields)
+    project_dict = {
+        **getProjectFields(project),
+        "creator": project.creator_id,
+    }
+    if bugs is not None:
+        project_dict["bugs"] = bugs
+    if tags is not None:
+        project_dict["tags"] = tags
+    if memberships is not None:
+        project_dict["members"] = [
+            {
+                "id": membership.user_id,
+                "authorization": membership.get_authorization_display(),
+            }
+            for membership in memberships
+        ]
+    project_dict["users"] = users
+    return project_dict
@@ -0,0 +1,156 @@
+import hashlib
+
+from django.core.cache import cache
+from django.db.models import Count, IntegerField, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import Assignment, Bug, Mark, Membership, User
+from .routers import fanout
+
+STATS_TIMEOUT = 60 * 60
+TOP_TAGS = 10
+
+
+def perAssignee(project):
+    rows = list(
+        Assignment.objects.filter(
+            bug__project=project, bug__status__in=Bug.ACTIVE_STATUSES
+        )
+        .values("membership__user_id")
+        .annotate(count=Count("id"))
+        .order_by("-count")
+    )
+    # users are on default, not next to the assignments
+    user_ids = dict(
+        User.objects.filter(
+            id__in=[row["membership__user_id"] for row in rows]
+        ).values_list("id", "user_id")
+    )
+    return [
+        {"userId": user_ids.get(row["membership__user_id"]), "count": row["count"]}
+        for row in rows
+    ]
+
+
+def computeProjectStats(project):
+    bugs = Bug.objects.filter(project=project, status__in=Bug.ACTIVE_STATUSES)
+    statuses = dict(Bug.STATUS_CHOICES)
+    return {
+        "byStatus": {
+            statuses[row["status"]]: row["count"]
+            for row in Bug.objects.filter(project=project)
+            .values("status")
+            .annotate(count=Count("id"))
+            .order_by()
+        },
+        "openCount": bugs.count(),
+        "unassignedCount": bugs.filter(assignments__isnull=True).count(),
+        "byImpactUrgency": list(
+            bugs.values("impact", "urgency")
+            .annotate(count=Count("id"))
+            .order_by("impact", "urgency")
+        ),
+        "perAssignee": perAssignee(project),
+        "topTags": [
+            {"id": row["tag_id"], "title": row["tag__title"], "count": row["count"]}
+            for row in Mark.objects.filter(bug__project=project)
+            .values("tag_id", "tag__title")
+            .annotate(count=Count("id"))
+            .order_by("-count", "tag_id")[:TOP_TAGS]
+        ],
+    }
+
+
+def getProjectStats(project):
+    key = f"project-stats:{project.project_id}:{project.revision}"
+    stats = cache.get(key)
+    if stats is None:
+        stats = computeProjectStats(project)
+        cache.set(key, stats, STATS_TIMEOUT)
+    return {"revision": project.revision, **stats}
+
+
+def count(queryset, field):
+    # correlated COUNT of queryset for each row of the outer query
+    return Coalesce(
+        Subquery(
+            queryset.values(field).annotate(count=Count("id")).values("count")[:1],
+            output_field=IntegerField(),
+        ),
+        0,
+    )
+
+
+def computeHome(user):
+    return [
+        project
+        for projects in fanout(lambda alias: computeShardHome(user))
+        for project in projects
+    ]
+
+
+def computeShardHome(user):
+    active = Bug.objects.filter(
+        project=OuterRef("project"), status__in=Bug.ACTIVE_STATUSES
+    )
+    memberships = (
+        Membership.objects.live()
+        .filter(user=user)
+        .select_related("project")
+        .annotate(
+            member_count=count(
+                Membership.objects.filter(project=OuterRef("project")), "project"
+            ),
+            open_count=count(active, "project"),
+            assigned_count=count(
+                Assignment.objects.filter(
+                    membership=OuterRef("pk"), bug__status__in=Bug.ACTIVE_STATUSES
+                ),
+                "membership",
+            ),
+            last_bug_change=Subquery(
+                Bug.objects.filter(project=OuterRef("project"))
+                .values("project")
+                .annotate(last=Max("date_modified"))
+                .values("last")[:1]
+            ),
+        )
+        .order_by("project_id")
+    )
+    return [
+        {
+            "id": membership.project.id,
+            "title": membership.project.title,
+            "projectId": membership.project.project_id,
+            "authorization": membership.get_authorization_display(),
+            "memberCount": membership.member_count,
+            "openCount": membership.open_count,
+            "assignedCount": membership.assigned_count,
+            "lastActivity": max(
+                filter(
+                    None, [membership.project.date_modified, membership.last_bug_change]
+                )
+            ),
+        }
+        for membership in memberships
+    ]
+
+
+def getHome(user):
+    # every change to a project bumps its revision, and joining or leaving
+    # one changes the list, so the key moves whenever the result could
+    revisions = fanout(
+        lambda alias: list(
+            Membership.objects.live()
+            .filter(user=user)
+            .order_by("project_id")
+            .values_list("project__project_id", "project__revision")
+        )
+    )
+    digest = hashlib.sha1(repr(revisions).encode()).hexdigest()
+    key = f"home:{user.pk}:{digest}"
+    home = cache.get(key)
+    if home is None:
+        home = computeHome(user)
+        cache.set(key, home, STATS_TIMEOUT)
+    return home
@@ -0,0 +1,235 @@
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Avg, Count, F, Max, Q, Sum
+from django.utils import timezone
+
+from .log import logError, logger
+from .models import Attachment, Project, ProjectShard, Task, User
+from .routers import using
+
+# task functions by name, filled by the task decorator
+registry = {}
+
+
+def task(name, retries=3, backoff=10):
+    """
+    Register function as the task name. A failed run is retried up to
+    retries times, backoff * 2 ** attempt seconds later.
+    """
+
+    def decorator(function):
+        function.retries = retries
+        function.backoff = backoff
+        registry[name] = function
+        return function
+
+    return decorator
+
+
+def enqueue(name, payload=None, key=None, delay=0):
+    """
+    Store a task for the worker and return right away. With a key, a task
+    still pending under the same key is updated instead of adding another.
+    """
+    if name not in registry:
+        raise ValueError(f"unknown task {name}")
+    payload = payload or {}
+    run_after = timezone.now() + timedelta(seconds=delay)
+    if key is not None:
+        updated = Task.objects.filter(key=key, status="PND").update(
+            payload=payload, run_after=run_after, date_modified=timezone.now()
+        )
+        if updated:
+            return
+    try:
+        with transaction.atomic(using="default"):
+            Task.objects.create(
+                name=name, payload=payload, key=key, run_after=run_after
+            )
+    except IntegrityError:
+        # enqueued by someone else in the meantime, which is just as good
+        pass
+
+
+def claim(batch_size):
+    # tasks left running longer than TASK_TIMEOUT belong to a worker that
+    # died and are taken over
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.TASK_TIMEOUT)
+    with transaction.atomic(using="default"):
+        tasks = list(
+            Task.objects.select_for_update(skip_locked=True)
+            .filter(
+                Q(status="PND", run_after__lte=now)
+                | Q(status="RUN", date_modified__lt=stale)
+            )
+            .order_by("run_after", "id")[:batch_size]
+        )
+        # a task that keeps stopping its worker, like an image too large to
+        # decode, fails once it used its runs like one that raises
+        exhausted = [
+            task.id
+            for task in tasks
+            if task.status == "RUN"
+            and task.attempts > getattr(registry.get(task.name), "retries", 0)
+        ]
+        Task.objects.filter(id__in=exhausted).update(
+            status="FAI",
+            error=f"not done within {settings.TASK_TIMEOUT} seconds",
+            date_modified=now,
+        )
+        tasks = [task for task in tasks if task.id not in exhausted]
+        Task.objects.filter(id__in=[task.id for task in tasks]).update(
+            status="RUN", attempts=F("attempts") + 1, date_modified=now
+        )
+    for task in tasks:
+        task.attempts += 1
+    return tasks
+
+
+def run(task):
+    function = registry.get(task.name)
+    start = time.perf_counter()
+    try:
+        if function is None:
+            raise LookupError(f"unknown task {task.name}")
+        function(**task.payload)
+    except Exception as error:
+        seconds = time.perf_counter() - start
+        logError(error)
+        retries = getattr(function, "retries", 0)
+        if task.attempts <= retries:
+            delay = function.backoff * 2 ** (task.attempts - 1)
+            try:
+                with transaction.atomic(using="default"):
+                    Task.objects.filter(id=task.id).update(
+                        status="PND",
+                        run_after=timezone.now() + timedelta(seconds=delay),
+                        error=traceback.format_exc(),
+                        seconds=seconds,
+                    )
+            except IntegrityError:
+                # the same key was enqueued again meanwhile, that run covers
+                # this one
+                Task.objects.filter(id=task.id).update(status="DON")
+        else:
+            Task.objects.filter(id=task.id).update(
+                status="FAI", error=traceback.format_exc(), seconds=seconds
+            )
+        return False
+
+    seconds = time.perf_counter() - start
+    Task.objects.filter(id=task.id).update(status="DON", error="", seconds=seconds)
+    logger.info("task %s", task.name, extra={"duration": round(seconds * 1000, 2)})
+    return True
+
+
+def runPending(batch_size=10):
+    tasks = claim(batch_size)
+    for task in tasks:
+        run(task)
+    return len(tasks)
+
+
+def cleanUp(days=7):
+    before = timezone.now() - timedelta(days=days)
+    return Task.objects.filter(status="DON", date_modified__lt=before).delete()[0]
+
+
+def queueStats():
+    """
+    Count the tasks of each name by status, with the retries and the run
+    durations of all workers, over the tasks kept since the last cleanUp.
+    """
+    stats = {}
+    rows = (
+        Task.objects.values("name", "status")
+        .annotate(
+            count=Count("id"),
+            retries=Sum("attempts") - Count("id", filter=Q(attempts__gt=0)),
+            mean=Avg("seconds"),
+            longest=Max("seconds"),
+        )
+        .order_by("name", "status")
+    )
+    for row in rows:
+        stats.setdefault(row["name"], {})[row["status"]] = {
+            "count": row["count"],
+            "retries": row["retries"] or 0,
+            "seconds": row["mean"],
+            "maxSeconds": row["longest"],
+        }
+    return stats
+
+
+@task("delete_files")
+def deleteFiles(names):
+    storage = Attachment._meta.get_field("file").storage
+    for name in names:
+        storage.delete(name)
+
+
+@task("refresh_profile")
+def refreshProfile(user, profile):
+    user = User.objects.get(pk=user)
+    changed = [key for key, value in profile.items() if getattr(user, key) != value]
+    if changed:
+        for key in changed:
+            setattr(user, key, profile[key])
+        user.save(update_fields=changed + ["date_modified"])
+
+
+@task("purge_project", retries=5)
+def purgeDeletedProject(project_id):
+    from .purge import purgeDeleted
+
+    database = (
+        ProjectShard.objects.filter(project_id=project_id)
+        .values_list("database", flat=True)
+        .first()
+        or "default"
+    )
+    project = (
+        Project.objects.using(database)
+        .filter(project_id=project_id, date_deleted__isnull=False)
+        .first()
+    )
+    if project is not None:
+        purgeDeleted(project)
+
+
+@task("make_preview", retries=2)
+def makeAttachmentPreview(database, attachment):
+    from .previews import makePreview
+
+    attachment = (
+        Attachment.objects.using(database)
+        .select_related("bug__project")
+        .filter(id=attachment, preview="")
+        .first()
+    )
+    if attachment is None:
+        return
+    preview = makePreview(attachment)
+    if preview is None:
+        return
+    content, extension, content_type = preview
+    storage = attachment.preview.storage
+    name = storage.save(f"{attachment.file.name}.preview.{extension}", content)
+    updated = (
+        Attachment.objects.using(database)
+        .filter(id=attachment.id, preview="")
+        .update(preview=name, preview_type=content_type)
+    )
+    if not updated:
+        # removed, or previewed by another run, meanwhile
+        storage.delete(name)
+        return
+    # cached bugs list the preview only once they are rebuilt
+    with using(database):
+        attachment.bug.touch()
+        attachment.bug.project.touch()
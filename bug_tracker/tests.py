@@ -1,3 +1,1549 @@
-from django.test import TestCase
+import io
+import json
+import logging
+import queue
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import jwt
+import requests
+from django.conf import settings
+from django.core import mail
+from django.core.mail import get_connection
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connections
+from django.http import HttpResponse
+from django.test import (
+    Client,
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .coalesce import SingleFlight
+from .management.commands.smtp_stub import Server
+from .fragments import FragmentCache, fragments
+from .log import JsonFormatter, TracebackQueueHandler
+from .ids import PROJECT_ALPHABET, Allocator, encode, saveWithId
+from .outbound import CircuitBreaker, CircuitOpen, Outbound, outbound
+from .models import (
+    Assignment,
+    Attachment,
+    Bug,
+    Mark,
+    Membership,
+    Notification,
+    NotificationPreference,
+    Project,
+    ProjectShard,
+    Tag,
+    Task,
+    User,
+)
+from .notifications import notify, sendDigests
+from .tasks import (
+    claim,
+    enqueue,
+    makeAttachmentPreview,
+    queueStats,
+    registry,
+    run,
+    task,
+)
+from .views import project_flights
+from .policy import RULES, can, canNominate, canOnBug, canRemove, requires
+from .serializers import getBugShell, getProject
+from .routers import (
+    ReplicaRouter,
+    Routing,
+    current,
+    fanout,
+    pickReplica,
+    routing,
+    shard_map,
+    using,
+)
+
+
+def createUser(number):
+    return User.objects.create(
+        user_id=f"u{number:05}",
+        auth_id=f"test|{number}",
+        email=f"user{number}@example.com",
+        first_name=f"First{number}",
+        last_name=f"Last{number}",
+        picture=f"https://example.com/{number}.png",
+    )
+
+
+def clientFor(user):
+    # signed in the way Authenticate leaves a session after checking a token
+    client = Client()
+    session = client.session
+    session["user_id"] = user.user_id
+    session.save()
+    client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+    return client
+
+
+def userQueries(queries):
+    return [query for query in queries if "bug_tracker_user" in query["sql"]]
+
+
+@override_settings(DATABASE_REPLICAS=["replica0"])
+class ReplicaRoutingTests(TransactionTestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user = createUser(1)
+        self.client = clientFor(self.user)
+
+    def request(self, method, path, **kwargs):
+        with CaptureQueriesContext(
+            connections["default"]
+        ) as primary, CaptureQueriesContext(connections["replica0"]) as replica:
+            response = getattr(self.client, method)(path, **kwargs)
+        return response, userQueries(primary), userQueries(replica)
+
+    def test_get_reads_from_replica(self):
+        response, primary, replica = self.request(
+            "get", f"/profile-get?userId={self.user.user_id}"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(replica)
+        self.assertFalse(primary)
+
+    def test_post_reads_from_primary(self):
+        response, primary, replica = self.request(
+            "post",
+            "/notification-preferences",
+            data={"window": 5},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(primary)
+        self.assertFalse(replica)
+
+    def test_get_after_write_sticks_to_primary(self):
+        self.client.post(
+            "/notification-preferences",
+            data={"window": 5},
+            content_type="application/json",
+        )
+        response, primary, replica = self.request(
+            "get", f"/profile-get?userId={self.user.user_id}"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(primary)
+        self.assertFalse(replica)
+
+    @override_settings(DATABASE_REPLICAS=["replica0", "replica1", "replica2"])
+    def test_request_reads_from_one_replica(self):
+        router = ReplicaRouter()
+        for _ in range(10):
+            state = Routing(replica=pickReplica())
+            token = routing.set(state)
+            try:
+                reads = {router.db_for_read(User) for _ in range(20)}
+            finally:
+                routing.reset(token)
+            self.assertEqual(reads, {state.replica})
+
+    def test_without_request_reads_from_primary(self):
+        self.assertEqual(ReplicaRouter().db_for_read(User), "default")
+
+
+ROLES = ["ADM", "DIR", "CON", "SPE"]
+
+# action: whether an administrator, director, contributor, spectator may
+PERMISSION_TABLE = {
+    "project.view": (True, True, True, True),
+    "project.edit": (True, True, False, False),
+    "project.delete": (True, False, False, False),
+    "member.add": (True, True, False, False),
+    "member.remove": (True, True, False, False),
+    "member.authorize": (True, True, False, False),
+    "tag.create": (True, True, True, False),
+    "tag.remove": (True, True, False, False),
+    "bug.report": (True, True, True, False),
+    "bug.edit": (True, True, True, False),
+    "bug.tag": (True, True, True, False),
+    "bug.assign": (True, True, False, False),
+    "bug.attach": (True, True, True, False),
+    "attachment.remove": (True, True, True, False),
+}
+
+# (requester, subject, new role) allowed, every other combination is refused
+NOMINATION_TABLE = {
+    *(("ADM", subject, role) for subject in ROLES for role in ROLES if role != subject),
+    ("DIR", "CON", "SPE"),
+    ("DIR", "SPE", "CON"),
+}
+
+# (requester, subject) allowed, every other combination is refused
+REMOVAL_TABLE = {
+    *(("ADM", subject) for subject in ROLES),
+    ("DIR", "CON"),
+    ("DIR", "SPE"),
+}
+
+
+class PolicyTests(SimpleTestCase):
+    def test_table_covers_every_action(self):
+        self.assertEqual(set(PERMISSION_TABLE), set(RULES))
+
+    def test_can(self):
+        for action, allowed in PERMISSION_TABLE.items():
+            for role, expected in zip(ROLES, allowed):
+                with self.subTest(action=action, role=role):
+                    self.assertIs(can(role, action), expected)
+
+    def test_can_nominate(self):
+        for requester in ROLES:
+            for subject in ROLES:
+                for role in ROLES:
+                    with self.subTest(requester=requester, subject=subject, role=role):
+                        self.assertIs(
+                            canNominate(requester, subject, role),
+                            (requester, subject, role) in NOMINATION_TABLE,
+                        )
+
+    def test_can_remove(self):
+        for requester in ROLES:
+            for subject in ROLES:
+                with self.subTest(requester=requester, subject=subject):
+                    self.assertIs(
+                        canRemove(requester, subject),
+                        (requester, subject) in REMOVAL_TABLE,
+                    )
+
+    def test_unknown_action(self):
+        with self.assertRaises(ValueError):
+            requires("project.rename")
+
+
+def allowed(request):
+    return HttpResponse(request.membership.authorization)
+
+
+class RequiresTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = createUser(1)
+        self.project = Project.objects.create(
+            title="Project", description="", creator=self.user, project_id="p000000001"
+        )
+
+    def call(self, action, user, project_id="p000000001", method="get"):
+        path = "/" if project_id is None else f"/?projectId={project_id}"
+        request = getattr(self.factory, method)(path)
+        request.user = user
+        return requires(action)(allowed)(request)
+
+    def test_roles(self):
+        for number, role in enumerate(ROLES, start=2):
+            user = createUser(number)
+            Membership.objects.create(
+                user=user, project=self.project, authorization=role
+            )
+            for action, permitted in PERMISSION_TABLE.items():
+                with self.subTest(action=action, role=role):
+                    response = self.call(action, user)
+                    if permitted[ROLES.index(role)]:
+                        self.assertEqual(response.status_code, 200)
+                        self.assertEqual(response.content.decode(), role)
+                    else:
+                        self.assertEqual(response.status_code, 403)
+
+    def test_without_project_id(self):
+        self.assertEqual(self.call("project.view", self.user, None).status_code, 400)
+
+    def test_non_member(self):
+        response = self.call("project.view", self.user)
+        self.assertEqual(response.status_code, 404)
+
+    def test_unknown_project(self):
+        Membership.objects.create(
+            user=self.user, project=self.project, authorization="ADM"
+        )
+        response = self.call("project.view", self.user, "p000000002")
+        self.assertEqual(response.status_code, 404)
+
+    def test_deleted_project(self):
+        Membership.objects.create(
+            user=self.user, project=self.project, authorization="ADM"
+        )
+        Project.objects.filter(pk=self.project.pk).update(date_deleted=timezone.now())
+        for action in PERMISSION_TABLE:
+            with self.subTest(action=action):
+                self.assertEqual(self.call(action, self.user).status_code, 404)
+
+
+def createProject(user, database, project_id):
+    with using(database):
+        project = Project.objects.create(
+            title=f"Project {project_id}",
+            description="",
+            creator=user,
+            project_id=project_id,
+        )
+        Membership.objects.create(user=user, project=project, authorization="ADM")
+    ProjectShard.objects.create(project_id=project_id, database=database)
+    return project
+
+
+def createBug(project, reporter, index, **fields):
+    with using(project._state.db):
+        return Bug.objects.create(
+            index=index,
+            title=f"Bug {index}",
+            description="",
+            reporter=reporter,
+            project=project,
+            **fields,
+        )
+
+
+class ShardingTests(TransactionTestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user = createUser(1)
+
+    def test_project_create_places_project_on_shard(self):
+        with mock.patch("bug_tracker.views.pickShard", return_value="shard0"):
+            response = clientFor(self.user).post(
+                "/project-create",
+                data={"title": "Project", "description": ""},
+                content_type="application/json",
+            )
+        self.assertEqual(response.status_code, 302)
+        entry = ProjectShard.objects.get()
+        self.assertEqual(entry.database, "shard0")
+        self.assertEqual(shard_map.get(entry.project_id), ("shard0", False))
+        for database in settings.DATABASE_SHARDS:
+            projects = Project.objects.using(database)
+            memberships = Membership.objects.using(database)
+            self.assertEqual(projects.exists(), database == "shard0")
+            self.assertEqual(memberships.exists(), database == "shard0")
+
+    def test_rows_follow_the_shard(self):
+        project = createProject(self.user, "shard1", "p000000001")
+        with using("shard1"):
+            Tag.objects.create(
+                title="Tag",
+                creator=self.user,
+                project=project,
+                text_color="#000000",
+                background_color="#ffffff",
+                border_color="#000000",
+            )
+        self.assertTrue(Tag.objects.using("shard1").exists())
+        self.assertFalse(Tag.objects.using("default").exists())
+        # an instance is saved back to the shard it was read from
+        tag = Tag.objects.using("shard1").get()
+        tag.title = "Renamed"
+        tag.save()
+        self.assertEqual(Tag.objects.using("shard1").get().title, "Renamed")
+        # users are global
+        self.assertEqual(User.objects.using("default").count(), 1)
+
+    def test_fanout(self):
+        for number, database in enumerate(settings.DATABASE_SHARDS):
+            createProject(self.user, database, f"p{number:09}")
+        results = fanout(
+            lambda alias: (
+                alias,
+                current(),
+                list(Project.objects.values_list("project_id", flat=True)),
+            )
+        )
+        self.assertEqual(
+            results,
+            [
+                (database, database, [f"p{number:09}"])
+                for number, database in enumerate(settings.DATABASE_SHARDS)
+            ],
+        )
+
+    def test_fanouts_run_at_once(self):
+        # every call but the first shard's waits for the other fan-out
+        barrier = threading.Barrier(2 * (len(settings.DATABASE_SHARDS) - 1), timeout=5)
+
+        def wait(alias):
+            if alias != settings.DATABASE_SHARDS[0]:
+                barrier.wait()
+            return alias
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(fanout(wait)))
+            for _ in range(2)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [settings.DATABASE_SHARDS] * 2)
+
+    def test_fanout_keeps_connections(self):
+        def connection(alias):
+            Project.objects.exists()
+            return connections[alias].connection
+
+        first, second = fanout(connection), fanout(connection)
+        self.assertEqual(first[1:], second[1:])
+        self.assertTrue(all(first))
+
+    def test_move_project(self):
+        project = createProject(self.user, "shard0", "p000000001")
+        other = createUser(2)
+        with using("shard0"):
+            membership = Membership.objects.create(
+                user=other, project=project, authorization="CON"
+            )
+            tag = Tag.objects.create(
+                title="Tag",
+                creator=self.user,
+                project=project,
+                text_color="#000000",
+                background_color="#ffffff",
+                border_color="#000000",
+            )
+            for index in range(1, 4):
+                bug = Bug.objects.create(
+                    index=index,
+                    title=f"Bug {index}",
+                    description="",
+                    reporter=self.user,
+                    project=project,
+                )
+                Mark.objects.create(bug=bug, tag=tag, creator=self.user)
+                Assignment.objects.create(bug=bug, membership=membership)
+
+        def snapshot(database):
+            with using(database):
+                return {
+                    "projects": list(
+                        Project.objects.values_list("project_id", "title")
+                    ),
+                    "memberships": sorted(
+                        Membership.objects.values_list("user_id", "authorization")
+                    ),
+                    "tags": list(Tag.objects.values_list("title", flat=True)),
+                    "bugs": sorted(Bug.objects.values_list("index", "title")),
+                    "marks": sorted(
+                        Mark.objects.values_list("bug__index", "tag__title")
+                    ),
+                    "assignments": sorted(
+                        Assignment.objects.values_list(
+                            "bug__index", "membership__user_id"
+                        )
+                    ),
+                }
+
+        before = snapshot("shard0")
+        call_command(
+            "move_project", "p000000001", "shard1", wait=0, stdout=io.StringIO()
+        )
+
+        self.assertEqual(snapshot("shard1"), before)
+        self.assertEqual(snapshot("shard0"), {name: [] for name in before})
+        entry = ProjectShard.objects.get(project_id="p000000001")
+        self.assertEqual((entry.database, entry.frozen), ("shard1", False))
+
+
+class BugReportTests(TestCase):
+    def setUp(self):
+        self.user = createUser(1)
+        self.project = createProject(self.user, "default", "p000000001")
+        self.client = clientFor(self.user)
+
+    def report(self, data):
+        return self.client.post(
+            "/bug-report?projectId=p000000001",
+            data=data,
+            content_type="application/json",
+        )
+
+    def test_report(self):
+        response = self.report({"title": "Bug", "description": "", "impact": 3})
+        self.assertEqual(response.status_code, 201)
+        bug = Bug.objects.get()
+        self.assertEqual((bug.index, bug.status, bug.impact), (1, "OPN", 3))
+        self.assertEqual(bug.reporter, self.user)
+
+    def test_fields_set_by_the_server(self):
+        for field, value in [
+            ("reporter_id", createUser(2).id),
+            ("status", "CLO"),
+            ("version", 7),
+            ("index", 500),
+            ("priority", 1),
+            ("project_id", self.project.pk),
+        ]:
+            with self.subTest(field=field):
+                response = self.report(
+                    {"title": "Bug", "description": "", field: value}
+                )
+                self.assertEqual(response.status_code, 400)
+        self.assertFalse(Bug.objects.exists())
+
+    def test_multipart_fields_set_by_the_server(self):
+        for field, value in [("status", "CLO"), ("index", 500), ("comment", "")]:
+            with self.subTest(field=field):
+                response = self.client.post(
+                    "/bug-report?projectId=p000000001",
+                    data={"title": "Bug", "description": "", field: value},
+                )
+                self.assertEqual(response.status_code, 400)
+        self.assertFalse(Bug.objects.exists())
+
+    def test_multipart_report(self):
+        response = self.client.post(
+            "/bug-report?projectId=p000000001",
+            data={
+                "title": "Bug",
+                "description": "",
+                "reproducible": "false",
+                "log": SimpleUploadedFile("log.txt", b"first\n"),
+            },
+        )
+        self.assertEqual(response.status_code, 201)
+        bug = Bug.objects.get()
+        self.assertFalse(bug.reproducible)
+        self.assertEqual(bug.attachments.count(), 1)
+
+
+class DigestTests(TransactionTestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.actor = createUser(1)
+        self.reporter = createUser(2)
+        self.assignee = createUser(3)
+        self.project = createProject(self.actor, "shard0", "p000000001")
+        with using("shard0"):
+            membership = Membership.objects.create(
+                user=self.assignee, project=self.project, authorization="CON"
+            )
+            self.bug = self.createBug(1)
+            Assignment.objects.create(bug=self.bug, membership=membership)
+        for user in [self.reporter, self.assignee]:
+            NotificationPreference.objects.create(user=user, window=0)
+
+    def createBug(self, index, project=None):
+        return Bug.objects.create(
+            index=index,
+            title=f"Bug {index}",
+            description="",
+            reporter=self.reporter,
+            project=project or self.project,
+        )
+
+    def digests(self):
+        return {message.to[0]: message for message in mail.outbox}
+
+    def test_assignment(self):
+        notify("ASG", self.actor, self.bug, self.project, [self.assignee.id])
+        self.assertEqual(sendDigests(), 1)
+        message = self.digests()["user3@example.com"]
+        self.assertEqual(message.subject, "BugPen: 1 update")
+        self.assertEqual(
+            message.body,
+            "Project p000000001 #1 Bug 1: assigned to you by First1 Last1",
+        )
+        # sent once
+        self.assertEqual(sendDigests(), 0)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_change_reaches_reporter_and_assignees(self):
+        notify("CHG", self.actor, self.bug, self.project, changes=["title"])
+        notify("CHG", self.actor, self.bug, self.project, changes=["status"])
+        self.assertEqual(sendDigests(), 2)
+        digests = self.digests()
+        self.assertEqual(set(digests), {"user2@example.com", "user3@example.com"})
+        self.assertEqual(digests["user2@example.com"].subject, "BugPen: 2 updates")
+        self.assertEqual(
+            digests["user2@example.com"].body.splitlines(),
+            [
+                "Project p000000001 #1 Bug 1: title changed by First1 Last1",
+                "Project p000000001 #1 Bug 1: status changed by First1 Last1",
+            ],
+        )
+
+    def test_window(self):
+        NotificationPreference.objects.filter(user=self.assignee).update(window=60)
+        notify("ASG", self.actor, self.bug, self.project, [self.assignee.id])
+        self.assertEqual(sendDigests(), 0)
+        Notification.objects.update(date_created=timezone.now() - timedelta(minutes=61))
+        self.assertEqual(sendDigests(), 1)
+
+    def test_switched_off(self):
+        NotificationPreference.objects.filter(user=self.assignee).update(
+            assignments=False
+        )
+        notify("ASG", self.actor, self.bug, self.project, [self.assignee.id])
+        self.assertEqual(sendDigests(), 0)
+        self.assertEqual(mail.outbox, [])
+        self.assertFalse(Notification.objects.filter(date_sent__isnull=True).exists())
+
+    def test_move_project(self):
+        # the copy of the bug gets another id than on shard0
+        other = createProject(self.actor, "shard1", "p000000002")
+        with using("shard1"):
+            self.createBug(1, other)
+        notify("CHG", self.actor, self.bug, self.project, changes=["title"])
+        call_command(
+            "move_project", "p000000001", "shard1", wait=0, stdout=io.StringIO()
+        )
+
+        with using("shard1"):
+            moved = Bug.objects.get(project__project_id="p000000001")
+        self.assertNotEqual(moved.id, self.bug.id)
+        self.assertEqual(
+            list(Notification.objects.values_list("bug_id", flat=True)), [moved.id]
+        )
+        self.assertEqual(sendDigests(), 2)
+        self.assertEqual(
+            set(self.digests()), {"user2@example.com", "user3@example.com"}
+        )
+
+    def test_smtp(self):
+        received = []
+        server = Server(("127.0.0.1", 0), received.append)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+
+        notify("ASG", self.actor, self.bug, self.project, [self.assignee.id])
+        connection = get_connection(
+            "django.core.mail.backends.smtp.EmailBackend",
+            host="127.0.0.1",
+            port=server.server_address[1],
+            username="",
+            password="",
+            use_tls=False,
+            use_ssl=False,
+        )
+        self.assertEqual(sendDigests(connection=connection), 1)
+        [message] = received
+        lines = message.splitlines()
+        self.assertTrue(lines[0].endswith(" to <user3@example.com>"))
+        self.assertIn("Subject: BugPen: 1 update", lines)
+        self.assertIn(
+            "Project p000000001 #1 Bug 1: assigned to you by First1 Last1", lines
+        )
+
+    def test_failed_digest_sent_next_run(self):
+        notify("CHG", self.actor, self.bug, self.project, changes=["title"])
+        connection = mail.get_connection()
+        send = connection.send_messages
+        calls = []
+
+        def failSecond(messages):
+            calls.append(messages)
+            if len(calls) == 2:
+                raise ConnectionError("connection lost")
+            return send(messages)
+
+        with mock.patch.object(connection, "send_messages", failSecond):
+            self.assertEqual(sendDigests(connection=connection), 1)
+        [first] = mail.outbox
+        # only the digest that was not sent goes out again
+        self.assertEqual(sendDigests(), 1)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertNotEqual(mail.outbox[1].to, first.to)
+        self.assertEqual(sendDigests(), 0)
+
+    def test_claimed_notifications_skipped(self):
+        notify("ASG", self.actor, self.bug, self.project, [self.assignee.id])
+        connection = mail.get_connection()
+        send = connection.send_messages
+
+        def sendTwice(messages):
+            # another digest process running while this one sends
+            self.assertEqual(sendDigests(), 0)
+            return send(messages)
+
+        with mock.patch.object(connection, "send_messages", sendTwice):
+            self.assertEqual(sendDigests(connection=connection), 1)
+        self.assertEqual(len(mail.outbox), 1)
+
+
+class PreviewTests(TransactionTestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user = createUser(1)
+        self.project = createProject(self.user, "shard0", "p000000001")
+        self.bug = createBug(self.project, self.user, 1)
+        # rows on default with the same primary keys, which must stay as is
+        with using("default"):
+            Project.objects.create(
+                id=self.project.id,
+                title="Other",
+                description="",
+                creator=self.user,
+                project_id="p000000002",
+            )
+        self.other = Project.objects.using("default").get()
+        self.other_bug = createBug(self.other, self.user, 1, id=self.bug.id)
+
+    def test_preview_on_shard(self):
+        with using("shard0"):
+            attachment = Attachment.objects.create(
+                title="log.txt",
+                bug=self.bug,
+                creator=self.user,
+                file=ContentFile(b"first\nsecond\n", name="log.txt"),
+                content_type="text/plain",
+                size=13,
+            )
+        makeAttachmentPreview("shard0", attachment.id)
+
+        attachment = Attachment.objects.using("shard0").get()
+        self.assertEqual(attachment.preview.read(), b"first\nsecond")
+        project = Project.objects.using("shard0").get()
+        bug = Bug.objects.using("shard0").get()
+        self.assertEqual(project.revision, self.project.revision + 1)
+        self.assertGreater(bug.date_modified, self.bug.date_modified)
+
+        other = Project.objects.using("default").get()
+        other_bug = Bug.objects.using("default").get()
+        self.assertEqual(other.revision, self.other.revision)
+        self.assertEqual(other_bug.date_modified, self.other_bug.date_modified)
+
+
+def waitUntil(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.001)
+
+
+def waiting(flights, key):
+    # callers blocked on the build of key in flight
+    return len(flights.calls[key].done._cond._waiters)
+
+
+class Interrupted(BaseException):
+    # like gevent's Timeout or GreenletExit
+    pass
+
+
+class SingleFlightTests(SimpleTestCase):
+    def test_concurrent_callers_share_one_build(self):
+        flights = SingleFlight(ttl=0)
+        started, release = threading.Event(), threading.Event()
+        builds = []
+
+        def build():
+            builds.append(1)
+            started.set()
+            release.wait(5)
+            return b"built"
+
+        results = []
+        leader = threading.Thread(
+            target=lambda: results.append(flights.do("key", build))
+        )
+        leader.start()
+        started.wait(5)
+        waiters = [
+            threading.Thread(target=lambda: results.append(flights.do("key", build)))
+            for _ in range(4)
+        ]
+        for waiter in waiters:
+            waiter.start()
+        waitUntil(lambda: waiting(flights, "key") == 4)
+        release.set()
+        for thread in [leader, *waiters]:
+            thread.join()
+        self.assertEqual(results, [b"built"] * 5)
+        self.assertEqual(len(builds), 1)
+
+    def test_result_reused_for_ttl(self):
+        flights = SingleFlight(ttl=60)
+        builds = []
+        for _ in range(3):
+            flights.do("key", lambda: builds.append(1) or len(builds))
+        self.assertEqual(len(builds), 1)
+
+    def test_failed_build_not_reused(self):
+        flights = SingleFlight(ttl=60)
+
+        def fail():
+            raise ValueError("failed")
+
+        with self.assertRaises(ValueError):
+            flights.do("key", fail)
+        self.assertEqual(flights.do("key", lambda: b"built"), b"built")
+
+    def test_interrupted_build_not_reused(self):
+        flights = SingleFlight(ttl=60)
+        started, release = threading.Event(), threading.Event()
+
+        def interrupted():
+            started.set()
+            release.wait(5)
+            raise Interrupted()
+
+        errors = []
+
+        def lead():
+            try:
+                flights.do("key", interrupted)
+            except BaseException as error:
+                errors.append(error)
+
+        def wait():
+            try:
+                flights.do("key", interrupted)
+            except Exception as error:
+                errors.append(error)
+
+        leader = threading.Thread(target=lead)
+        leader.start()
+        started.wait(5)
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        waitUntil(lambda: waiting(flights, "key") == 1)
+        release.set()
+        leader.join()
+        waiter.join()
+        self.assertEqual(
+            sorted(type(error).__name__ for error in errors),
+            ["Exception", "Interrupted"],
+        )
+        self.assertEqual(flights.do("key", lambda: b"built"), b"built")
+
+
+class ProjectGetTests(TransactionTestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        project_flights.results.clear()
+        self.admin = createUser(1)
+        self.spectator = createUser(2)
+        self.project = createProject(self.admin, "default", "p000000001")
+        Membership.objects.create(
+            user=self.spectator, project=self.project, authorization="SPE"
+        )
+
+    def get(self, user):
+        response = clientFor(user).get("/project-get?projectId=p000000001")
+        self.assertEqual(response.status_code, 200)
+        return response.json()["project"]
+
+    def test_authorization_spliced_into_shared_build(self):
+        with mock.patch("bug_tracker.views.getProject", wraps=getProject) as build:
+            admin, spectator = self.get(self.admin), self.get(self.spectator)
+        self.assertEqual(build.call_count, 1)
+        self.assertEqual(admin["authorization"], "Administrator")
+        self.assertEqual(spectator["authorization"], "Spectator")
+        del admin["authorization"], spectator["authorization"]
+        self.assertEqual(admin, spectator)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def jsonResponse(value, status_code=200):
+    return mock.Mock(status_code=status_code, json=mock.Mock(return_value=value))
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch("bug_tracker.outbound.time.monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(failures=3, reset=30)
+
+    def open(self):
+        for _ in range(3):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.failure()
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        # a success in between starts the count over
+        self.breaker.success()
+        self.breaker.failure()
+        self.breaker.failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.failure()
+        self.assertFalse(self.breaker.allow())
+        self.clock.now += 29
+        self.assertFalse(self.breaker.allow())
+
+    def test_single_trial_after_reset(self):
+        self.open()
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        # one trial at a time
+        self.assertFalse(self.breaker.allow())
+
+    def test_trial_success_closes(self):
+        self.open()
+        self.clock.now += 30
+        self.breaker.allow()
+        self.breaker.success()
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.allow())
+
+    def test_trial_failure_reopens(self):
+        self.open()
+        self.clock.now += 30
+        self.breaker.allow()
+        self.breaker.failure()
+        self.assertFalse(self.breaker.allow())
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+
+
+class OutboundTests(SimpleTestCase):
+    def setUp(self):
+        self.outbound = Outbound()
+        self.outbound.session = mock.Mock()
+        self.get = self.outbound.session.get
+
+    def call(self, max_age=0):
+        return self.outbound.get_json("remote", "https://example.com/", max_age=max_age)
+
+    def test_cached_within_max_age(self):
+        self.get.return_value = jsonResponse({"value": 1})
+        self.assertEqual(self.call(max_age=60), {"value": 1})
+        self.assertEqual(self.call(max_age=60), {"value": 1})
+        self.assertEqual(self.get.call_count, 1)
+
+    def test_falls_back_on_last_good_response(self):
+        self.get.return_value = jsonResponse({"value": 1})
+        self.call()
+        self.get.side_effect = requests.ConnectionError()
+        self.assertEqual(self.call(), {"value": 1})
+        self.get.side_effect = None
+        self.get.return_value = jsonResponse({}, status_code=503)
+        self.get.return_value.raise_for_status.side_effect = requests.HTTPError()
+        self.assertEqual(self.call(), {"value": 1})
+
+    def test_open_circuit(self):
+        self.get.side_effect = requests.ConnectionError()
+        for _ in range(5):
+            with self.assertRaises(requests.ConnectionError):
+                self.call()
+        with self.assertRaises(CircuitOpen):
+            self.call()
+        self.assertEqual(self.get.call_count, 5)
+
+    def test_open_circuit_serves_cache(self):
+        self.get.return_value = jsonResponse({"value": 1})
+        self.call()
+        self.get.side_effect = requests.ConnectionError()
+        for _ in range(5):
+            self.call()
+        self.assertEqual(self.call(), {"value": 1})
+        self.assertEqual(self.get.call_count, 6)
+
+
+class UnknownKeyTests(SimpleTestCase):
+    def setUp(self):
+        outbound.cache.clear()
+        outbound.breakers.clear()
+
+    def test_unknown_key_ids_do_not_refetch_keys(self):
+        with mock.patch.object(
+            outbound.session, "get", return_value=jsonResponse({"keys": []})
+        ) as get:
+            for number in range(20):
+                token = jwt.encode(
+                    {"sub": "test"}, "secret", headers={"kid": f"bogus{number}"}
+                )
+                response = Client().get("/me", HTTP_AUTHORIZATION=f"Bearer {token}")
+                self.assertEqual(response.status_code, 403)
+        self.assertEqual(get.call_count, 1)
+
+
+class TaskQueueTests(TestCase):
+    def setUp(self):
+        self.runs = []
+
+        def record(**payload):
+            self.runs.append(payload)
+
+        def fail(**payload):
+            self.runs.append(payload)
+            raise ValueError("failed")
+
+        task("test_record")(record)
+        task("test_fail", retries=2, backoff=10)(fail)
+        self.addCleanup(registry.pop, "test_record")
+        self.addCleanup(registry.pop, "test_fail")
+
+    def test_claim(self):
+        enqueue("test_record", {"number": 1})
+        enqueue("test_record", {"number": 2}, delay=60)
+        tasks = claim(10)
+        self.assertEqual([task.payload for task in tasks], [{"number": 1}])
+        self.assertEqual(tasks[0].attempts, 1)
+        self.assertEqual(Task.objects.get(id=tasks[0].id).status, "RUN")
+        # claimed tasks are not handed out twice
+        self.assertEqual(claim(10), [])
+
+    def test_run(self):
+        enqueue("test_record", {"number": 1})
+        for claimed in claim(10):
+            self.assertTrue(run(claimed))
+        self.assertEqual(self.runs, [{"number": 1}])
+        finished = Task.objects.get()
+        self.assertEqual(finished.status, "DON")
+        self.assertIsNotNone(finished.seconds)
+
+    def test_unknown_task(self):
+        with self.assertRaises(ValueError):
+            enqueue("test_unknown")
+
+    def test_retry_with_backoff(self):
+        enqueue("test_fail")
+        for attempt, delay in enumerate([10, 20], start=1):
+            [claimed] = claim(10)
+            self.assertEqual(claimed.attempts, attempt)
+            before = timezone.now()
+            self.assertFalse(run(claimed))
+            retried = Task.objects.get()
+            self.assertEqual(retried.status, "PND")
+            self.assertIn("ValueError", retried.error)
+            self.assertGreaterEqual(
+                retried.run_after, before + timedelta(seconds=delay)
+            )
+            self.assertLess(retried.run_after, before + timedelta(seconds=delay + 5))
+            Task.objects.update(run_after=timezone.now())
+        [claimed] = claim(10)
+        self.assertFalse(run(claimed))
+        self.assertEqual(Task.objects.get().status, "FAI")
+        self.assertEqual(len(self.runs), 3)
+
+    def test_key_deduplication(self):
+        enqueue("test_record", {"number": 1}, key="record")
+        enqueue("test_record", {"number": 2}, key="record")
+        self.assertEqual(
+            list(Task.objects.values_list("payload", flat=True)), [{"number": 2}]
+        )
+        # a running task does not hold its key
+        claim(10)
+        enqueue("test_record", {"number": 3}, key="record")
+        self.assertEqual(
+            sorted(Task.objects.values_list("status", flat=True)), ["PND", "RUN"]
+        )
+
+    def test_stale_takeover(self):
+        enqueue("test_fail")
+        claim(10)
+        stale = timezone.now() - timedelta(seconds=settings.TASK_TIMEOUT + 1)
+        Task.objects.update(date_modified=stale)
+        [claimed] = claim(10)
+        self.assertEqual(claimed.attempts, 2)
+        Task.objects.update(date_modified=stale)
+        self.assertEqual(len(claim(10)), 1)
+
+        # the worker stopped during its last allowed run too
+        Task.objects.update(date_modified=stale)
+        self.assertEqual(claim(10), [])
+        failed = Task.objects.get()
+        self.assertEqual((failed.status, failed.attempts), ("FAI", 3))
+        self.assertEqual(self.runs, [])
+
+    def test_stats(self):
+        enqueue("test_record")
+        enqueue("test_fail")
+        enqueue("test_fail", delay=60)
+        for claimed in claim(10):
+            run(claimed)
+        stats = queueStats()
+        self.assertEqual(stats["test_record"]["DON"]["count"], 1)
+        self.assertEqual(stats["test_fail"]["PND"]["count"], 2)
+        self.assertEqual(stats["test_fail"]["PND"]["retries"], 0)
+        self.assertIsNotNone(stats["test_record"]["DON"]["seconds"])
+
+        output = io.StringIO()
+        call_command("run_tasks", stats=True, stdout=output)
+        self.assertEqual(json.loads(output.getvalue()), stats)
+
+
+class EditTests(TransactionTestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user = createUser(1)
+        self.project = createProject(self.user, "default", "p000000001")
+        self.bug = createBug(self.project, self.user, 1, impact=2, urgency=3)
+        self.client = clientFor(self.user)
+
+    def post(self, path, data):
+        with CaptureQueriesContext(connections["default"]) as queries:
+            response = self.client.post(
+                f"{path}?projectId=p000000001&bugId={self.bug.id}",
+                data=data,
+                content_type="application/json",
+            )
+        return response, [
+            query["sql"] for query in queries if query["sql"].startswith("UPDATE")
+        ]
+
+    def test_project_edit_is_one_update(self):
+        response, updates = self.post(
+            "/project-edit", {"title": "Renamed", "version": 0}
+        )
+        self.assertEqual(response.status_code, 302)
+        [update] = [sql for sql in updates if "bug_tracker_project" in sql]
+        self.assertIn('"title"', update)
+        self.assertNotIn('"description"', update)
+        project = Project.objects.get()
+        self.assertEqual(
+            (project.title, project.version, project.revision),
+            ("Renamed", 1, self.project.revision + 1),
+        )
+
+    def test_project_edit_conflict(self):
+        self.post("/project-edit", {"title": "First", "version": 0})
+        response, updates = self.post(
+            "/project-edit", {"description": "Second", "version": 0}
+        )
+        self.assertEqual(response.status_code, 409)
+        body = response.json()
+        self.assertEqual(body["error"], "version conflict")
+        self.assertEqual(body["project"]["title"], "First")
+        self.assertEqual(Project.objects.get().description, "")
+
+    def test_bug_edit_conflict(self):
+        self.post("/bug-edit", {"title": "First", "version": 0})
+        response, _ = self.post("/bug-edit", {"description": "Second", "version": 0})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["bug"]["title"], "First")
+        self.assertEqual(Bug.objects.get().description, "")
+
+    def test_bug_edit_writes_changed_columns(self):
+        response, updates = self.post("/bug-edit", {"title": "Renamed"})
+        self.assertEqual(response.status_code, 302)
+        [update] = [sql for sql in updates if "bug_tracker_bug" in sql]
+        self.assertIn('"title"', update)
+        for column in ["description", "impact", "urgency", "priority", "status"]:
+            self.assertNotIn(f'"{column}"', update)
+
+    def test_priority_recomputed(self):
+        for changes, priority in [
+            ({"impact": 5}, 15),
+            ({"urgency": 1}, 5),
+            ({"impact": 4, "urgency": 4}, 16),
+        ]:
+            with self.subTest(changes=changes):
+                response, _ = self.post("/bug-edit", changes)
+                self.assertEqual(response.status_code, 302)
+                self.assertEqual(Bug.objects.get().priority, priority)
+
+
+class FragmentCacheTests(SimpleTestCase):
+    def size(self, fragment):
+        return len(json.dumps(fragment))
+
+    def test_version_mismatch_misses(self):
+        cache = FragmentCache(max_bytes=1000)
+        cache.set("bug", 1, "v1", {"title": "Bug"})
+        self.assertEqual(cache.get("bug", 1, "v1"), {"title": "Bug"})
+        self.assertIsNone(cache.get("bug", 1, "v2"))
+        cache.set("bug", 1, "v2", {"title": "Renamed"})
+        self.assertEqual(cache.get("bug", 1, "v2"), {"title": "Renamed"})
+        self.assertEqual(cache.size, self.size({"title": "Renamed"}))
+
+    def test_least_recently_used_evicted(self):
+        fragment = {"title": "x" * 10}
+        cache = FragmentCache(max_bytes=3 * self.size(fragment))
+        for id in [1, 2, 3]:
+            cache.set("bug", id, "v", fragment)
+        # 1 is used again, so 2 is the least recently used
+        cache.get("bug", 1, "v")
+        cache.set("bug", 4, "v", fragment)
+        self.assertEqual(list(cache.entries), [("bug", 3), ("bug", 1), ("bug", 4)])
+        self.assertIsNone(cache.get("bug", 2, "v"))
+        self.assertLessEqual(cache.size, cache.max_bytes)
+
+    def test_fragment_larger_than_cache_not_stored(self):
+        cache = FragmentCache(max_bytes=10)
+        fragment = {"title": "x" * 10}
+        self.assertEqual(cache.set("bug", 1, "v", fragment), fragment)
+        self.assertEqual((cache.entries, cache.size), ({}, 0))
+
+
+class FragmentInvalidationTests(TransactionTestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        fragments.clear()
+        project_flights.results.clear()
+        self.user = createUser(1)
+        self.other = createUser(2)
+        # on a shard, where the ids of bugs and tags also exist on default
+        self.project = createProject(self.user, "shard0", "p000000001")
+        with using("shard0"):
+            Membership.objects.create(
+                user=self.other, project=self.project, authorization="CON"
+            )
+            self.tag = Tag.objects.create(
+                title="Tag",
+                creator=self.user,
+                project=self.project,
+                text_color="#000000",
+                background_color="#ffffff",
+                border_color="#000000",
+            )
+        self.bugs = [createBug(self.project, self.user, index) for index in range(1, 4)]
+        self.bug = self.bugs[1]
+        self.client = clientFor(self.user)
+        self.assertEqual(self.serialized(), {bug.id for bug in self.bugs})
+
+    def serialized(self):
+        # ids of the bugs whose shells project-get had to build
+        with mock.patch(
+            "bug_tracker.serializers.getBugShell", wraps=getBugShell
+        ) as build:
+            response = self.client.get("/project-get?projectId=p000000001")
+        self.assertEqual(response.status_code, 200)
+        return {call.args[0].id for call in build.call_args_list}
+
+    def post(self, path, parameters="", **kwargs):
+        response = self.client.post(
+            f"{path}?projectId=p000000001&bugId={self.bug.id}{parameters}", **kwargs
+        )
+        self.assertEqual(response.status_code, 302)
+
+    def test_unchanged_project_not_serialized(self):
+        self.assertEqual(self.serialized(), set())
+
+    def test_bug_edit(self):
+        self.post(
+            "/bug-edit", data={"title": "Renamed"}, content_type="application/json"
+        )
+        self.assertEqual(self.serialized(), {self.bug.id})
+
+    def test_tag_add(self):
+        self.post("/tag-add", f"&tagId={self.tag.id}")
+        self.assertEqual(self.serialized(), {self.bug.id})
+
+    def test_assign(self):
+        self.post("/assign", f"&userId={self.other.user_id}")
+        self.assertEqual(self.serialized(), {self.bug.id})
+
+    def test_attach(self):
+        self.post("/attach", data={"file": SimpleUploadedFile("log.txt", b"first\n")})
+        self.assertEqual(self.serialized(), {self.bug.id})
+
+        attachment = Attachment.objects.using("shard0").get()
+        makeAttachmentPreview("shard0", attachment.id)
+        self.assertEqual(self.serialized(), {self.bug.id})
+        response = self.client.get("/project-get?projectId=p000000001")
+        [bug] = [
+            bug
+            for bug in response.json()["project"]["bugs"]
+            if bug["id"] == self.bug.id
+        ]
+        self.assertIsNotNone(bug["attachments"][0]["preview"])
+
+
+class GenerateDatasetTests(TransactionTestCase):
+    databases = "__all__"
+
+    def generate(self, prefix):
+        call_command(
+            "generate_dataset",
+            users=4,
+            projects=3,
+            members=3,
+            bugs=2,
+            tags=2,
+            attachments=0,
+            seed=0,
+            prefix=prefix,
+            stdout=io.StringIO(),
+        )
+
+    def test_second_dataset_with_same_seed(self):
+        self.generate("first")
+        self.generate("second")
+        entries = ProjectShard.objects.all()
+        self.assertEqual(entries.count(), 6)
+        for entry in entries:
+            with self.subTest(project_id=entry.project_id):
+                self.assertTrue(
+                    Project.objects.using(entry.database)
+                    .filter(project_id=entry.project_id)
+                    .exists()
+                )
+
+
+# role: whether a member may edit, or remove attachments of, a bug they
+# reported, one assigned to them and someone else's
+OWNERSHIP_TABLE = {
+    "ADM": (True, True, True),
+    "DIR": (True, True, True),
+    "CON": (True, True, False),
+    "SPE": (False, False, False),
+}
+
+
+class OwnershipTests(TransactionTestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.admin = createUser(1)
+        self.project = createProject(self.admin, "default", "p000000001")
+        self.members = {"ADM": Membership.objects.get(user=self.admin)}
+        for number, role in enumerate(["DIR", "CON", "SPE"], start=2):
+            self.members[role] = Membership.objects.create(
+                user=createUser(number), project=self.project, authorization=role
+            )
+
+    def bugsOf(self, role):
+        # reported by, assigned to and unrelated to the member of role
+        membership = self.members[role]
+        index = Bug.objects.count()
+        reported = createBug(self.project, membership.user, index + 1)
+        assigned = createBug(self.project, self.admin, index + 2)
+        Assignment.objects.create(bug=assigned, membership=membership)
+        other = createBug(self.project, self.admin, index + 3)
+        if role == "ADM":
+            other.reporter = self.members["DIR"].user
+            other.save()
+        return reported, assigned, other
+
+    def test_can_on_bug(self):
+        for role, allowed in OWNERSHIP_TABLE.items():
+            bugs = self.bugsOf(role)
+            for action in ["bug.edit", "attachment.remove"]:
+                for kind, bug, expected in zip(
+                    ["reported", "assigned", "other"], bugs, allowed
+                ):
+                    with self.subTest(role=role, action=action, bug=kind):
+                        self.assertIs(
+                            canOnBug(self.members[role], action, bug), expected
+                        )
+
+    def test_contributor_cannot_change_others_bugs(self):
+        reported, assigned, other = self.bugsOf("CON")
+        client = clientFor(self.members["CON"].user)
+        for bug, status in [(reported, 302), (assigned, 302), (other, 403)]:
+            attachment = Attachment.objects.create(
+                title="log.txt",
+                bug=bug,
+                creator=self.admin,
+                file=ContentFile(b"log", name="log.txt"),
+                content_type="text/plain",
+                size=3,
+            )
+            query = f"projectId=p000000001&bugId={bug.id}"
+            response = client.post(
+                f"/bug-edit?{query}",
+                data={"title": "Renamed"},
+                content_type="application/json",
+            )
+            self.assertEqual(response.status_code, status)
+            response = client.post(
+                f"/attachment-remove?{query}&attachmentId={attachment.id}"
+            )
+            self.assertEqual(response.status_code, status)
+        self.assertEqual(Bug.objects.get(id=other.id).title, other.title)
+        self.assertEqual(
+            list(Attachment.objects.values_list("bug_id", flat=True)), [other.id]
+        )
+
+
+class BugsTopTests(TransactionTestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user = createUser(1)
+        self.client = clientFor(self.user)
+        self.projects = [
+            createProject(self.user, database, f"p{number:09}")
+            for number, database in enumerate(["default", "shard0", "shard1"])
+        ]
+        for impact, project in enumerate(self.projects, start=1):
+            createBug(project, self.user, 1, impact=impact, urgency=3)
+            createBug(project, self.user, 2, impact=impact, urgency=3, status="CLO")
+
+    def top(self, query="", status=200):
+        response = self.client.get(f"/bugs-top?{query}")
+        self.assertEqual(response.status_code, status)
+        return response.json()["bugs"] if status == 200 else None
+
+    def test_across_shards(self):
+        bugs = self.top()
+        self.assertEqual(
+            [(bug["projectId"], bug["priority"]) for bug in bugs],
+            [("p000000002", 9), ("p000000001", 6), ("p000000000", 3)],
+        )
+        bugs = self.top("limit=1")
+        self.assertEqual([bug["projectId"] for bug in bugs], ["p000000002"])
+
+    def test_project(self):
+        bugs = self.top("projectId=p000000001")
+        self.assertEqual([bug["projectId"] for bug in bugs], ["p000000001"])
+
+    def test_not_member(self):
+        other = createUser(2)
+        createProject(other, "shard0", "p000000009")
+        self.top("projectId=p000000009", status=404)
+
+    def test_deleted_project(self):
+        Project.objects.using("shard1").update(date_deleted=timezone.now())
+        self.top("projectId=p000000002", status=404)
+        bugs = self.top()
+        self.assertEqual(
+            [bug["projectId"] for bug in bugs], ["p000000001", "p000000000"]
+        )
+
+
+class IdTests(TransactionTestCase):
+    def test_encode_collision_free(self):
+        for length, alphabet in [(2, PROJECT_ALPHABET), (10, PROJECT_ALPHABET)]:
+            with self.subTest(length=length):
+                count = min(len(alphabet) ** length - 1, 100000)
+                ids = {encode(number, length, alphabet) for number in range(count)}
+                self.assertEqual(len(ids), count)
+                self.assertEqual({len(id) for id in ids}, {length})
+
+    def test_allocator_blocks_are_disjoint(self):
+        first = Allocator("test", 10, PROJECT_ALPHABET, block=3)
+        second = Allocator("test", 10, PROJECT_ALPHABET, block=3)
+        ids = [allocator.next() for _ in range(4) for allocator in (first, second)]
+        self.assertEqual(len(set(ids)), 8)
+
+    def test_save_with_id_skips_legacy_ids(self):
+        user = createUser(1)
+        allocator = Allocator("test", 10, PROJECT_ALPHABET)
+        # ids that were taken at random before the allocator existed
+        taken = [encode(number, 10, PROJECT_ALPHABET) for number in range(2)]
+        for project_id in taken:
+            Project.objects.create(
+                title="Legacy", description="", creator=user, project_id=project_id
+            )
+        project = Project(title="New", description="", creator=user)
+        saveWithId(project, "project_id", allocator)
+        self.assertEqual(project.project_id, encode(2, 10, PROJECT_ALPHABET))
+        self.assertEqual(Project.objects.get(pk=project.pk).title, "New")
+
+        # all attempts taken
+        project = Project(title="New", description="", creator=user)
+        for number in range(3, 5):
+            Project.objects.create(
+                title="Legacy",
+                description="",
+                creator=user,
+                project_id=encode(number, 10, PROJECT_ALPHABET),
+            )
+        with self.assertRaises(IntegrityError):
+            saveWithId(project, "project_id", allocator, attempts=2)
+
+
+LOGIN_BUG = (
+    "Login button does nothing on mobile",
+    "Tapping the login button on the mobile layout does nothing, no request "
+    "is sent and no error is shown, the session token is never stored",
+)
+
+
+class DuplicateTests(TransactionTestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user = createUser(1)
+        self.project = createProject(self.user, "shard0", "p000000001")
+        self.client = clientFor(self.user)
+        self.bug = self.report(*LOGIN_BUG)["bug"]
+
+    def report(self, title, description):
+        response = self.client.post(
+            "/bug-report?projectId=p000000001",
+            data={"title": title, "description": description},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def duplicates(self, title, description):
+        return [
+            duplicate["id"]
+            for duplicate in self.report(title, description)["duplicates"]
+        ]
+
+    def test_near_identical_is_duplicate(self):
+        title, description = LOGIN_BUG
+        self.assertEqual(
+            self.duplicates(title, description.replace("mobile", "phone")),
+            [self.bug["id"]],
+        )
+
+    def test_unrelated_is_not_duplicate(self):
+        self.assertEqual(
+            self.duplicates(
+                "Export drops archived bugs",
+                "Exporting a project as JSON leaves out every closed bug and "
+                "the attachments of the remaining ones",
+            ),
+            [],
+        )
+
+    def test_bug_edit_reindexes(self):
+        title = "Search filter ignores tags"
+        description = (
+            "Filtering the search results by a tag returns every bug of the "
+            "project, the tag filter is dropped from the query"
+        )
+        response = self.client.post(
+            f"/bug-edit?projectId=p000000001&bugId={self.bug['id']}",
+            data={"title": title, "description": description},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.duplicates(*LOGIN_BUG), [])
+        self.assertEqual(
+            self.duplicates(title, description.replace("project", "board")),
+            [self.bug["id"]],
+        )
+
+
+class LogTests(SimpleTestCase):
+    def test_exception_survives_queue(self):
+        records = queue.SimpleQueue()
+        handler = TracebackQueueHandler(records)
+        logger = logging.getLogger("bug_tracker.tests.queue")
+        logger.addHandler(handler)
+        logger.setLevel(logging.ERROR)
+        logger.propagate = False
+        try:
+            raise ValueError("bad value")
+        except ValueError:
+            logger.error("failed", exc_info=True)
+        finally:
+            logger.removeHandler(handler)
+
+        entry = json.loads(JsonFormatter().format(records.get_nowait()))
+        self.assertEqual(entry["message"], "failed")
+        self.assertIn("ValueError: bad value", entry["exception"])
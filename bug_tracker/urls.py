@@ -4,13 +4,21 @@ from . import views
 urlpatterns = [
     path("project-create", views.project_create),
     path("projects-my", views.projects_my),
+    path("home", views.home),
     path("project-get", views.project_get),
     path("project-edit", views.project_edit),
+    path("project-delete", views.project_delete),
+    path("project-export", views.project_export),
+    path("project-stats", views.project_stats),
     path("bug-report", views.bug_report),
     path("bug-edit", views.bug_edit),
+    path("bugs-top", views.bugs_top),
+    path("bugs-archived", views.bugs_archived),
+    path("bugs-mine", views.bugs_mine),
     path("memberships-count", views.memberships_count),
     path("profiles-search", views.profiles_search),
     path("profile-get", views.profile_get),
+    path("notification-preferences", views.notification_preferences),
     path("member-add", views.member_add),
     path("member-remove", views.member_remove),
     path("member-authorize", views.member_authorize),
@@ -23,5 +31,6 @@ urlpatterns = [
     path("assign-remove", views.assign_remove),
     path("attach", views.attach),
     path("attachment-get", views.attachment_get),
+    path("attachment-preview", views.attachment_preview),
     path("attachment-remove", views.attachment_remove),
 ]
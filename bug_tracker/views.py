@@ -1,7 +1,10 @@
-import random
-import string
+import json
+from datetime import datetime, timedelta
 
-from django.db.models import Max, Q
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Max, Q
 from django.http import (
     FileResponse,
     HttpResponse,
@@ -11,99 +14,50 @@ from django.http import (
     HttpResponseNotFound,
     HttpResponseServerError,
     JsonResponse,
+    StreamingHttpResponse,
 )
 from django.shortcuts import redirect
+from django.utils import timezone
+
+from .coalesce import SingleFlight
+from .duplicates import findDuplicates, indexBugs, minhash
+from .export import streamJson, streamNdjson
+from .ids import project_ids, saveWithId
+from .log import logError
+from .models import (
+    Assignment,
+    Attachment,
+    Bug,
+    Mark,
+    Membership,
+    NotificationPreference,
+    Project,
+    ProjectShard,
+    Tag,
+    User,
+)
+from .notifications import notify
+from .policy import AUTHORIZATIONS, can, canNominate, canOnBug, canRemove, requires
+from .previews import previewKind
+from .routers import current, fanout, pickShard, pinned, shard_map, using
+from .serializers import (
+    BUG_FIELDS,
+    countMemberships,
+    PROJECT_SECTIONS,
+    getBugs,
+    getBugSummary,
+    getDuplicate,
+    getPreferences,
+    getProject,
+    getProjectFields,
+    getProjectNormalized,
+    getUser,
+)
+from .stats import getHome, getProjectStats
+from .tasks import enqueue
 
-from .models import Assignment, Attachment, Bug, Mark, Membership, Project, Tag, User
-
-
-def generate_id(
-    length=10,
-    characters=string.ascii_uppercase + string.digits,
-):
-    return "".join(random.choice(characters) for _ in range(length))
-
-
-def printError(*args, **kwargs):
-    print("ERROR", *args, **kwargs)
-
-
-def getUser(user):
-    return {
-        "id": user.id,
-        "userId": user.user_id,
-        "name": f"{user.first_name} {user.last_name}",
-        "firstName": user.first_name,
-        "lastName": user.last_name,
-        "picture": user.picture,
-        "membershipsCount": len(user.memberships.all()),
-    }
-
-
-def getAttachment(attachment):
-    return {
-        "id": attachment.id,
-        "title": attachment.title,
-        "size": attachment.size,
-        "contentType": attachment.content_type,
-        "creator": getUser(attachment.creator),
-        "createdAt": attachment.date_created,
-    }
-
-
-def getTag(tag):
-    return {
-        "id": tag.id,
-        "createdAt": tag.date_created,
-        "creator": getUser(tag.creator),
-        "title": tag.title,
-        "textColor": tag.text_color,
-        "backgroundColor": tag.background_color,
-        "borderColor": tag.border_color,
-    }
-
-
-def getBug(bug):
-    return {
-        "id": bug.id,
-        "index": bug.index,
-        "title": bug.title,
-        "description": bug.description,
-        "reporter": getUser(bug.reporter),
-        "createdAt": bug.date_created,
-        "updatedAt": bug.date_modified,
-        "reproducible": bug.reproducible,
-        "impact": bug.impact,
-        "urgency": bug.urgency,
-        "tags": [getTag(mark.tag) for mark in bug.marks.all()],
-        "attachments": [
-            getAttachment(attachment) for attachment in bug.attachments.all()
-        ],
-        "assignees": [
-            getUser(assignment.membership.user) for assignment in bug.assignments.all()
-        ],
-    }
-
-
-def getProject(project):
-    return {
-        "id": project.id,
-        "projectId": project.project_id,
-        "title": project.title,
-        "description": project.description,
-        "createdAt": project.date_created,
-        "updatedAt": project.date_modified,
-        "creator": getUser(project.creator),
-        "bugs": [getBug(bug) for bug in project.bugs.all()],
-        "tags": [getTag(tag) for tag in project.tags.all()],
-        "members": [
-            {
-                "authorization": membership.get_authorization_display(),
-                **getUser(membership.user),
-            }
-            for membership in project.memberships.all()
-        ],
-    }
+
+project_flights = SingleFlight(ttl=settings.PROJECT_REUSE_SECONDS)
 
 
 def me(request):
@@ -114,27 +68,27 @@ def me(request):
 
 def project_create(request):
     if request.method == "POST":
+        database = pickShard()
         try:
-            project_id = None
-            while (
-                not project_id or Project.objects.filter(project_id=project_id).exists()
-            ):
-                project_id = generate_id(length=10)
-            project = Project(
-                creator=request.user, project_id=project_id, **request.data
+            with using(database):
+                project = Project(creator=request.user, **request.data)
+                saveWithId(project, "project_id", project_ids)
+            ProjectShard.objects.create(
+                project_id=project.project_id, database=database
             )
-            project.save()
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseServerError("could not save project")
 
         try:
-            membership = Membership(
-                user=request.user, authorization="ADM", project=project
-            )
-            membership.save()
+            with using(database):
+                membership = Membership(
+                    user=request.user, authorization="ADM", project=project
+                )
+                membership.save()
+            request.user.touch()
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseServerError("could not save membership")
 
         return redirect("/projects-my")
@@ -143,10 +97,20 @@ def project_create(request):
 def projects_my(request):
     if request.method == "GET":
         try:
-            memberships = Membership.objects.filter(user=request.user)
-            memberships = list(memberships)
+            memberships = [
+                membership
+                for memberships in fanout(
+                    lambda alias: list(
+                        Membership.objects.live()
+                        .filter(user=request.user)
+                        .select_related("project")
+                        .annotate(member_count=Count("project__memberships"))
+                    )
+                )
+                for membership in memberships
+            ]
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseServerError("could not get memberships")
 
         try:
@@ -156,43 +120,287 @@ def projects_my(request):
                     "title": membership.project.title,
                     "projectId": membership.project.project_id,
                     "authorization": membership.get_authorization_display(),
-                    "memberCount": len(membership.project.memberships.all()),
+                    "memberCount": membership.member_count,
                 }
                 for membership in memberships
             ]
         except Exception as error:
-            printError(error)
+            logError(error)
+            return HttpResponseServerError("could not get projects")
+
+        return JsonResponse({"projects": projects})
+
+
+def home(request):
+    if request.method == "GET":
+        try:
+            projects = getHome(request.user)
+        except Exception as error:
+            logError(error)
             return HttpResponseServerError("could not get projects")
 
         return JsonResponse({"projects": projects})
 
 
+@requires("project.view")
 def project_get(request):
     if request.method == "GET":
+        membership = request.membership
+
+        try:
+            include = PROJECT_SECTIONS
+            if "include" in request.GET:
+                include = set(filter(None, request.GET["include"].split(",")))
+                if not include <= PROJECT_SECTIONS:
+                    raise Exception("unknown section")
+            fields = None
+            if "fields" in request.GET:
+                fields = set(filter(None, request.GET["fields"].split(",")))
+                if not fields <= set(BUG_FIELDS):
+                    raise Exception("unknown field")
+        except Exception as error:
+            logError(error)
+            return HttpResponseBadRequest("include or fields not valid")
+
+        normalized = request.GET.get("format") == "normalized"
+        project = membership.project
+
+        def build():
+            # encoded once and shared by every caller, so it must not depend on
+            # the membership of whoever triggered the build
+            return json.dumps(
+                (getProjectNormalized if normalized else getProject)(
+                    project, include, fields
+                ),
+                cls=DjangoJSONEncoder,
+                separators=(",", ":") if normalized else None,
+            ).encode()
+
+        try:
+            encoded = project_flights.do(
+                (
+                    project.project_id,
+                    project.revision,
+                    normalized,
+                    frozenset(include),
+                    frozenset(fields) if fields is not None else None,
+                ),
+                build,
+            )
+        except Exception as error:
+            logError(error)
+            return HttpResponseServerError("could not get project")
+
+        authorization = json.dumps(membership.get_authorization_display())
+        return HttpResponse(
+            b'{"project":{"authorization":%s,%s}'
+            % (authorization.encode(), encoded[1:]),
+            content_type="application/json",
+        )
+
+
+@requires("project.view")
+def project_export(request):
+    if request.method == "GET":
+        project_id = request.GET["projectId"]
+        membership = request.membership
+
+        if request.GET.get("format") == "ndjson":
+            response = StreamingHttpResponse(
+                pinned(current(), streamNdjson(membership.project)),
+                content_type="application/x-ndjson",
+            )
+            extension = "ndjson"
+        else:
+            response = StreamingHttpResponse(
+                pinned(current(), streamJson(membership.project)),
+                content_type="application/json",
+            )
+            extension = "json"
+        response[
+            "Content-Disposition"
+        ] = f'attachment; filename="{project_id}.{extension}";'
+        return response
+
+
+@requires("project.view")
+def project_stats(request):
+    if request.method == "GET":
+        membership = request.membership
+
         try:
-            project_id = request.GET["projectId"]
+            stats = getProjectStats(membership.project)
         except Exception as error:
-            printError(error)
-            return HttpResponseForbidden("projectId not specified")
+            logError(error)
+            return HttpResponseServerError("could not get stats")
+
+        return JsonResponse({"stats": stats})
 
+
+def bugs_top(request):
+    if request.method == "GET":
         try:
-            membership = Membership.objects.get(
-                user=request.user, project__project_id=project_id
+            limit = min(int(request.GET.get("limit", 20)), 100)
+        except Exception as error:
+            logError(error)
+            return HttpResponseBadRequest("limit not valid")
+
+        if "projectId" in request.GET:
+            return project_bugs_top(request, limit)
+
+        def top(alias):
+            return topBugs(
+                Bug.objects.filter(
+                    project__in=Membership.objects.live()
+                    .filter(user=request.user)
+                    .values("project"),
+                    status__in=Bug.ACTIVE_STATUSES,
+                ),
+                limit,
             )
+
+        try:
+            bugs = [bug for bugs in fanout(top) for bug in bugs]
         except Exception as error:
-            printError(error)
-            return HttpResponseForbidden("membership not found")
+            logError(error)
+            return HttpResponseServerError("could not get bugs")
+
+        return getTopResponse(bugs, limit)
+
 
+@requires("project.view")
+def project_bugs_top(request, limit):
+    # bugs-top of a single project, membership is checked like everywhere else
+    try:
+        bugs = topBugs(
+            request.membership.project.bugs.filter(status__in=Bug.ACTIVE_STATUSES),
+            limit,
+        )
+    except Exception as error:
+        logError(error)
+        return HttpResponseServerError("could not get bugs")
+
+    return getTopResponse(bugs, limit)
+
+
+def topBugs(bugs, limit):
+    bugs = bugs.select_related("project").defer("description")
+    return list(bugs.order_by("-priority", "-id")[:limit])
+
+
+def getTopResponse(bugs, limit):
+    try:
+        bugs.sort(key=lambda bug: (bug.priority, bug.id), reverse=True)
+        bugs = [getBugSummary(bug) for bug in bugs[:limit]]
+    except Exception as error:
+        logError(error)
+        return HttpResponseServerError("could not get bugs")
+
+    return JsonResponse({"bugs": bugs})
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+# orderings of bugs-mine as the field, how its value is written into the
+# cursor and read back; ties are broken by id and then by shard, so the
+# cursor is unique
+MINE_ORDERINGS = {
+    "priority": ("priority", int, int),
+    "date": (
+        "date_modified",
+        lambda value: (value - EPOCH) // MICROSECOND,
+        lambda value: EPOCH + int(value) * MICROSECOND,
+    ),
+}
+
+
+def bugs_mine(request):
+    if request.method == "GET":
         try:
-            project = {
-                "authorization": membership.get_authorization_display(),
-                **getProject(membership.project),
-            }
+            limit = min(int(request.GET.get("limit", 50)), 100)
+            field, write, read = MINE_ORDERINGS[request.GET.get("sort", "priority")]
+            cursor = None
+            if "cursor" in request.GET:
+                value, id, rank = request.GET["cursor"].split("_")
+                cursor = (read(value), int(id), int(rank))
+        except Exception as error:
+            logError(error)
+            return HttpResponseBadRequest("parameter not valid")
+
+        def load(alias):
+            rank = settings.DATABASE_SHARDS.index(alias)
+            mine = Q(assignments__membership__user=request.user)
+            if request.GET.get("reported") == "true":
+                # reported bugs may also be assigned, checked as subqueries
+                # so no bug is joined twice
+                mine = Q(
+                    id__in=Assignment.objects.filter(
+                        membership__user=request.user
+                    ).values("bug_id")
+                ) | Q(reporter=request.user)
+            bugs = Bug.objects.filter(mine, project__date_deleted__isnull=True)
+            if request.GET.get("status") != "all":
+                bugs = bugs.filter(status__in=Bug.ACTIVE_STATUSES)
+            if cursor is not None:
+                after = "id__lte" if rank < cursor[2] else "id__lt"
+                bugs = bugs.filter(
+                    Q(**{f"{field}__lt": cursor[0]})
+                    | Q(**{field: cursor[0], after: cursor[1]})
+                )
+            bugs = bugs.select_related("project").defer(
+                "description", "project__description"
+            )
+            return [(bug, rank) for bug in bugs.order_by(f"-{field}", "-id")[:limit]]
+
+        try:
+            bugs = [bug for bugs in fanout(load) for bug in bugs]
+            bugs.sort(
+                key=lambda pair: (getattr(pair[0], field), pair[0].id, pair[1]),
+                reverse=True,
+            )
+            bugs = bugs[:limit]
         except Exception as error:
-            printError(error)
-            return HttpResponseServerError("could not get project")
+            logError(error)
+            return HttpResponseServerError("could not get bugs")
 
-        return JsonResponse({"project": project})
+        cursor = None
+        if len(bugs) == limit:
+            bug, rank = bugs[-1]
+            cursor = f"{write(getattr(bug, field))}_{bug.id}_{rank}"
+        return JsonResponse(
+            {"bugs": [getBugSummary(bug) for bug, _ in bugs], "cursor": cursor}
+        )
+
+
+@requires("project.view")
+def bugs_archived(request):
+    if request.method == "GET":
+        try:
+            project_id = request.GET["projectId"]
+            limit = min(int(request.GET.get("limit", 50)), 100)
+            cursor = int(request.GET["cursor"]) if "cursor" in request.GET else None
+        except Exception as error:
+            logError(error)
+            return HttpResponseBadRequest("parameter not valid")
+
+        membership = request.membership
+
+        try:
+            bugs = membership.project.bugs.exclude(status__in=Bug.ACTIVE_STATUSES)
+            if cursor is not None:
+                bugs = bugs.filter(id__lt=cursor)
+            bugs = getBugs(bugs.order_by("-id")[:limit], membership.project)
+        except Exception as error:
+            logError(error)
+            return HttpResponseServerError("could not get bugs")
+
+        return JsonResponse(
+            {
+                "bugs": bugs,
+                "cursor": bugs[-1]["id"] if len(bugs) == limit else None,
+            }
+        )
 
 
 def memberships_count(request):
@@ -205,38 +413,163 @@ def memberships_count(request):
         return JsonResponse({"membershipsCount": count})
 
 
+def newAttachments(files, bug, user):
+    return [
+        Attachment(
+            bug=bug,
+            creator=user,
+            title=file.name,
+            file=file,
+            content_type=file.content_type,
+            size=file.size,
+        )
+        for file in files
+    ]
+
+
+def queuePreviews(attachments):
+    for attachment in attachments:
+        if previewKind(attachment.content_type, attachment.title):
+            enqueue(
+                "make_preview",
+                {"database": attachment._state.db, "attachment": attachment.id},
+            )
+
+
+# bug fields a multipart report may set, JSON reports name them as keys
+REPORT_FIELDS = ["title", "description", "reproducible", "impact", "urgency"]
+
+
+@requires("bug.report")
 def bug_report(request):
+    """
+    Report a bug, optionally together with its tags, assignees and files.
+    The body is either JSON, or multipart with the bug fields, repeated tags
+    and assignees fields and the files, all saved in one transaction.
+    Returns the new bug and the bugs it likely duplicates.
+    """
     if request.method == "POST":
+        membership = request.membership
+        project = membership.project
+
+        try:
+            if request.content_type == "multipart/form-data":
+                keys = set(request.POST) - {"tags", "assignees"}
+                # form values are strings, "false" included
+                fields = {
+                    key: Bug._meta.get_field(key)
+                    .formfield()
+                    .to_python(request.POST[key])
+                    for key in REPORT_FIELDS
+                    if key in request.POST
+                }
+                tag_ids = request.POST.getlist("tags")
+                user_ids = request.POST.getlist("assignees")
+            else:
+                fields = dict(request.data)
+                tag_ids = fields.pop("tags", [])
+                user_ids = fields.pop("assignees", [])
+                keys = set(fields)
+            # the reporter, status, index and version are not the client's
+            if not keys <= set(REPORT_FIELDS):
+                raise Exception("unknown field")
+            tag_ids, user_ids = set(map(int, tag_ids)), set(user_ids)
+            files = list(request.FILES.values())
+        except Exception as error:
+            logError(error)
+            return HttpResponseBadRequest("body not valid")
+
+        if user_ids and not can(membership.authorization, "bug.assign"):
+            return HttpResponseForbidden("not authorized")
+
         try:
-            project_id = request.GET["projectId"]
+            tags = list(project.tags.filter(id__in=tag_ids))
+            if len(tags) != len(tag_ids):
+                raise Exception("tag not in project")
         except Exception as error:
-            printError(error)
-            return HttpResponseForbidden("projectId not specified")
+            logError(error)
+            return HttpResponseNotFound("tag not found")
 
         try:
-            membership = Membership.objects.get(
-                user=request.user, project__project_id=project_id
+            users = list(
+                User.objects.filter(user_id__in=user_ids).values_list("id", flat=True)
             )
+            assignees = list(project.memberships.filter(user_id__in=users))
+            if len(assignees) != len(user_ids):
+                raise Exception("assignee not member")
         except Exception as error:
-            printError(error)
-            return HttpResponseNotFound("membership not found")
+            logError(error)
+            return HttpResponseNotAllowed("subject not member")
 
         try:
-            project = membership.project
-            project.bug_index += 1
-            bug = Bug(
-                index=project.bug_index,
-                reporter=request.user,
-                project=membership.project,
-                **request.data,
-            )
-            bug.save()
-            project.save()
+            bins = minhash(fields.get("title", ""), fields.get("description", ""))
+            duplicates = findDuplicates(project, bins)
         except Exception as error:
-            printError(error)
+            logError(error)
+            return HttpResponseServerError("could not check duplicates")
+
+        attachments = newAttachments(files, bug=None, user=request.user)
+        try:
+            with transaction.atomic(using=current()):
+                # locked so concurrent reports get consecutive indexes
+                locked = Project.objects.select_for_update().get(pk=project.pk)
+                locked.bug_index += 1
+                locked.save(update_fields=["bug_index"])
+                bug = Bug(
+                    index=locked.bug_index,
+                    reporter=request.user,
+                    project=project,
+                    **fields,
+                )
+                bug.save()
+                Mark.objects.bulk_create(
+                    [Mark(creator=request.user, bug=bug, tag=tag) for tag in tags]
+                )
+                Assignment.objects.bulk_create(
+                    [Assignment(membership=assignee, bug=bug) for assignee in assignees]
+                )
+                for attachment in attachments:
+                    attachment.bug = bug
+                Attachment.objects.bulk_create(attachments)
+                indexBugs([bug], current())
+        except Exception as error:
+            logError(error)
+            # files are written to storage while inserting, before the
+            # transaction is known to commit
+            names = [
+                attachment.file.name
+                for attachment in attachments
+                if attachment.file._committed
+            ]
+            if names:
+                enqueue("delete_files", {"names": names})
             return HttpResponseServerError("could not save bug or project")
 
-        return redirect(f"/project-get?projectId={project_id}")
+        try:
+            queuePreviews(attachments)
+            project.touch()
+            if assignees:
+                notify(
+                    "ASG",
+                    request.user,
+                    bug,
+                    project,
+                    recipients=[assignee.user_id for assignee in assignees],
+                )
+            bug = getBugs([project.bugs.get(pk=bug.pk)], project)[0]
+        except Exception as error:
+            logError(error)
+            return HttpResponseServerError("could not get bug")
+
+        return JsonResponse(
+            {
+                "bug": bug,
+                "duplicates": [
+                    getDuplicate(duplicate, score) for duplicate, score in duplicates
+                ],
+            },
+            status=201,
+        )
 
 
 def profiles_search(request):
@@ -244,7 +577,7 @@ def profiles_search(request):
         try:
             text = request.GET["text"]
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseForbidden("search text not specified")
 
         try:
@@ -255,13 +588,13 @@ def profiles_search(request):
                     Q(first_name__contains=word) | Q(last_name__contains=word)
                 )
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseServerError("could not search")
 
         try:
-            profiles = [getUser(user) for user in users[:10]]
+            profiles = [getUser(user) for user in countMemberships(users[:10])]
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseServerError("could not get users")
 
         return JsonResponse({"profiles": profiles})
@@ -272,195 +605,187 @@ def profile_get(request):
         try:
             user_id = request.GET["userId"]
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseForbidden("userId not specified")
 
         try:
             user = User.objects.get(user_id=user_id)
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("user not found")
 
         try:
             profile = getUser(user)
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseServerError("could not get profile")
 
         return JsonResponse({"profile": profile})
 
 
-def member_add(request):
+def notification_preferences(request):
+    try:
+        preference = NotificationPreference.objects.get(user=request.user)
+    except NotificationPreference.DoesNotExist:
+        preference = NotificationPreference(user=request.user)
+
     if request.method == "POST":
         try:
-            project_id = request.GET["projectId"]
+            changes = {}
+            for key in ["assignments", "changes", "window"]:
+                if key in request.data:
+                    changes[key] = request.data[key]
+            if not changes:
+                raise Exception("changes not found")
         except Exception as error:
-            printError(error)
-            return HttpResponseForbidden("projectId not specified")
+            logError(error)
+            return HttpResponseNotFound("changes not found")
 
         try:
-            user_id = request.GET["userId"]
+            preference.update(**changes)
+            preference.full_clean(exclude=["user"])
         except Exception as error:
-            printError(error)
-            return HttpResponseForbidden("userId not specified")
+            logError(error)
+            return HttpResponseBadRequest("preferences not valid")
 
         try:
-            project = Project.objects.filter(project_id=project_id).first()
+            preference.save()
         except Exception as error:
-            printError(error)
-            return HttpResponseNotFound("project not found")
+            logError(error)
+            return HttpResponseServerError("could not save preferences")
+
+    return JsonResponse({"preferences": getPreferences(preference)})
 
+
+@requires("member.add")
+def member_add(request):
+    if request.method == "POST":
         try:
-            user = User.objects.filter(user_id=user_id).first()
+            user_id = request.GET["userId"]
         except Exception as error:
-            printError(error)
-            return HttpResponseNotFound("user not found")
+            logError(error)
+            return HttpResponseForbidden("userId not specified")
 
         try:
-            membership_requester = Membership.objects.get(
-                user=request.user, project=project
-            )
-            if membership_requester.authorization not in ["ADM", "DIR"]:
-                raise Exception("authorization not sufficient")
-            membership_subject = Membership.objects.filter(
-                user=user, project=project
-            ).exists()
-            if membership_subject:
-                raise Exception("subject membership already exists")
+            user = User.objects.get(user_id=user_id)
         except Exception as error:
-            printError(error)
+            logError(error)
+            return HttpResponseNotFound("user not found")
+
+        project = request.membership.project
+
+        try:
+            with transaction.atomic(using=current()):
+                Membership.objects.create(
+                    user=user, project=project, authorization="SPE"
+                )
+        except IntegrityError as error:
+            logError(error)
             return HttpResponseForbidden("not authorized")
+        except Exception as error:
+            logError(error)
+            return HttpResponseServerError("could not create membership")
 
         try:
-            membership = Membership(user=user, project=project, authorization="SPE")
-            membership.save()
+            project.touch()
+            user.touch()
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseServerError("could not create membership")
 
         return JsonResponse({})
 
 
+@requires("member.remove")
 def member_remove(request):
     if request.method == "POST":
         try:
             project_id = request.GET["projectId"]
             user_id = request.GET["userId"]
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseForbidden("parameter not specified")
 
+        membership_requester = request.membership
+
         try:
-            membership_subject = Membership.objects.get(
-                user__user_id=user_id, project__project_id=project_id
+            membership_subject = membership_requester.project.memberships.get(
+                user=User.objects.get(user_id=user_id)
             )
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("subject membership not found")
 
         try:
-            membership_requester = membership_subject.project.memberships.get(
-                user=request.user
-            )
-            if membership_requester.authorization not in ["ADM", "DIR"] or (
-                membership_requester.authorization == "DIR"
-                and membership_subject.authorization in ["ADM", "DIR"]
+            if not canRemove(
+                membership_requester.authorization, membership_subject.authorization
             ):
                 raise Exception("authorization not sufficient")
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseForbidden("not authorized")
 
         try:
+            Bug.objects.filter(assignments__membership=membership_subject).update(
+                date_modified=timezone.now()
+            )
             membership_subject.delete()
+            membership_requester.project.touch()
+            membership_subject.user.touch()
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseServerError("could not delete membership")
 
         return redirect(f"/project-get?projectId={project_id}")
 
 
+@requires("member.authorize")
 def member_authorize(request):
     if request.method == "POST":
         try:
             user_id = request.GET["userId"]
             project_id = request.GET["projectId"]
-            authorization = request.GET["authorization"]
+            authorization = AUTHORIZATIONS[request.GET["authorization"]]
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseBadRequest("parameter not found")
 
-        try:
-            membership_requester = Membership.objects.get(
-                user=request.user, project__project_id=project_id
-            )
-        except Exception as error:
-            printError(error)
-            return HttpResponseNotFound("requester not member")
+        membership_requester = request.membership
 
         try:
             membership_subject = membership_requester.project.memberships.get(
-                user__user_id=user_id
+                user=User.objects.get(user_id=user_id)
             )
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("subject not member")
 
-        convert = {
-            "Administrator": "ADM",
-            "Director": "DIR",
-            "Contributor": "CON",
-            "Spectator": "SPE",
-        }
-
-        allowed = {
-            "ADM": {
-                "ADM": ["DIR", "CON", "SPE"],
-                "DIR": ["ADM", "CON", "SPE"],
-                "CON": ["ADM", "DIR", "SPE"],
-                "SPE": ["ADM", "DIR", "CON"],
-            },
-            "DIR": {"CON": ["SPE"], "SPE": ["CON"]},
-        }
-
         try:
-            print(
+            if not canNominate(
                 membership_requester.authorization,
                 membership_subject.authorization,
                 authorization,
-            )
-            if not (
-                membership_requester.authorization in allowed
-                and membership_subject.authorization
-                in allowed[membership_requester.authorization]
-                and convert[authorization]
-                in allowed[membership_requester.authorization][
-                    membership_subject.authorization
-                ]
             ):
                 raise Exception("not authorized")
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseForbidden("not authorized")
 
         try:
-            membership_subject.authorization = convert[authorization]
-            membership_subject.save()
+            membership_subject.authorization = authorization
+            membership_subject.save(update_fields=["authorization", "date_modified"])
+            membership_requester.project.touch()
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseServerError("could not save")
 
         return redirect(f"/project-get?projectId={project_id}")
 
 
+@requires("tag.create")
 def tag_create(request):
     if request.method == "POST":
-        try:
-            project_id = request.GET["projectId"]
-        except Exception as error:
-            printError(error)
-            return HttpResponseBadRequest("parameter not found")
-
+        project_id = request.GET["projectId"]
         try:
             parameters = {
                 "title": request.data["title"],
@@ -469,75 +794,93 @@ def tag_create(request):
                 "background_color": request.data["backgroundColor"],
             }
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseBadRequest("bad body")
 
-        try:
-            membership = Membership.objects.get(
-                user=request.user, project__project_id=project_id
-            )
-        except Exception as error:
-            printError(error)
-            return HttpResponseNotAllowed("not member")
+        membership = request.membership
 
         try:
-            tag = Tag.objects.filter(project=membership.project, **parameters).exists()
-            if tag:
-                raise Exception("tag already exists")
-        except Exception as error:
-            printError(error)
+            with transaction.atomic(using=current()):
+                Tag.objects.create(
+                    project=membership.project, creator=membership.user, **parameters
+                )
+        except IntegrityError as error:
+            logError(error)
             return HttpResponseNotAllowed("tag already exists")
+        except Exception as error:
+            logError(error)
+            return HttpResponseServerError("could not save")
 
         try:
-            tag = Tag(project=membership.project, creator=membership.user, **parameters)
-            tag.save()
+            membership.project.touch()
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseServerError("could not save")
 
         return redirect(f"/project-get?projectId={project_id}")
 
 
+@requires("tag.remove")
 def tag_remove(request):
     if request.method == "POST":
         try:
             project_id = request.GET["projectId"]
             tag_id = request.GET["tagId"]
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseBadRequest("parameter not found")
 
-        try:
-            membership = Membership.objects.get(
-                user=request.user, project__project_id=project_id
-            )
-        except Exception as error:
-            printError(error)
-            return HttpResponseNotAllowed("not member")
+        membership = request.membership
 
         try:
             tag = membership.project.tags.get(id=tag_id)
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("tag not found")
 
         try:
+            Bug.objects.filter(marks__tag=tag).update(date_modified=timezone.now())
             tag.delete()
+            membership.project.touch()
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseServerError("could not delete")
 
         return redirect(f"/project-get?projectId={project_id}")
 
 
-def project_edit(request):
+@requires("project.delete")
+def project_delete(request):
     if request.method == "POST":
+        membership = request.membership
+
         try:
-            project_id = request.GET["projectId"]
+            # hidden right away, the rows are removed by the purge_project task
+            Project.objects.filter(pk=membership.project.pk).update(
+                date_deleted=timezone.now(), revision=F("revision") + 1
+            )
+            enqueue(
+                "purge_project",
+                {"project_id": membership.project.project_id},
+                key=f"purge:{membership.project.project_id}",
+            )
         except Exception as error:
-            printError(error)
-            return HttpResponseBadRequest("parameter not found")
+            logError(error)
+            return HttpResponseServerError("could not delete project")
+
+        return redirect("/projects-my")
+
 
+def getVersion(request):
+    # version of the row the client based its edit on, None skips the check
+    version = request.data.get("version")
+    return None if version is None else int(version)
+
+
+@requires("project.edit")
+def project_edit(request):
+    if request.method == "POST":
+        project_id = request.GET["projectId"]
         try:
             changes = {}
             for key in ["title", "description"]:
@@ -546,72 +889,124 @@ def project_edit(request):
             if not changes:
                 raise Exception("changes not found")
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("changes not found")
 
         try:
-            membership = Membership.objects.get(
-                user=request.user, project__project_id=project_id
-            )
+            version = getVersion(request)
         except Exception as error:
-            printError(error)
-            return HttpResponseNotAllowed("not member")
+            logError(error)
+            return HttpResponseBadRequest("version not valid")
+
+        membership = request.membership
 
         try:
-            membership.project.update(**changes)
-            membership.project.save()
+            edited = membership.project.edit(changes, version)
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseServerError("could update")
 
+        if not edited:
+            project = Project.objects.get(pk=membership.project.pk)
+            return JsonResponse(
+                {"error": "version conflict", "project": getProjectFields(project)},
+                status=409,
+            )
+
         return redirect(f"/project-get?projectId={project_id}")
 
 
+@requires("bug.edit")
 def bug_edit(request):
     if request.method == "POST":
         try:
             project_id = request.GET["projectId"]
             bug_id = request.GET["bugId"]
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseBadRequest("parameter not found")
 
         try:
             changes = {}
-            for key in ["title", "description", "reproducible", "impact", "urgency"]:
+            for key in [
+                "title",
+                "description",
+                "reproducible",
+                "impact",
+                "urgency",
+                "status",
+            ]:
                 if key in request.data:
                     changes[key] = request.data[key]
-            print(changes)
             if not changes:
                 raise Exception("changes not found")
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("changes not found")
 
+        membership = request.membership
+
         try:
-            membership = Membership.objects.get(
-                user=request.user, project__project_id=project_id
-            )
+            version = getVersion(request)
         except Exception as error:
-            printError(error)
-            return HttpResponseNotAllowed("not member")
+            logError(error)
+            return HttpResponseBadRequest("version not valid")
 
         try:
             bug = membership.project.bugs.get(id=bug_id)
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("bug not found")
 
         try:
-            bug.update(**changes)
-            bug.save()
+            if not canOnBug(membership, "bug.edit", bug):
+                raise Exception("bug.edit not allowed on this bug")
         except Exception as error:
-            printError(error)
+            logError(error)
+            return HttpResponseForbidden("not authorized")
+
+        try:
+            if "status" in changes:
+                statuses = {name: code for code, name in Bug.STATUS_CHOICES}
+                status = statuses[changes["status"]]
+                if (
+                    status != bug.status
+                    and status not in Bug.STATUS_TRANSITIONS[bug.status]
+                ):
+                    raise Exception("status transition not allowed")
+                changes["status"] = status
+        except Exception as error:
+            logError(error)
+            return HttpResponseBadRequest("status not valid")
+
+        try:
+            edited = bug.edit(changes, version)
+            if edited:
+                membership.project.touch()
+                if "title" in changes or "description" in changes:
+                    bug = membership.project.bugs.get(id=bug_id)
+                    indexBugs([bug], current())
+                notify(
+                    "CHG", request.user, bug, membership.project, changes=list(changes)
+                )
+        except Exception as error:
+            logError(error)
             return HttpResponseServerError("could update")
 
+        if not edited:
+            bug = membership.project.bugs.get(id=bug_id)
+            return JsonResponse(
+                {
+                    "error": "version conflict",
+                    "bug": getBugs([bug], membership.project)[0],
+                },
+                status=409,
+            )
+
         return redirect(f"/project-get?projectId={project_id}")
 
 
+@requires("bug.tag")
 def tag_add(request):
     if request.method == "POST":
         try:
@@ -619,47 +1014,43 @@ def tag_add(request):
             bug_id = request.GET["bugId"]
             tag_id = request.GET["tagId"]
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseBadRequest("parameter not found")
 
-        try:
-            membership = Membership.objects.get(
-                user=request.user, project__project_id=project_id
-            )
-        except Exception as error:
-            printError(error)
-            return HttpResponseNotAllowed("not member")
+        membership = request.membership
 
         try:
             bug = membership.project.bugs.get(id=bug_id)
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("bug not found")
 
         try:
             tag = membership.project.tags.get(id=tag_id)
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("tag not found")
 
         try:
-            mark = bug.marks.filter(tag=tag).first()
-            if mark:
-                return HttpResponseNotAllowed("tag already added")
-        except Exception as error:
-            printError(error)
+            with transaction.atomic(using=current()):
+                Mark.objects.create(creator=request.user, bug=bug, tag=tag)
+        except IntegrityError:
             return HttpResponseNotAllowed("tag already added")
+        except Exception as error:
+            logError(error)
+            return HttpResponseServerError("could not save mark")
 
         try:
-            mark = Mark(creator=request.user, bug=bug, tag=tag)
-            mark.save()
+            bug.touch()
+            membership.project.touch()
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseServerError("could not save mark")
 
         return redirect(f"/project-get?projectId={project_id}")
 
 
+@requires("bug.tag")
 def mark_remove(request):
     if request.method == "POST":
         try:
@@ -667,44 +1058,41 @@ def mark_remove(request):
             bug_id = request.GET["bugId"]
             tag_id = request.GET["tagId"]
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseBadRequest("parameter not found")
 
-        try:
-            membership = Membership.objects.get(
-                user=request.user, project__project_id=project_id
-            )
-        except Exception as error:
-            printError(error)
-            return HttpResponseNotAllowed("not member")
+        membership = request.membership
 
         try:
             bug = membership.project.bugs.get(id=bug_id)
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("bug not found")
 
         try:
             tag = membership.project.tags.get(id=tag_id)
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("tag not found")
 
         try:
             mark = bug.marks.get(tag=tag)
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("mark not found")
 
         try:
             mark.delete()
+            bug.touch()
+            membership.project.touch()
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseServerError("could not delete mark")
 
         return redirect(f"/project-get?projectId={project_id}")
 
 
+@requires("bug.assign")
 def assign(request):
     if request.method == "POST":
         try:
@@ -712,49 +1100,52 @@ def assign(request):
             bug_id = request.GET["bugId"]
             user_id = request.GET["userId"]
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseBadRequest("parameter not found")
 
-        try:
-            membership_requester = Membership.objects.get(
-                user=request.user, project__project_id=project_id
-            )
-        except Exception as error:
-            printError(error)
-            return HttpResponseNotAllowed("requester not member")
+        membership_requester = request.membership
 
         try:
             membership_subject = membership_requester.project.memberships.get(
-                user__user_id=user_id
+                user=User.objects.get(user_id=user_id)
             )
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotAllowed("subject not member")
 
         try:
             bug = membership_requester.project.bugs.get(id=bug_id)
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("bug not found")
 
         try:
-            assignment = bug.assignments.filter(membership=membership_subject).first()
-            if assignment:
-                return HttpResponseNotAllowed("already assigned")
-        except Exception as error:
-            printError(error)
+            with transaction.atomic(using=current()):
+                Assignment.objects.create(membership=membership_subject, bug=bug)
+        except IntegrityError:
             return HttpResponseNotAllowed("already assigned")
+        except Exception as error:
+            logError(error)
+            return HttpResponseNotFound("could not save assignment")
 
         try:
-            assignment = Assignment(membership=membership_subject, bug=bug)
-            assignment.save()
+            bug.touch()
+            membership_requester.project.touch()
+            notify(
+                "ASG",
+                request.user,
+                bug,
+                membership_requester.project,
+                recipients=[membership_subject.user_id],
+            )
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("could not save assignment")
 
         return redirect(f"/project-get?projectId={project_id}")
 
 
+@requires("bug.assign")
 def assign_remove(request):
     if request.method == "POST":
         try:
@@ -762,87 +1153,75 @@ def assign_remove(request):
             bug_id = request.GET["bugId"]
             user_id = request.GET["userId"]
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseBadRequest("parameter not found")
 
-        try:
-            membership_requester = Membership.objects.get(
-                user=request.user, project__project_id=project_id
-            )
-        except Exception as error:
-            printError(error)
-            return HttpResponseNotAllowed("requester not member")
+        membership_requester = request.membership
 
         try:
             membership_subject = membership_requester.project.memberships.get(
-                user__user_id=user_id
+                user=User.objects.get(user_id=user_id)
             )
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotAllowed("subject not member")
 
         try:
             bug = membership_requester.project.bugs.get(id=bug_id)
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("bug not found")
 
         try:
             assignment = bug.assignments.get(membership=membership_subject)
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("could not find assignment")
 
         try:
             assignment.delete()
+            bug.touch()
+            membership_requester.project.touch()
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("could not remove assignment")
 
         return redirect(f"/project-get?projectId={project_id}")
 
 
+@requires("bug.attach")
 def attach(request):
     if request.method == "POST":
         try:
             project_id = request.GET["projectId"]
             bug_id = request.GET["bugId"]
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseBadRequest("parameter not found")
 
-        try:
-            membership = Membership.objects.get(
-                user=request.user, project__project_id=project_id
-            )
-        except Exception as error:
-            printError(error)
-            return HttpResponseNotAllowed("not member")
+        membership = request.membership
 
         try:
             bug = membership.project.bugs.get(id=bug_id)
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("bug not found")
 
         try:
-            for file in request.FILES.values():
-                attachment = Attachment(
-                    bug=bug,
-                    creator=request.user,
-                    title=file.name,
-                    file=file,
-                    content_type=file.content_type,
-                    size=file.size,
-                )
+            attachments = newAttachments(request.FILES.values(), bug, request.user)
+            for attachment in attachments:
                 attachment.save()
+            queuePreviews(attachments)
+            bug.touch()
+            membership.project.touch()
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("could not process files")
 
         return redirect(f"/project-get?projectId={project_id}")
 
 
+@requires("project.view")
 def attachment_get(request):
     if request.method == "GET":
         try:
@@ -850,28 +1229,22 @@ def attachment_get(request):
             bug_id = request.GET["bugId"]
             attachment_id = request.GET["attachmentId"]
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseBadRequest("parameter not found")
 
-        try:
-            membership = Membership.objects.get(
-                user=request.user, project__project_id=project_id
-            )
-        except Exception as error:
-            printError(error)
-            return HttpResponseNotAllowed("not member")
+        membership = request.membership
 
         try:
             bug = membership.project.bugs.get(id=bug_id)
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("bug not found")
 
         try:
             attachment = bug.attachments.get(id=attachment_id)
             file = attachment.file
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("attachment not found")
 
         try:
@@ -883,47 +1256,103 @@ def attachment_get(request):
             ] = f'attachment; filename="{attachment.title}";'
 
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("attachment not found")
 
         return response
 
 
-def attachment_remove(request):
-    if request.method == "POST":
+@requires("project.view")
+def attachment_preview(request):
+    if request.method == "GET":
         try:
-            project_id = request.GET["projectId"]
             bug_id = request.GET["bugId"]
             attachment_id = request.GET["attachmentId"]
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseBadRequest("parameter not found")
 
+        membership = request.membership
+
         try:
-            membership = Membership.objects.get(
-                user=request.user, project__project_id=project_id
+            attachment = Attachment.objects.get(
+                id=attachment_id, bug_id=bug_id, bug__project=membership.project
             )
+            if not attachment.preview:
+                raise Exception("no preview yet")
+        except Exception as error:
+            logError(error)
+            return HttpResponseNotFound("preview not found")
+
+        # a preview never changes once made, only the attachment's removal
+        # takes it away
+        etag = f'"{attachment.preview.name}"'
+        if request.headers.get("If-None-Match") == etag:
+            response = HttpResponse(status=304)
+        else:
+            try:
+                response = FileResponse(
+                    attachment.preview.open("rb"),
+                    content_type=attachment.preview_type,
+                )
+            except Exception as error:
+                logError(error)
+                return HttpResponseNotFound("preview not found")
+        response["ETag"] = etag
+        response["Cache-Control"] = "private, max-age=86400"
+        return response
+
+
+@requires("attachment.remove")
+def attachment_remove(request):
+    if request.method == "POST":
+        try:
+            project_id = request.GET["projectId"]
+            bug_id = request.GET["bugId"]
+            attachment_id = request.GET["attachmentId"]
         except Exception as error:
-            printError(error)
-            return HttpResponseNotAllowed("not member")
+            logError(error)
+            return HttpResponseBadRequest("parameter not found")
+
+        membership = request.membership
 
         try:
             bug = membership.project.bugs.get(id=bug_id)
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("bug not found")
 
         try:
             attachment = bug.attachments.get(id=attachment_id)
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseNotFound("attachment not found")
 
         try:
-            attachment.file.delete()
-            attachment.delete()
+            if not canOnBug(membership, "attachment.remove", bug):
+                raise Exception("attachment.remove not allowed on this bug")
+        except Exception as error:
+            logError(error)
+            return HttpResponseForbidden("not authorized")
+
+        try:
+            with transaction.atomic(using=current()):
+                # locked, so a preview made meanwhile is either deleted here
+                # or by the make_preview task
+                attachment = Attachment.objects.select_for_update().get(
+                    id=attachment.id
+                )
+                names = [
+                    name
+                    for name in (attachment.file.name, attachment.preview.name)
+                    if name
+                ]
+                attachment.delete()
+            enqueue("delete_files", {"names": names})
+            bug.touch()
+            membership.project.touch()
         except Exception as error:
-            printError(error)
+            logError(error)
             return HttpResponseServerError("could not delete attachment")
 
         return redirect(f"/project-get?projectId={project_id}")